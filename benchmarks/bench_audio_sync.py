@@ -0,0 +1,209 @@
+# benchmarks/bench_audio_sync.py
+"""
+Đo đồng bộ tiếng-hình của audio livestream không cần micro/loa: SyntheticAudioSource (realtime) qua
+AudioCaptureThread, một "mạng" giả lập (độ trễ cố định + jitter, giữ thứ tự như TCP, bỏ ngẫu nhiên --loss
+frame như khi hàng đợi gửi đầy) vào AudioPlayoutBuffer, phát bằng AudioPlayer(use_device=False).
+
+Phía viewer được báo độ trễ hiển thị video (--video-delay-ms, đo trên trục giờ viewer - timestamp host như
+ViewerDecodePipeline.latency_ms). Mỗi frame audio mang thời điểm thu thật của nó, nên khi phát:
+lệch tiếng-hình = giờ phát - (giờ thu + độ trễ video); dương là tiếng chậm hơn hình.
+Hai kiểu lệch đồng hồ được giả lập:
+- đồng hồ mẫu của card âm thanh phía host nhanh hơn --device-skew-ppm (AudioCaptureThread phải chỉnh mốc);
+- đồng hồ máy viewer nhanh hơn máy host --viewer-skew-ppm: thread phát và thread nhận của viewer thấy một
+  đồng hồ chạy nhanh hơn (thay module time của audio_track), nên phát nhanh hơn nhịp thu và buffer phải
+  chèn im lặng để không trôi dần.
+
+Mỗi kịch bản chạy --duration giây thời gian thực; in lệch tiếng-hình (p50/p99/max, bỏ --warmup giây đầu),
+độ trôi (trung bình 2 giây cuối - 2 giây đầu) và số frame phát / che (im lặng thay frame mất) / bỏ / chèn.
+Buffer chỉ sửa khi lệch quá một frame và AudioCaptureThread chỉ chỉnh mốc khi trôi quá max_drift_ms (40 ms),
+nên lệch trong khoảng đó là đúng thiết kế; điều cần thấy là độ trôi không tăng theo thời gian.
+
+Chạy từ thư mục gốc dự án:
+    python benchmarks/bench_audio_sync.py --duration 10 --jitter-ms 40 --loss 0.01 --viewer-skew-ppm 5000
+"""
+import argparse
+import os
+import queue
+import random
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.core import audio_track
+from src.core.audio_track import AudioCaptureThread, AudioPlayer, AudioPlayoutBuffer, SyntheticAudioSource
+
+_MARKER = struct.Struct("<d") # Giờ thu thật (ms) ghi đè lên 8 byte đầu của PCM để nhận ra frame khi phát
+_VIEWER_THREADS = ("LivestreamAudioPlayout", "SimulatedLink")
+
+
+class SkewedClock:
+    """
+    Thay module time trong audio_track: các thread phía viewer (_VIEWER_THREADS) thấy đồng hồ chạy nhanh hơn
+    thật `rate` lần (time, monotonic và sleep cùng tỉ lệ), các thread khác (phía host) thấy đồng hồ thật.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._wall_origin = time.time()
+        self._mono_origin = time.monotonic()
+
+    def viewer_time(self, real_time: float) -> float:
+        return self._wall_origin + (real_time - self._wall_origin) * self.rate
+
+    def _on_viewer(self) -> bool:
+        return threading.current_thread().name in _VIEWER_THREADS
+
+    def time(self) -> float:
+        return self.viewer_time(time.time()) if self._on_viewer() else time.time()
+
+    def monotonic(self) -> float:
+        now = time.monotonic()
+        return self._mono_origin + (now - self._mono_origin) * self.rate if self._on_viewer() else now
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds / self.rate if self._on_viewer() else seconds)
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class SimulatedLink:
+    """Chuyển frame audio tới buffer của viewer sau network_ms + jitter, giữ thứ tự, bỏ ngẫu nhiên theo loss."""
+
+    def __init__(self, playout: AudioPlayoutBuffer, network_ms: float, jitter_ms: float, loss: float, seed: int = 1):
+        self.playout = playout
+        self.network_ms = network_ms
+        self.jitter_ms = jitter_ms
+        self.loss = loss
+        self.lost = 0
+        self._rng = random.Random(seed)
+        self._queue: "queue.Queue" = queue.Queue()
+        self._last_delivery = 0.0
+        self._thread = threading.Thread(target=self._run, name="SimulatedLink", daemon=True)
+        self._thread.start()
+
+    def send(self, seq: int, timestamp_ms: int, pcm: bytes):
+        if self._rng.random() < self.loss:
+            self.lost += 1
+            return
+        deliver_at = time.monotonic() + (self.network_ms + self._rng.uniform(0, self.jitter_ms)) / 1000
+        self._last_delivery = max(self._last_delivery, deliver_at) # TCP: frame sau không vượt frame trước
+        self._queue.put((self._last_delivery, seq, timestamp_ms, pcm))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            deliver_at, seq, timestamp_ms, pcm = item
+            delay = deliver_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.playout.push(seq, timestamp_ms, pcm)
+
+
+def _run_scenario(name: str, args, network_ms: float, jitter_ms: float, loss: float,
+                  device_skew_ppm: float, viewer_skew_ppm: float):
+    start_ms = time.time() * 1000
+    clock = SkewedClock(1.0 + viewer_skew_ppm * 1e-6)
+    audio_track.time = clock
+
+    playout = AudioPlayoutBuffer(args.sample_rate, 1, args.frame_ms,
+                                 target_delay_ms=60.0, max_delay_ms=max(300.0, args.video_delay_ms * 2))
+    link = SimulatedLink(playout, network_ms, jitter_ms, loss)
+    source = SyntheticAudioSource(round(args.sample_rate * (1 + device_skew_ppm * 1e-6)), 1, args.frame_ms)
+    source.samples_per_frame = audio_track.frame_samples(args.sample_rate, args.frame_ms) # Cùng kích thước frame, nhịp nhanh hơn
+
+    def on_frame(seq: int, timestamp_ms: int, pcm: bytes):
+        captured_ms = time.time() * 1000 - args.frame_ms # Mẫu đầu của frame được thu một frame trước lúc read() trả về
+        link.send(seq, timestamp_ms, _MARKER.pack(captured_ms) + pcm[_MARKER.size:])
+
+    errors = [] # (giờ phát, lệch tiếng-hình ms)
+
+    def on_played(pcm: bytes):
+        now_ms = time.time() * 1000
+        captured_ms = _MARKER.unpack_from(pcm)[0]
+        if captured_ms <= 0:
+            return # Im lặng (chưa phát, che frame mất hoặc chèn để chờ)
+        errors.append((now_ms, now_ms - (captured_ms + args.video_delay_ms)))
+
+    player = AudioPlayer(playout, use_device=False, sink=on_played)
+    capture = AudioCaptureThread(source, on_frame)
+    stop = threading.Event()
+
+    def report_video_delay():
+        # Như LivestreamService: độ trễ hiển thị của frame video đang thấy, trên trục giờ viewer - timestamp host
+        while not stop.wait(0.1):
+            now = time.time()
+            playout.set_video_delay_ms(clock.viewer_time(now) * 1000 - (now * 1000 - args.video_delay_ms))
+
+    reporter = threading.Thread(target=report_video_delay, daemon=True)
+    reporter.start()
+    capture.start()
+    player.start()
+    time.sleep(args.duration)
+    capture.stop()
+    capture.join()
+    link.close()
+    player.stop()
+    stop.set()
+    reporter.join()
+    audio_track.time = time
+
+    measured = [(at, error) for at, error in errors if at - start_ms >= args.warmup * 1000]
+    values = [error for _, error in measured]
+    absolute = [abs(error) for error in values]
+    end_ms = measured[-1][0] if measured else start_ms
+    first = [error for at, error in measured if at - measured[0][0] < 2000]
+    last = [error for at, error in measured if end_ms - at < 2000]
+    drift = (sum(last) / len(last) - sum(first) / len(first)) if first and last else 0.0
+    stats = playout.get_stats()
+    print(f"  {name:<24} lip-sync p50 {_percentile(values, 50):+6.1f} ms  |p99| {_percentile(absolute, 99):5.1f} ms  "
+          f"max {max(absolute or [0]):5.1f} ms  drift {drift:+5.1f} ms   played {stats['played_frames']:4d}  "
+          f"concealed {stats['concealed_frames']:3d} (lost {link.lost:3d})  sync drops {stats['sync_drops']:3d}  "
+          f"inserts {stats['sync_inserts']:3d}  late {stats['late_frames']:2d}  underruns {stats['underruns']:3d}  "
+          f"capture clock fixes {capture.clock_adjustments}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=10.0, help="Thời gian chạy mỗi kịch bản (giây)")
+    parser.add_argument("--warmup", type=float, default=1.0, help="Bỏ qua lệch tiếng-hình của chừng này giây đầu")
+    parser.add_argument("--sample-rate", type=int, default=16000)
+    parser.add_argument("--frame-ms", type=int, default=20)
+    parser.add_argument("--network-ms", type=float, default=30.0, help="Độ trễ mạng cố định")
+    parser.add_argument("--jitter-ms", type=float, default=40.0, help="Jitter thêm vào, phân bố đều 0..jitter")
+    parser.add_argument("--loss", type=float, default=0.01, help="Tỉ lệ frame audio bị bỏ trên đường gửi")
+    parser.add_argument("--video-delay-ms", type=float, default=150.0, help="Độ trễ capture -> hiển thị của video")
+    parser.add_argument("--device-skew-ppm", type=float, default=10000.0, help="Card âm thanh host nhanh hơn (ppm)")
+    parser.add_argument("--viewer-skew-ppm", type=float, default=5000.0, help="Đồng hồ viewer nhanh hơn host (ppm)")
+    args = parser.parse_args()
+    audio_track.log_event = lambda *a, **k: None # Không đo chi phí ghi file log
+
+    print(f"{args.frame_ms} ms frames, video delay {args.video_delay_ms:g} ms, network {args.network_ms:g} ms, "
+          f"{args.duration:g} s per scenario:")
+    scenarios = (
+        ("clean link", args.network_ms, 0.0, 0.0, 0.0, 0.0),
+        (f"jitter {args.jitter_ms:g} ms + loss", args.network_ms, args.jitter_ms, args.loss, 0.0, 0.0),
+        (f"capture clock {args.device_skew_ppm:+g} ppm", args.network_ms, 0.0, 0.0, args.device_skew_ppm, 0.0),
+        (f"viewer clock {args.viewer_skew_ppm:+g} ppm", args.network_ms, 0.0, 0.0, 0.0, args.viewer_skew_ppm),
+        ("all of the above", args.network_ms, args.jitter_ms, args.loss, args.device_skew_ppm, args.viewer_skew_ppm),
+    )
+    for name, network_ms, jitter_ms, loss, device_skew_ppm, viewer_skew_ppm in scenarios:
+        _run_scenario(name, args, network_ms, jitter_ms, loss, device_skew_ppm, viewer_skew_ppm)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# benchmarks/bench_history_paging.py
+"""
+Đo chi phí mở kênh và cuộn ngược lịch sử với local_store theo số tin nhắn của kênh.
+
+Mỗi kênh (--sizes, mặc định 100 / 10k / 100k tin nhắn, --ties tin nhắn chung một timestamp) được đo:
+- mở kênh: đọc trang --page tin nhắn mới nhất (get_messages_before không có mốc), p50/p99;
+- cuộn ngược: độ trễ mỗi trang khi đi hết lịch sử bằng mốc keyset (timestamp, id), p50/max,
+  kèm kiểm tra không thiếu/lặp tin nhắn nào dù timestamp trùng nhau;
+- để so sánh: trang sâu nhất nếu phân trang bằng LIMIT/OFFSET (SQLite phải duyệt qua mọi dòng bị bỏ qua).
+
+Chạy từ thư mục gốc dự án:
+    python benchmarks/bench_history_paging.py --sizes 100 10000 100000 --page 100
+"""
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.models.message import Message
+from src.storage import local_store
+
+_SQL_OFFSET_PAGE = local_store._SQL_SELECT_COLUMNS + \
+    " WHERE channel_id = ? ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?;"
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _seed(channel_id: str, count: int, ties: int):
+    base = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    batch = []
+    for index in range(count):
+        # id không tăng theo thời gian (như UUID) để thứ tự trong nhóm trùng timestamp chỉ do id quyết định
+        batch.append(Message(channel_id=channel_id, user_id=f"user-{index % 50}", content=f"tin nhắn số {index}",
+                             timestamp=base + datetime.timedelta(seconds=index // ties),
+                             id=f"{channel_id}-{(index * 7919) % count:09d}"))
+        if len(batch) == 5000:
+            local_store.add_messages(batch)
+            batch = []
+    local_store.add_messages(batch)
+
+
+def _measure(channel_id: str, count: int, args):
+    opens = []
+    for _ in range(args.opens):
+        started = time.perf_counter()
+        page = local_store.get_messages_before(channel_id, limit=args.page)
+        opens.append((time.perf_counter() - started) * 1000)
+
+    pages = []
+    seen = set(message.id for message in page)
+    while page:
+        started = time.perf_counter()
+        page = local_store.get_messages_before(channel_id, page[0].timestamp, page[0].id, args.page)
+        pages.append((time.perf_counter() - started) * 1000)
+        seen.update(message.id for message in page)
+    if len(seen) != count:
+        raise RuntimeError(f"Keyset paging returned {len(seen)} distinct messages, expected {count}")
+
+    started = time.perf_counter()
+    with local_store._connections.reader() as conn:
+        conn.execute(_SQL_OFFSET_PAGE, (channel_id, args.page, max(0, count - args.page))).fetchall()
+    deepest_offset = (time.perf_counter() - started) * 1000
+
+    print(f"{count:>9} msgs: open p50 {_percentile(opens, 50):6.2f} ms  p99 {_percentile(opens, 99):6.2f} ms   "
+          f"scroll back {len(pages):5d} pages p50 {_percentile(pages, 50):6.2f} ms  max {max(pages):6.2f} ms   "
+          f"deepest page with OFFSET {deepest_offset:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 10000, 100000], help="Số tin nhắn mỗi kênh")
+    parser.add_argument("--page", type=int, default=100, help="Số tin nhắn mỗi trang")
+    parser.add_argument("--ties", type=int, default=10, help="Số tin nhắn chung một timestamp")
+    parser.add_argument("--opens", type=int, default=200, help="Số lần đo mở kênh")
+    args = parser.parse_args()
+    local_store.log_event = lambda *a, **k: None # Không đo chi phí ghi file log
+
+    with tempfile.TemporaryDirectory() as tmp:
+        local_store.DB_FILE = os.path.join(tmp, "bench.db")
+        local_store.init_storage()
+        for count in args.sizes:
+            _seed(f"channel-{count}", count, args.ties)
+        print(f"Page size {args.page}, {args.ties} messages per timestamp:")
+        for count in args.sizes:
+            _measure(f"channel-{count}", count, args)
+        local_store.close_storage()
+
+
+if __name__ == "__main__":
+    main()
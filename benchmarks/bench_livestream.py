@@ -0,0 +1,208 @@
+# benchmarks/bench_livestream.py
+"""
+Benchmark đầu-cuối cho livestream: một host LivestreamService và N viewer, mỗi bên một P2PService
+nối qua loopback, host dùng nguồn frame giả (SyntheticFrameSource) nên chạy được không cần camera/màn hình.
+
+Báo cáo cho từng viewer: FPS hiển thị, độ trễ capture -> hiển thị (p50/p99), số frame bị bỏ;
+thời gian CPU của từng công đoạn (thumbnail preview, encode JPEG/delta, giải mã + ghép tile, chuyển ảnh
+hiển thị, xử lý message trên event loop) và số byte host đã ghi ra socket.
+
+Cần PySide6, qasync, OpenCV, NumPy. Chạy từ thư mục gốc dự án:
+    python benchmarks/bench_livestream.py --viewers 4 --width 1280 --height 720 --quality 70 --fps 24 --duration 10
+"""
+import argparse
+import asyncio
+import collections
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen") # QPixmap cần QGuiApplication, không cần màn hình
+
+import qasync
+from PySide6.QtGui import QGuiApplication
+
+from src.core import host_pipeline, simulcast, viewer_pipeline
+from src.core.adaptive_bitrate import AdaptiveBitrateController, QualityRung
+from src.core.frame_source import SyntheticFrameSource
+from src.core.livestream_service import LivestreamService
+from src.core.peer_manager import PeerManager
+from src.core.tile_delta import TileCompositor
+from src.p2p import protocol as p2p_proto
+from src.p2p.p2p_service import P2PService
+
+LIVESTREAM_TYPES = {
+    p2p_proto.MSG_TYPE_LIVESTREAM_START, p2p_proto.MSG_TYPE_LIVESTREAM_END, p2p_proto.MSG_TYPE_VIDEO_FRAME,
+    p2p_proto.MSG_TYPE_AUDIO_FRAME, p2p_proto.MSG_TYPE_RELAY_ASSIGN, p2p_proto.MSG_TYPE_RELAY_REPORT,
+    p2p_proto.MSG_TYPE_LIVESTREAM_SUBSCRIBE, p2p_proto.MSG_TYPE_LIVESTREAM_UNSUBSCRIBE,
+}
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class StageCpu:
+    """Cộng dồn thời gian CPU của thread (time.thread_time) theo công đoạn, an toàn với nhiều thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            started = time.thread_time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.thread_time() - started
+                with self._lock:
+                    self.seconds[stage] += elapsed
+                    self.calls[stage] += 1
+        return timed
+
+
+def _instrument(cpu: StageCpu):
+    """Bọc các hàm của từng công đoạn để đo CPU (thay thuộc tính module mà pipeline tra cứu lúc chạy)."""
+    host_pipeline.make_preview_image = cpu.wrap("host preview", host_pipeline.make_preview_image)
+    simulcast.encode_jpeg = cpu.wrap("host encode (full JPEG)", simulcast.encode_jpeg)
+    host_pipeline.HostEncodePipeline._encode_delta_layer = staticmethod(
+        cpu.wrap("host encode (tile delta)", host_pipeline.HostEncodePipeline._encode_delta_layer))
+    TileCompositor.apply = cpu.wrap("viewer decode + composite", TileCompositor.apply)
+    viewer_pipeline.frame_to_image = cpu.wrap("viewer scale + QImage", viewer_pipeline.frame_to_image)
+
+
+async def _run(args):
+    cpu = StageCpu()
+    _instrument(cpu)
+    services = {}
+
+    def router(name):
+        def on_message(peer_addr, message_dict):
+            if message_dict.get("type") in LIVESTREAM_TYPES and name in services:
+                services[name].handle_incoming_p2p_livestream_message(peer_addr, message_dict)
+        return cpu.wrap("event loop receive", on_message)
+
+    host_p2p = P2PService(PeerManager(lambda: "bench-host"), router("host"))
+    _, host_port = await host_p2p.start_server("127.0.0.1", 0)
+    ladder = [QualityRung(args.quality, 1.0, args.fps)]
+    layers = ((1.0, 0), (0.5, 10), (0.25, 20)) if args.simulcast else ((1.0, 0),)
+    host = LivestreamService(host_p2p, "bench-host", "Bench Host",
+                             bitrate_controller=AdaptiveBitrateController(ladder),
+                             simulcast_layers=layers, delta_mode=args.delta,
+                             relay_mode=args.relay, audio_source="none")
+    services["host"] = host
+    host._on_frame_encoded = cpu.wrap("host send (event loop)", host._on_frame_encoded)
+
+    viewers = []
+    display_latency = collections.defaultdict(list)
+    displayed = collections.Counter()
+    for index in range(args.viewers):
+        name = f"bench-viewer-{index}"
+        p2p = P2PService(PeerManager(lambda name=name: name), router(name))
+        await p2p.start_server("127.0.0.1", 0)
+        await p2p.connect_to_peer("127.0.0.1", host_port)
+        service = LivestreamService(p2p, name, name, audio_source="none")
+        original = service._on_frame_decoded
+
+        def on_decoded(decoded, name=name, original=original):
+            # Frame được gắn lên UI ngay trong callback này: đây là thời điểm "hiển thị"
+            display_latency[name].append(time.time() * 1000 - decoded.timestamp_ms)
+            displayed[name] += 1
+            original(decoded)
+        service._on_frame_decoded = on_decoded
+        service.set_viewer_display_size(args.display_width, args.display_height)
+        services[name] = service
+        viewers.append((name, p2p, service))
+    if args.relay:
+        # Cho các viewer nối với nhau để host có thể giao vai trò relay
+        for index, (_, p2p, _) in enumerate(viewers):
+            for _, other_p2p, _ in viewers[index + 1:]:
+                await p2p.connect_to_peer("127.0.0.1", other_p2p.get_listening_port())
+    await asyncio.sleep(0.3) # Chờ greeting thương lượng xong
+
+    source = SyntheticFrameSource(args.width, args.height)
+    host.start_hosting_livestream(frame_source=source)
+    for name, _, service in viewers:
+        service.start_viewing_livestream("bench-host", "Bench Host")
+
+    await asyncio.sleep(args.warmup)
+    for name in displayed:
+        displayed[name] = 0
+        display_latency[name].clear()
+    process_cpu_start = time.process_time()
+    stage_start = dict(cpu.seconds)
+    bytes_start = sum(stats["sent_bytes"] for stats in host_p2p.get_peer_stats().values())
+    captured_start = source.frame_count
+    started = time.perf_counter()
+    await asyncio.sleep(args.duration)
+    elapsed = time.perf_counter() - started
+    process_cpu = time.process_time() - process_cpu_start
+    peer_stats = host_p2p.get_peer_stats()
+    wire_bytes = sum(stats["sent_bytes"] for stats in peer_stats.values()) - bytes_start
+    captured = source.frame_count - captured_start
+    encode_stats = host._encode_pipeline.get_stats()
+    viewer_stats = {name: service.get_viewer_stats() for name, _, service in viewers}
+
+    host.stop_hosting_livestream()
+    for _, _, service in viewers:
+        service.stop_viewing_livestream()
+    await asyncio.sleep(0.2)
+    for _, p2p, _ in viewers:
+        await p2p.stop_server()
+    await host_p2p.stop_server()
+
+    print(f"Config              : {args.viewers} viewers, {args.width}x{args.height} @ {args.fps} FPS, quality {args.quality}, "
+          f"delta={args.delta}, simulcast={args.simulcast}, relay={args.relay}")
+    print(f"Captured / encoded  : {captured / elapsed:.1f} FPS captured, "
+          f"{encode_stats['skipped_frames']} skipped by busy encoder, encode wall time (EWMA) {encode_stats['encode_ms']} ms")
+    print(f"Bytes on the wire   : {wire_bytes / elapsed / 1024:.1f} KiB/s from host "
+          f"({wire_bytes / max(1, captured) / 1024:.1f} KiB per captured frame, all viewers)")
+    print(f"Process CPU         : {process_cpu / elapsed * 100:.0f}% of one core")
+    for stage in sorted(cpu.seconds):
+        seconds = cpu.seconds[stage] - stage_start.get(stage, 0.0)
+        print(f"  CPU {stage:<26}: {seconds / elapsed * 100:5.1f}% of one core")
+    for name, _, _ in viewers:
+        latencies = display_latency[name]
+        stats = viewer_stats[name]
+        print(f"{name}: {displayed[name] / elapsed:.1f} FPS, capture->display p50={statistics.median(latencies) if latencies else 0:.1f} ms "
+              f"p99={_percentile(latencies, 99):.1f} ms, superseded={stats.get('dropped_superseded')}, "
+              f"late={stats.get('dropped_late')}, discarded deltas={stats.get('discarded_deltas')}")
+    for addr, stats in peer_stats.items():
+        print(f"Host -> {stats.get('peer_user_id') or addr}: sent {stats['sent_bytes'] / 1024:.0f} KiB, "
+              f"dropped {stats['dropped_video_frames']} frames, queue latency {stats['queue_latency_ms']} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--viewers", type=int, default=2, help="Số viewer")
+    parser.add_argument("--width", type=int, default=1280, help="Độ rộng frame giả")
+    parser.add_argument("--height", type=int, default=720, help="Độ cao frame giả")
+    parser.add_argument("--quality", type=int, default=75, help="Chất lượng JPEG cố định (tắt điều chỉnh thích ứng)")
+    parser.add_argument("--fps", type=int, default=24, help="FPS capture")
+    parser.add_argument("--display-width", type=int, default=960, help="Kích thước khung hiển thị của viewer")
+    parser.add_argument("--display-height", type=int, default=540)
+    parser.add_argument("--duration", type=float, default=10.0, help="Thời gian đo (giây)")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Thời gian chạy trước khi đo (giây)")
+    parser.add_argument("--delta", action="store_true", help="Bật chế độ delta theo tile")
+    parser.add_argument("--simulcast", action="store_true", help="Encode 3 lớp simulcast thay vì một lớp")
+    parser.add_argument("--relay", action="store_true", help="Bật cây chuyển tiếp giữa các viewer")
+    args = parser.parse_args()
+
+    app = QGuiApplication.instance() or QGuiApplication(sys.argv)
+    loop = qasync.QEventLoop(app)
+    asyncio.set_event_loop(loop)
+    with loop:
+        loop.run_until_complete(_run(args))
+
+
+if __name__ == "__main__":
+    main()
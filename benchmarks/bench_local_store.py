@@ -0,0 +1,245 @@
+# benchmarks/bench_local_store.py
+"""
+So sánh truy cập SQLite của local_store: cách cũ (mỗi lần gọi mở sqlite3.connect mới, chạy một câu lệnh,
+commit rồi đóng, tuần tự hóa bằng một threading.Lock toàn cục) với trình quản lý kết nối hiện tại
+(một kết nối ghi sống lâu + pool kết nối chỉ đọc, câu lệnh được cache).
+
+Đo trên file DB tạm:
+- số insert/giây (mỗi tin nhắn một transaction, như add_message);
+- độ trễ đọc 100 tin nhắn mới nhất của một kênh (p50/p99), khi chỉ có reader và khi có một thread
+  ghi liên tục song song.
+Phần thứ hai so sánh các cách ghi với từng chế độ PRAGMA synchronous (NORMAL/FULL):
+- add_message: mỗi tin nhắn một commit;
+- add_messages: nhập từng lô --import-batch tin nhắn (như nhập backup từ server), một transaction mỗi lô;
+- group commit: --producers thread cùng submit_message, mỗi thread --rate tin/giây (không chờ từng tin),
+  đo số tin nhắn mỗi commit (số commit/fsync tiết kiệm được) và thời gian từ lúc submit tới lúc commit (p50/p99).
+Trên tmpfs/SSD có cache ghi, fsync rẻ nên FULL và NORMAL gần nhau; trên đĩa thật chênh lệch lớn hơn nhiều.
+Log của local_store bị tắt trong lúc đo để chỉ so phần truy cập DB. Với nhiều thread đọc (--readers),
+p99 của cả hai cách chủ yếu phản ánh việc chờ GIL (khoảng chuyển thread 5 ms) chứ không phải SQLite.
+
+Chạy từ thư mục gốc dự án:
+    python benchmarks/bench_local_store.py --inserts 2000 --reads 2000 --readers 1
+    python benchmarks/bench_local_store.py --import-batch 200 --producers 4 --rate 500
+"""
+import argparse
+import datetime
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.models.message import Message
+from src.storage import local_store
+
+CHANNELS = 20
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _make_message(index: int) -> Message:
+    timestamp = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(milliseconds=index)
+    return Message(channel_id=f"channel-{index % CHANNELS}", user_id=f"user-{index % 50}",
+                   content=f"tin nhắn số {index} " + "x" * (index % 120), timestamp=timestamp,
+                   id=f"{index:012d}", sender_display_name=f"User {index % 50}")
+
+
+class LegacyStore:
+    """Đường truy cập cũ của local_store: kết nối mới cho mỗi lần gọi, một lock toàn cục."""
+
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+
+    def add_message(self, message: Message):
+        params = (message.id, message.channel_id, message.user_id, message.content,
+                  message.timestamp.astimezone(datetime.timezone.utc).isoformat(), message.sender_display_name)
+        with self.lock:
+            conn = sqlite3.connect(self.db_file, timeout=10, check_same_thread=False)
+            try:
+                conn.execute("""
+                    INSERT OR REPLACE INTO messages (id, channel_id, user_id, content, timestamp, sender_display_name)
+                    VALUES (?, ?, ?, ?, ?, ?);
+                """, params)
+                conn.commit()
+            finally:
+                conn.close()
+
+    def get_messages(self, channel_id: str, limit: int = 100):
+        with self.lock:
+            conn = sqlite3.connect(self.db_file, timeout=10, check_same_thread=False)
+            try:
+                rows = conn.execute("""
+                    SELECT id, channel_id, user_id, content, timestamp, sender_display_name
+                    FROM messages
+                    WHERE channel_id = ?
+                    ORDER BY timestamp DESC LIMIT ?;
+                """, (channel_id, limit)).fetchall()
+            finally:
+                conn.close()
+        return [local_store._row_to_message(row) for row in reversed(rows)]
+
+
+class PooledStore:
+    """Các hàm của local_store với trình quản lý kết nối."""
+
+    def __init__(self, db_file: str):
+        local_store.close_storage()
+        local_store.DB_FILE = db_file
+        local_store.init_storage()
+
+    def add_message(self, message: Message):
+        if not local_store.add_message(message):
+            raise RuntimeError("add_message failed")
+
+    def get_messages(self, channel_id: str, limit: int = 100):
+        return local_store.get_messages_for_channel(channel_id, limit)
+
+
+def _measure_reads(store, reads: int, readers: int):
+    """readers thread cùng đọc, tổng cộng `reads` lần; trả về danh sách độ trễ (ms)."""
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(worker_index):
+        local = []
+        for index in range(reads // readers):
+            started = time.perf_counter()
+            store.get_messages(f"channel-{(worker_index + index) % CHANNELS}", 100)
+            local.append((time.perf_counter() - started) * 1000)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def _run(name: str, store, args, first_index: int):
+    started = time.perf_counter()
+    for index in range(first_index, first_index + args.inserts):
+        store.add_message(_make_message(index))
+    insert_rate = args.inserts / (time.perf_counter() - started)
+
+    idle = _measure_reads(store, args.reads, args.readers)
+
+    stop = threading.Event()
+    written = [0]
+
+    def background_writer():
+        index = first_index + args.inserts
+        while not stop.is_set():
+            store.add_message(_make_message(index))
+            index += 1
+            written[0] += 1
+
+    writer = threading.Thread(target=background_writer)
+    writer.start()
+    started = time.perf_counter()
+    busy = _measure_reads(store, args.reads, args.readers)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    writer.join()
+
+    print(f"{name:<8} inserts {insert_rate:8.0f}/s   "
+          f"read p50 {_percentile(idle, 50):6.2f} ms  p99 {_percentile(idle, 99):6.2f} ms   "
+          f"with writer: read p50 {_percentile(busy, 50):6.2f} ms  p99 {_percentile(busy, 99):6.2f} ms  "
+          f"({written[0] / elapsed:6.0f} inserts/s alongside)")
+
+
+def _run_writes(db_file: str, synchronous: str, args, first_index: int):
+    local_store.close_storage()
+    local_store.DB_FILE = db_file
+    local_store.init_storage(synchronous=synchronous)
+    index = first_index
+
+    started = time.perf_counter()
+    for index in range(index, index + args.inserts):
+        local_store.add_message(_make_message(index))
+    single_rate = args.inserts / (time.perf_counter() - started)
+    index += 1
+
+    total = 0
+    started = time.perf_counter()
+    while total < args.inserts * 5:
+        total += local_store.add_messages([_make_message(i) for i in range(index, index + args.import_batch)])
+        index += args.import_batch
+    bulk_rate = total / (time.perf_counter() - started)
+
+    latencies = []
+    lock = threading.Lock()
+    per_producer = max(1, int(args.rate * args.group_seconds))
+
+    def producer(start):
+        local = []
+        next_send = time.perf_counter()
+        for offset in range(per_producer):
+            next_send += 1.0 / args.rate
+            time.sleep(max(0.0, next_send - time.perf_counter()))
+            submitted = time.perf_counter()
+            future = local_store.submit_message(_make_message(start + offset))
+            future.add_done_callback(lambda done, submitted=submitted: local.append((time.perf_counter() - submitted) * 1000))
+        future.result()
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=producer, args=(index + n * per_producer,)) for n in range(args.producers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = local_store.get_group_commit_stats()
+    local_store.close_storage()
+    print(f"synchronous={synchronous:<6} add_message {single_rate:8.0f} msgs/s   "
+          f"add_messages x{args.import_batch} {bulk_rate:8.0f} msgs/s   "
+          f"group commit ({args.producers}x{args.rate:g} msgs/s) "
+          f"{stats['messages_per_commit']} msgs/commit, submit->commit p50 {_percentile(latencies, 50):5.2f} ms "
+          f"p99 {_percentile(latencies, 99):5.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--inserts", type=int, default=2000, help="Số tin nhắn chèn tuần tự")
+    parser.add_argument("--reads", type=int, default=2000, help="Tổng số lần đọc 100 tin nhắn mới nhất")
+    parser.add_argument("--readers", type=int, default=1, help="Số thread đọc song song")
+    parser.add_argument("--import-batch", type=int, default=200, help="Số tin nhắn mỗi lô add_messages")
+    parser.add_argument("--producers", type=int, default=4, help="Số thread cùng submit_message (group commit)")
+    parser.add_argument("--rate", type=float, default=500.0, help="Tin nhắn/giây mỗi thread submit_message")
+    parser.add_argument("--group-seconds", type=float, default=2.0, help="Thời gian đo group commit (giây)")
+    parser.add_argument("--seed-messages", type=int, default=20000, help="Số tin nhắn có sẵn trong DB trước khi đo")
+    args = parser.parse_args()
+    local_store.log_event = lambda *a, **k: None # Không đo chi phí ghi file log
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, factory in (("legacy", LegacyStore), ("pooled", PooledStore)):
+            db_file = os.path.join(tmp, f"{name}.db")
+            # Cùng schema, cùng dữ liệu ban đầu cho cả hai cách
+            local_store.close_storage()
+            local_store.DB_FILE = db_file
+            local_store.init_storage()
+            with local_store._connections.writer() as conn:
+                conn.executemany(local_store._SQL_INSERT_MESSAGE, [
+                    (m.id, m.channel_id, m.user_id, m.content, m.timestamp.isoformat(), m.sender_display_name)
+                    for m in map(_make_message, range(args.seed_messages))])
+                conn.commit()
+            local_store.close_storage()
+            _run(name, factory(db_file), args, args.seed_messages)
+        local_store.close_storage()
+        for synchronous in ("NORMAL", "FULL"):
+            _run_writes(os.path.join(tmp, f"writes-{synchronous}.db"), synchronous, args, 0)
+
+
+if __name__ == "__main__":
+    main()
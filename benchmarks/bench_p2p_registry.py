@@ -0,0 +1,116 @@
+# benchmarks/bench_p2p_registry.py
+"""
+Stress benchmark cho registry kết nối của P2PService:
+host broadcast video 30 FPS trong khi một client liên tục connect/disconnect hàng trăm lần.
+Đo thời gian mỗi lần gọi broadcast (đường đọc không lock) và số frame viewer ổn định nhận được.
+
+Chạy từ thư mục gốc dự án:
+    python benchmarks/bench_p2p_registry.py --cycles 300 --fps 30 --duration 10
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.core.peer_manager import PeerManager
+from src.p2p import protocol as p2p_proto
+from src.p2p.p2p_service import P2PService
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def _run(cycles: int, fps: int, frame_bytes: int, duration: float):
+    received = {"video": 0, "chat": 0}
+
+    def on_viewer_message(peer_addr, message_dict):
+        if message_dict.get("type") == p2p_proto.MSG_TYPE_VIDEO_FRAME:
+            received["video"] += 1
+        elif message_dict.get("type") == p2p_proto.MSG_TYPE_CHAT_MESSAGE:
+            received["chat"] += 1
+
+    host = P2PService(PeerManager(lambda: "bench-host"), lambda addr, msg: None)
+    viewer = P2PService(PeerManager(lambda: "bench-viewer"), on_viewer_message)
+    churner = P2PService(PeerManager(lambda: "bench-churn"), lambda addr, msg: None)
+    _, host_port = await host.start_server("127.0.0.1", 0)
+    await viewer.start_server("127.0.0.1", 0)
+    await viewer.connect_to_peer("127.0.0.1", host_port)
+    await asyncio.sleep(0.2) # Chờ greeting thương lượng xong
+
+    done = asyncio.Event()
+    churn_stats = {"cycles": 0}
+
+    async def churn():
+        pause = duration / cycles if cycles else 0 # Dàn đều các vòng trong suốt thời gian broadcast
+        for _ in range(cycles):
+            if await churner.connect_to_peer("127.0.0.1", host_port):
+                await asyncio.sleep(pause / 2)
+                await churner.disconnect_from_peer("127.0.0.1", host_port)
+                churn_stats["cycles"] += 1
+            await asyncio.sleep(pause / 2)
+        done.set()
+
+    broadcast_us = []
+    sent = {"video": 0, "chat": 0}
+    payload = b"\xff\xd8" + os.urandom(frame_bytes - 2)
+
+    async def broadcaster():
+        interval = 1.0 / fps
+        frame_id = 0
+        next_tick = time.perf_counter()
+        while not done.is_set():
+            frame_id += 1
+            message = p2p_proto.PreEncodedMessage(p2p_proto.create_message(
+                p2p_proto.MSG_TYPE_VIDEO_FRAME,
+                p2p_proto.create_raw_video_frame_payload("bench-host", payload, frame_id, int(time.time() * 1000))))
+            started = time.perf_counter()
+            host.broadcast_nowait(message)
+            broadcast_us.append((time.perf_counter() - started) * 1e6)
+            sent["video"] += 1
+            if frame_id % 10 == 0:
+                await host.broadcast_message(p2p_proto.create_message(
+                    p2p_proto.MSG_TYPE_CHAT_MESSAGE, {"content": f"tick {frame_id}"}))
+                sent["chat"] += 1
+            next_tick += interval
+            await asyncio.sleep(max(0.0, next_tick - time.perf_counter()))
+
+    started = time.perf_counter()
+    await asyncio.gather(churn(), broadcaster())
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(0.3) # Cho hàng đợi gửi xả hết
+
+    stats = host.get_peer_stats()
+    await churner.stop_server()
+    await viewer.stop_server()
+    await host.stop_server()
+
+    print(f"Connect/disconnect cycles : {churn_stats['cycles']} in {elapsed:.2f}s")
+    print(f"Video frames sent/received: {sent['video']} / {received['video']}")
+    print(f"Chat messages sent/recv   : {sent['chat']} / {received['chat']}")
+    print(f"broadcast_nowait (us)     : p50={statistics.median(broadcast_us):.1f} "
+          f"p99={_percentile(broadcast_us, 99):.1f} max={max(broadcast_us):.1f}")
+    for addr, peer_stats in stats.items():
+        print(f"Peer {addr[0]}:{addr[1]} stats: {peer_stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cycles", type=int, default=300, help="Số vòng connect/disconnect")
+    parser.add_argument("--fps", type=int, default=30, help="Tốc độ broadcast video")
+    parser.add_argument("--frame-bytes", type=int, default=40_000, help="Kích thước mỗi frame giả lập")
+    parser.add_argument("--duration", type=float, default=5.0, help="Thời gian (giây) dàn đều các vòng connect/disconnect")
+    args = parser.parse_args()
+    asyncio.run(_run(args.cycles, args.fps, args.frame_bytes, args.duration))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# benchmarks/bench_p2p_transport.py
+"""
+So sánh hai transport của P2PService ("streams": StreamReader + task đọc cho mỗi kết nối,
+"protocol": BufferedProtocol tách frame trong callback) với nhiều peer qua loopback.
+
+Mỗi lượt đo một transport (host và các peer dùng cùng transport), gồm hai pha:
+- fan-in: mọi peer gửi tin chat liên tục cho host;
+- fan-out: host broadcast tin chat liên tục cho mọi peer.
+Mặc định gửi hết tốc độ (đo thông lượng tối đa, CPU bão hòa); với --rate mỗi peer (fan-in) hoặc host
+(fan-out, mỗi lần tới mọi peer) gửi đúng số message/giây đó, để so CPU mỗi kết nối ở cùng một tải.
+Báo cáo số message nhận được mỗi giây và thời gian CPU của tiến trình (cả hai phía, cùng một event loop)
+tính trên mỗi message và trên mỗi kết nối, cùng số lần ghi socket (flush) và số byte/message mỗi lần ghi.
+--batch-bytes 1 tắt việc gom (mỗi message một lần ghi + drain như trước).
+
+Chạy từ thư mục gốc dự án:
+    python benchmarks/bench_p2p_transport.py --peers 100 --duration 5 --transport both
+    python benchmarks/bench_p2p_transport.py --peers 200 --rate 50
+    python benchmarks/bench_p2p_transport.py --transport protocol --batch-bytes 1
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from src.core.peer_manager import PeerManager
+from src.p2p import protocol as p2p_proto
+from src.p2p.buffered_transport import TRANSPORT_PROTOCOL, TRANSPORT_STREAMS
+from src.p2p.p2p_service import P2PService
+
+SEND_BATCH = 32 # Số message mỗi peer đưa vào hàng đợi trước khi nhường event loop (khi gửi hết tốc độ)
+PACING_TICK_S = 0.01
+
+
+def _sender(send_one, rate: float):
+    """Coroutine gửi: hết tốc độ (rate=0) hoặc đúng rate message/giây, dàn theo từng tick 10ms."""
+    async def send(stop):
+        carry = 0.0
+        next_tick = time.perf_counter()
+        while not stop.is_set():
+            if not rate:
+                for _ in range(SEND_BATCH):
+                    await send_one()
+                await asyncio.sleep(0)
+                continue
+            carry += rate * PACING_TICK_S
+            while carry >= 1.0:
+                carry -= 1.0
+                await send_one()
+            next_tick += PACING_TICK_S
+            await asyncio.sleep(max(0.0, next_tick - time.perf_counter()))
+    return send
+
+
+def _write_totals(services):
+    """Tổng (số lần flush, số message, số byte) đã ghi của mọi kết nối."""
+    totals = [0, 0, 0]
+    for service in services:
+        for stats in service.get_peer_stats().values():
+            totals[0] += stats["flushes"]
+            totals[1] += stats["sent_messages"]
+            totals[2] += stats["sent_bytes"]
+    return totals
+
+
+async def _phase(name, senders, received, duration, peers, services):
+    """Chạy các coroutine gửi trong duration giây, đo message nhận được, CPU tiến trình và số lần ghi socket."""
+    stop = asyncio.Event()
+    tasks = [asyncio.create_task(sender(stop)) for sender in senders]
+    await asyncio.sleep(0.5) # Làm nóng: hàng đợi và buffer socket đầy
+    writes_start = _write_totals(services)
+    received_start = received["count"]
+    cpu_start = time.process_time()
+    started = time.perf_counter()
+    await asyncio.sleep(duration)
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_start
+    count = received["count"] - received_start
+    flushes, messages, written = (end - start for end, start in zip(_write_totals(services), writes_start))
+    stop.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await asyncio.sleep(0.3) # Cho hàng đợi xả bớt trước pha kế tiếp
+    print(f"  {name:<8}: {count / elapsed:10.0f} msgs/s   CPU {cpu / max(1, count) * 1e6:6.1f} us/msg   "
+          f"{cpu / elapsed / peers * 1e3:6.2f} ms CPU/s per connection   process CPU {cpu / elapsed * 100:4.0f}%")
+    print(f"            {flushes / elapsed:10.0f} flushes/s  {written / max(1, flushes):8.0f} bytes/flush  "
+          f"{messages / max(1, flushes):6.1f} msgs/flush")
+
+
+async def _run(transport: str, peers: int, duration: float, payload_bytes: int, rate: float,
+               batch_bytes: int, batch_delay_ms: float):
+    received = {"count": 0}
+
+    def on_message(peer_addr, message_dict):
+        if message_dict.get("type") == p2p_proto.MSG_TYPE_CHAT_MESSAGE:
+            received["count"] += 1
+
+    options = dict(transport=transport, write_batch_bytes=batch_bytes, write_batch_delay_ms=batch_delay_ms)
+    host = P2PService(PeerManager(lambda: "bench-host"), on_message, **options)
+    _, host_port = await host.start_server("127.0.0.1", 0)
+    clients = []
+    for index in range(peers):
+        client = P2PService(PeerManager(lambda index=index: f"bench-peer-{index}"), on_message, **options)
+        if not await client.connect_to_peer("127.0.0.1", host_port):
+            raise RuntimeError(f"Peer {index} could not connect")
+        clients.append(client)
+    await asyncio.sleep(0.5) # Chờ greeting thương lượng xong (binary framing)
+
+    message = p2p_proto.PreEncodedMessage(p2p_proto.create_message(
+        p2p_proto.MSG_TYPE_CHAT_MESSAGE,
+        p2p_proto.create_chat_payload("bench", "general", "x" * payload_bytes, "2024-01-01T00:00:00")))
+
+    def client_sender(client):
+        return _sender(lambda: client.send_message("127.0.0.1", host_port, message), rate)
+
+    load = f"{rate:g} msgs/s per sender" if rate else "unpaced"
+    print(f"{transport} transport, {peers} peers, {payload_bytes}-byte chat payload, {load}, "
+          f"write batch {batch_bytes} bytes / {batch_delay_ms:g} ms:")
+    services = [host] + clients
+    await _phase("fan-in", [client_sender(client) for client in clients], received, duration, peers, services)
+    await _phase("fan-out", [_sender(lambda: host.broadcast_message(message), rate)], received, duration, peers, services)
+
+    for client in clients:
+        await client.stop_server()
+    await host.stop_server()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--peers", type=int, default=100, help="Số peer kết nối tới host")
+    parser.add_argument("--duration", type=float, default=5.0, help="Thời gian đo mỗi pha (giây)")
+    parser.add_argument("--payload-bytes", type=int, default=200, help="Độ dài nội dung mỗi tin chat")
+    parser.add_argument("--rate", type=float, default=0.0, help="Message/giây mỗi bên gửi (0 = hết tốc độ)")
+    parser.add_argument("--batch-bytes", type=int, default=config.P2P_WRITE_BATCH_BYTES, help="Ngưỡng gom khi ghi (1 = không gom)")
+    parser.add_argument("--batch-delay-ms", type=float, default=config.P2P_WRITE_BATCH_DELAY_MS, help="Thời gian chờ gom tối đa")
+    parser.add_argument("--transport", choices=(TRANSPORT_STREAMS, TRANSPORT_PROTOCOL, "both"), default="both")
+    args = parser.parse_args()
+    transports = (TRANSPORT_STREAMS, TRANSPORT_PROTOCOL) if args.transport == "both" else (args.transport,)
+    for transport in transports:
+        asyncio.run(_run(transport, args.peers, args.duration, args.payload_bytes, args.rate,
+                         args.batch_bytes, args.batch_delay_ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# benchmarks/bench_receive_path.py
+"""
+So sánh đường nhận message: vòng lặp cũ (`buffer += chunk` rồi `buffer.split(b'\\n', 1)` trên bytes)
+với FrameDecoder (bytearray dùng lại, memoryview), nạp bằng feed() như StreamReader hoặc bằng
+get_buffer()/buffer_updated() kiểu readinto. Luồng dữ liệu trộn chat và frame video như khi xem livestream.
+
+Đo thời gian xử lý mỗi message (lượt chạy không bật tracemalloc), và bằng tracemalloc ở lượt thứ hai:
+bộ nhớ cấp phát tạm thời cao nhất trong mỗi lần đọc socket (peak - current trước lần đọc).
+Chạy từ thư mục gốc dự án:
+    python benchmarks/bench_receive_path.py --frames 300 --frame-bytes 60000 --chat-per-frame 2
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.p2p import protocol as p2p_proto
+
+
+def _build_stream(framing: str, frames: int, frame_bytes: int, chat_per_frame: int) -> bytes:
+    """Luồng byte giống một kết nối thật: mỗi frame video kèm vài tin chat."""
+    jpeg = b"\xff\xd8" + os.urandom(frame_bytes - 2)
+    parts = []
+    for frame_id in range(frames):
+        for index in range(chat_per_frame):
+            parts.append(p2p_proto.encode_message_for(p2p_proto.create_message(
+                p2p_proto.MSG_TYPE_CHAT_MESSAGE,
+                p2p_proto.create_chat_payload("bench", "general", f"tin nhắn {frame_id}/{index}", "2024-01-01T00:00:00")),
+                framing))
+        parts.append(p2p_proto.encode_message_for(p2p_proto.create_message(
+            p2p_proto.MSG_TYPE_VIDEO_FRAME,
+            p2p_proto.create_raw_video_frame_payload("bench", jpeg, frame_id, 0)), framing))
+    return b"".join(parts)
+
+
+def _legacy_reader(stream: io.BytesIO, read_size: int):
+    """Đường nhận cũ: bytes bất biến, mỗi chunk và mỗi dòng đều cấp phát lại toàn bộ phần còn lại."""
+    buffer = b""
+    while True:
+        chunk = stream.read(read_size)
+        if not chunk:
+            return
+        buffer += chunk
+        messages = []
+        while b"\n" in buffer:
+            line, buffer = buffer.split(b"\n", 1)
+            if line.strip():
+                messages.append(json.loads(line.decode("utf-8")))
+        yield messages
+
+
+def _feed_reader(stream: io.BytesIO, read_size: int):
+    """FrameDecoder.feed: chunk bytes (như StreamReader.read) được chép vào buffer dùng lại."""
+    decoder = p2p_proto.FrameDecoder()
+    while True:
+        chunk = stream.read(read_size)
+        if not chunk:
+            return
+        yield decoder.feed(chunk)
+
+
+def _readinto_reader(stream: io.BytesIO, read_size: int):
+    """FrameDecoder.get_buffer/buffer_updated: dữ liệu được đọc thẳng vào buffer của decoder."""
+    decoder = p2p_proto.FrameDecoder()
+    while True:
+        target = decoder.get_buffer(read_size)
+        nbytes = stream.readinto(target[:read_size])
+        target.release()
+        if not nbytes:
+            return
+        yield decoder.buffer_updated(nbytes)
+
+
+def _measure(name: str, reader_factory, data: bytes, read_size: int):
+    started = time.perf_counter()
+    message_count = sum(len(messages) for messages in reader_factory(io.BytesIO(data), read_size))
+    elapsed = time.perf_counter() - started
+
+    transient = []
+    tracemalloc.start()
+    reader = reader_factory(io.BytesIO(data), read_size)
+    while True:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        messages = next(reader, None)
+        if messages is None:
+            break
+        _, peak = tracemalloc.get_traced_memory()
+        transient.append(peak - before)
+        del messages # Ứng dụng xử lý xong message rồi bỏ
+    tracemalloc.stop()
+    reads = max(1, len(transient))
+    print(f"{name:<34} {message_count:>7} msgs  {elapsed / max(1, message_count) * 1e6:8.1f} us/msg  "
+          f"transient/read avg {sum(transient) / reads / 1024:8.1f} KiB  max {max(transient or [0]) / 1024:8.1f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=300, help="Số frame video trong luồng")
+    parser.add_argument("--frame-bytes", type=int, default=60_000, help="Kích thước JPEG mỗi frame")
+    parser.add_argument("--chat-per-frame", type=int, default=2, help="Số tin chat xen giữa hai frame")
+    args = parser.parse_args()
+
+    json_stream = _build_stream(p2p_proto.FRAMING_JSON_LINES, args.frames, args.frame_bytes, args.chat_per_frame)
+    binary_stream = _build_stream(p2p_proto.FRAMING_BINARY, args.frames, args.frame_bytes, args.chat_per_frame)
+    print(f"JSON-lines stream {len(json_stream) / 1e6:.1f} MB, binary stream {len(binary_stream) / 1e6:.1f} MB")
+    _measure("legacy split, JSON-lines, 4 KiB", _legacy_reader, json_stream, 4096)
+    _measure("FrameDecoder.feed, JSON-lines, 4 KiB", _feed_reader, json_stream, 4096)
+    _measure("FrameDecoder.feed, binary, 4 KiB", _feed_reader, binary_stream, 4096)
+    _measure("FrameDecoder.feed, binary, 64 KiB", _feed_reader, binary_stream, p2p_proto.RECV_BUFFER_SIZE)
+    _measure("FrameDecoder readinto, binary, 64 KiB", _readinto_reader, binary_stream, p2p_proto.RECV_BUFFER_SIZE)
+
+
+if __name__ == "__main__":
+    main()
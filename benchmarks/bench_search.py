@@ -0,0 +1,124 @@
+# benchmarks/bench_search.py
+"""
+Đo tìm kiếm toàn văn của local_store (search_messages, FTS5) trên kho tin nhắn sinh ngẫu nhiên.
+
+Kho mặc định 1.000.000 tin nhắn chia đều cho --channels kênh, mỗi tin 3-20 từ lấy theo phân bố Zipf
+(vài chục từ tiếng Việt thông dụng ở đầu, rồi các từ hiếm "từN"): từ phổ biến nhất có trong khoảng 2/3 số
+tin nhắn, từ hiếm chỉ trong vài tin. Tin nhắn được ghi qua câu lệnh INSERT của local_store nên index FTS5
+được trigger cập nhật như khi chạy thật; thời gian nạp và kích thước DB cho biết chi phí ghi của index.
+
+Mỗi truy vấn (trong một kênh) được chạy --repeats lần: độ trễ trang đầu (p50/p99), trang thứ hai (dùng
+cursor) và số kết quả của trang đầu.
+
+Chạy từ thư mục gốc dự án (--db giữ lại kho đã sinh để chạy lại nhanh):
+    python benchmarks/bench_search.py --messages 1000000 --db /tmp/search_corpus.db
+"""
+import argparse
+import datetime
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.storage import local_store
+
+COMMON_WORDS = ("tin nhắn kênh họp dự án báo cáo ngày mai hôm nay lịch sử tải xuống máy chủ livestream video "
+                "âm thanh mạng chậm lỗi sửa xong kiểm tra cập nhật phiên bản mới cũ người dùng đăng nhập mật khẩu "
+                "cảm ơn nhé ok được rồi không có gì đâu chào buổi sáng tối trưa ăn cơm đi về nhà làm việc").split()
+RARE_WORDS = 20000
+INSERT_BATCH = 20000
+
+QUERIES = (
+    ("từ phổ biến nhất", "tin"),
+    ("hai từ phổ biến", "nhắn kênh"),
+    ("không dấu, ba từ", "hop du an"),
+    ("cụm thông dụng", "ngày mai họp"),
+    ("từ ít gặp", "từ5"),
+    ("từ hiếm", "từ19999"),
+    ("không khớp", "khôngtồntại"),
+)
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _channel_id(index: int) -> str:
+    return f"00000000-0000-4000-8000-{index:012d}"
+
+
+def _build_corpus(count: int, channels: int):
+    vocab = COMMON_WORDS + [f"từ{index}" for index in range(RARE_WORDS)]
+    # cum_weights tính một lần (random.choices với weights tính lại tổng tích lũy ở mỗi lần gọi)
+    cum_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(vocab))))
+    rng = random.Random(1)
+    base = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    started = time.perf_counter()
+    for first in range(0, count, INSERT_BATCH):
+        rows = []
+        for index in range(first, min(count, first + INSERT_BATCH)):
+            content = " ".join(rng.choices(vocab, cum_weights=cum_weights, k=rng.randint(3, 20)))
+            timestamp = (base + datetime.timedelta(seconds=index)).isoformat()
+            rows.append((f"{index:012d}", _channel_id(index % channels), f"user-{index % 500}", content,
+                         timestamp, f"User {index % 500}"))
+        with local_store._connections.writer() as conn:
+            conn.executemany(local_store._SQL_INSERT_MESSAGE, rows)
+            conn.commit()
+    with local_store._connections.writer() as conn:
+        conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('optimize');") # Gộp các segment của index
+        conn.commit()
+    elapsed = time.perf_counter() - started
+    print(f"Built {count} messages in {elapsed:.0f} s ({count / elapsed:.0f} msgs/s with search index), "
+          f"DB {os.path.getsize(local_store.DB_FILE) / 1e6:.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1000000, help="Số tin nhắn của kho")
+    parser.add_argument("--channels", type=int, default=20, help="Số kênh")
+    parser.add_argument("--limit", type=int, default=20, help="Số kết quả mỗi trang")
+    parser.add_argument("--repeats", type=int, default=20, help="Số lần chạy mỗi truy vấn")
+    parser.add_argument("--db", help="File DB của kho (giữ lại giữa các lần chạy; mặc định: file tạm)")
+    args = parser.parse_args()
+    local_store.log_event = lambda *a, **k: None # Không đo chi phí ghi file log
+
+    with tempfile.TemporaryDirectory() as tmp:
+        local_store.DB_FILE = args.db or os.path.join(tmp, "search.db")
+        local_store.init_storage()
+        with local_store._connections.reader() as conn:
+            existing = conn.execute("SELECT count(*) FROM messages;").fetchone()[0]
+        if existing != args.messages:
+            if existing:
+                raise SystemExit(f"{local_store.DB_FILE} has {existing} messages, expected {args.messages}")
+            _build_corpus(args.messages, args.channels)
+        channel_id = _channel_id(0)
+        print(f"{args.messages} messages in {args.channels} channels, searching channel {channel_id}, "
+              f"{args.limit} results per page, rank window {local_store.SEARCH_RANK_WINDOW}:")
+        for name, query in QUERIES:
+            first_page, second_page = [], []
+            for _ in range(args.repeats):
+                started = time.perf_counter()
+                hits, cursor = local_store.search_messages(channel_id, query, None, args.limit)
+                first_page.append((time.perf_counter() - started) * 1000)
+                if cursor:
+                    started = time.perf_counter()
+                    local_store.search_messages(channel_id, query, cursor, args.limit)
+                    second_page.append((time.perf_counter() - started) * 1000)
+            second = f"p50 {_percentile(second_page, 50):6.2f} ms" if second_page else "   (one page)"
+            print(f"  {name:<18} {query!r:<16} page 1 p50 {_percentile(first_page, 50):6.2f} ms  "
+                  f"p99 {_percentile(first_page, 99):6.2f} ms   page 2 {second}   {len(hits):3d} hits")
+            if hits:
+                print(f"      top: {hits[0].snippet}")
+        local_store.close_storage()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# benchmarks/bench_storage_event_loop.py
+"""
+Đo mức event loop bị chặn bởi truy cập SQLite: gọi LocalStorageService (đồng bộ, ngay trên event loop)
+so với AsyncLocalStorageService (thread DB riêng + group commit, coroutine chỉ await).
+
+Tải giống ứng dụng chat: một coroutine gửi tin nhắn liên tục (--rate tin/giây, mỗi tin một add_message,
+bản async không chờ commit như send_chat_message) và một coroutine mở lịch sử kênh (đọc --page tin nhắn
+mới nhất) mỗi --read-interval-ms; một thread khác nhập backup liên tục theo lô --import-batch tin nhắn
+(như perform_initial_sync), giữ khóa ghi trong lúc nhập. Song song đó một "nhịp tim" ngủ 1 ms và ghi lại
+độ trễ so với lịch hẹn: đây là thời gian UI (qasync) không xử lý được sự kiện.
+Với bản async, in thêm histogram thời gian người gọi phải chờ của từng thao tác (get_wait_stats()).
+
+Chạy từ thư mục gốc dự án:
+    python benchmarks/bench_storage_event_loop.py --duration 5 --rate 200 --synchronous FULL
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from src.models.message import Message
+from src.storage import local_store
+from src.storage.local_storage_service import AsyncLocalStorageService, LocalStorageService
+
+CHANNELS = 10
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _make_message(index: int) -> Message:
+    timestamp = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(milliseconds=index)
+    return Message(channel_id=f"channel-{index % CHANNELS}", user_id=f"user-{index % 50}",
+                   content=f"tin nhắn số {index} " + "x" * (index % 200), timestamp=timestamp, id=f"{index:012d}")
+
+
+async def _heartbeat(stop: asyncio.Event, lags: list):
+    while not stop.is_set():
+        expected = time.perf_counter() + 0.001
+        await asyncio.sleep(0.001)
+        lags.append(max(0.0, (time.perf_counter() - expected) * 1000))
+
+
+async def _workload(mode: str, storage, sync_storage: LocalStorageService, args, first_index: int):
+    stop = asyncio.Event()
+    lags = []
+    counters = {"writes": 0, "reads": 0}
+    pending = set()
+
+    async def writer():
+        index = first_index
+        next_send = time.perf_counter()
+        while not stop.is_set():
+            message = _make_message(index)
+            if mode == "sync":
+                storage.add_message(message)
+            else:
+                pending.add(asyncio.ensure_future(storage.add_message(message)))
+                pending.difference_update([future for future in pending if future.done()])
+            index += 1
+            counters["writes"] += 1
+            next_send += 1.0 / args.rate
+            await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+
+    async def reader():
+        index = 0
+        while not stop.is_set():
+            channel_id = f"channel-{index % CHANNELS}"
+            if mode == "sync":
+                storage.get_messages(channel_id, limit=args.page)
+            else:
+                await storage.get_messages(channel_id, limit=args.page)
+            index += 1
+            counters["reads"] += 1
+            await asyncio.sleep(args.read_interval_ms / 1000.0)
+
+    import_stop = threading.Event()
+
+    def importer():
+        index = first_index + 10_000_000
+        while not import_stop.is_set():
+            sync_storage.add_messages([_make_message(i) for i in range(index, index + args.import_batch)])
+            index += args.import_batch
+
+    import_thread = threading.Thread(target=importer) if args.import_batch else None
+    if import_thread:
+        import_thread.start()
+    tasks = [asyncio.create_task(_heartbeat(stop, lags)), asyncio.create_task(writer()), asyncio.create_task(reader())]
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await asyncio.gather(*tasks)
+    await asyncio.gather(*pending)
+    if import_thread:
+        import_stop.set()
+        import_thread.join()
+    print(f"{mode:<5}: event loop lag p50 {_percentile(lags, 50):6.2f} ms  p99 {_percentile(lags, 99):6.2f} ms  "
+          f"max {max(lags or [0]):7.2f} ms   {counters['writes'] / args.duration:6.0f} writes/s  "
+          f"{counters['reads'] / args.duration:5.0f} reads/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=5.0, help="Thời gian đo mỗi chế độ (giây)")
+    parser.add_argument("--rate", type=float, default=200.0, help="Số tin nhắn ghi mỗi giây")
+    parser.add_argument("--page", type=int, default=100, help="Số tin nhắn mỗi lần đọc lịch sử")
+    parser.add_argument("--read-interval-ms", type=float, default=20.0, help="Khoảng cách giữa hai lần đọc")
+    parser.add_argument("--import-batch", type=int, default=5000, help="Số tin nhắn mỗi lô nhập nền (0 = không nhập)")
+    parser.add_argument("--seed-messages", type=int, default=50000, help="Số tin nhắn có sẵn trong DB")
+    parser.add_argument("--synchronous", default=config.LOCAL_STORE_SYNCHRONOUS, choices=local_store.SYNCHRONOUS_MODES)
+    args = parser.parse_args()
+    config.LOCAL_STORE_SYNCHRONOUS = args.synchronous
+    local_store.log_event = lambda *a, **k: None # Không đo chi phí ghi file log
+
+    with tempfile.TemporaryDirectory() as tmp:
+        local_store.DB_FILE = os.path.join(tmp, "bench.db")
+        sync_storage = LocalStorageService()
+        sync_storage.add_messages([_make_message(index) for index in range(args.seed_messages)])
+        print(f"{args.seed_messages} messages seeded, synchronous={args.synchronous}, "
+              f"{args.rate:g} writes/s + one {args.page}-message read every {args.read_interval_ms:g} ms, "
+              f"background import batches of {args.import_batch}")
+        asyncio.run(_workload("sync", sync_storage, sync_storage, args, args.seed_messages))
+        async_storage = AsyncLocalStorageService(sync_storage)
+        asyncio.run(_workload("async", async_storage, sync_storage, args, args.seed_messages * 2))
+        for operation, stats in async_storage.get_wait_stats().items():
+            print(f"  wait {operation:<13} count {stats['count']:6d}  avg {stats['avg_ms']:6.2f} ms  "
+                  f"p50 <= {stats['p50_ms']:g} ms  p99 <= {stats['p99_ms']:g} ms  buckets {stats['buckets']}")
+        async_storage.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,73 @@ SUPABASE_KEY = "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.eyJpc3MiOiJzdXBhYmFzZSIsInJ
 LOG_FILE = "client_log.txt"
 LOG_MAX_RECORDS = 10000
 
+# --- P2P ---
+# Transport cho kết nối P2P: "streams" (StreamReader/StreamWriter) hoặc "protocol"
+# (asyncio BufferedProtocol, tách frame ngay trong callback nhận, ít task hơn khi có nhiều peer)
+P2P_TRANSPORT = "streams"
+# Gom message thành lô trước khi ghi socket: ghi khi đủ số byte, control/chat/audio ghi ngay,
+# lô chỉ có bulk/video chờ thêm tối đa P2P_WRITE_BATCH_DELAY_MS (0 = không chờ)
+P2P_WRITE_BATCH_BYTES = 64 * 1024
+P2P_WRITE_BATCH_DELAY_MS = 2.0
+# Buffer gửi/nhận của socket (byte, None = mặc định của hệ điều hành), đủ cho vài frame video đang bay
+P2P_SOCKET_SNDBUF = 1024 * 1024
+P2P_SOCKET_RCVBUF = 1024 * 1024
+# Nén payload JSON lớn (lịch sử chat, danh sách peer...) khi cả hai peer hỗ trợ: zstd nếu có gói zstandard, không thì zlib
+P2P_COMPRESSION = True
+P2P_COMPRESSION_MIN_BYTES = 256
+# Host gửi lịch sử kênh qua P2P (req_history/res_history) theo từng phần nhỏ, lớp ưu tiên bulk:
+# mỗi lần chỉ một phần chờ trong hàng đợi của kết nối, nên chat trực tiếp không phải chờ cả đợt tải lịch sử
+P2P_HISTORY_CHUNK_MESSAGES = 100
+P2P_HISTORY_CHUNK_MAX_BYTES = 32 * 1024 # Ước lượng theo nội dung tin nhắn, trước khi nén
+P2P_HISTORY_CHUNK_INTERVAL_MS = 5.0 # Nghỉ giữa hai phần
+P2P_HISTORY_INITIAL_LIMIT = 100 # Số tin nhắn mới nhất gửi khi peer vào kênh (chưa có mốc để tải tiếp)
+P2P_HISTORY_REQUEST_TIMEOUT_S = 5.0 # Không nhận được phần đầu tiên từ host thì tải từ server backup
+
+# --- Lưu trữ cục bộ (SQLite) ---
+# PRAGMA synchronous của kết nối ghi: "NORMAL" (với WAL: không fsync mỗi commit, mất điện có thể mất vài
+# tin nhắn cuối nhưng DB không hỏng) hoặc "FULL" (fsync mỗi commit, bền nhất, chậm hơn nhiều trên đĩa thật)
+LOCAL_STORE_SYNCHRONOUS = "NORMAL"
+# Tin nhắn trực tiếp được gom tối đa chừng này ms (hoặc chừng này tin) rồi commit chung một transaction
+LOCAL_STORE_GROUP_COMMIT_MS = 5.0
+LOCAL_STORE_GROUP_COMMIT_MAX = 256
+# Số tin nhắn mỗi trang lịch sử: trang mới nhất khi mở kênh, thêm một trang cũ hơn mỗi lần cuộn lên đầu
+CHAT_HISTORY_PAGE_SIZE = 100
+
+# --- Livestream: giới hạn cho bộ điều chỉnh chất lượng thích ứng (min, max) ---
+LIVESTREAM_JPEG_QUALITY_RANGE = (35, 85)
+LIVESTREAM_SCALE_RANGE = (0.25, 1.0) # Tỉ lệ so với độ phân giải gốc của camera
+LIVESTREAM_FPS_RANGE = (5, 24)
+LIVESTREAM_ABR_INTERVAL_MS = 1000 # Chu kỳ đánh giá metrics của viewer
+# Ngưỡng nghẽn/khỏe theo metrics gửi của từng viewer, dùng chung cho điều chỉnh chất lượng và chọn lớp simulcast
+LIVESTREAM_CONGESTION_THRESHOLDS = {
+    "congested_latency_ms": 150.0, "congested_drain_ms": 60.0, # Từ mức này là nghẽn: hạ bậc ngay
+    "healthy_latency_ms": 40.0, "healthy_drain_ms": 15.0,       # Dưới mức này là khỏe
+    "intervals_before_step_up": 3, "hold_after_step_down": 4,   # Số chu kỳ khỏe trước khi nâng / giữ sau khi hạ
+}
+# Nguồn frame khi host: None = camera mặc định; hoặc "camera:1", "file:<video>", "images:<thư mục>",
+# "synthetic:1280x720" (frame giả, chạy được trên máy không có camera)
+LIVESTREAM_FRAME_SOURCE = None
+# Các lớp simulcast: (tỉ lệ độ phân giải, số điểm chất lượng JPEG giảm) so với bậc hiện tại; lớp 0 là lớp cao nhất
+LIVESTREAM_SIMULCAST_LAYERS = ((1.0, 0), (0.5, 10), (0.25, 20))
+LIVESTREAM_PREVIEW_MAX_WIDTH = 640 # Ảnh preview của host được thu nhỏ trong worker trước khi về thread GUI
+# Chế độ delta theo tile: chỉ gửi các tile thay đổi, keyframe đầy đủ định kỳ (hợp với cảnh ít chuyển động)
+LIVESTREAM_DELTA_MODE = False
+LIVESTREAM_DELTA_TILE_SIZE = 64 # pixel
+LIVESTREAM_KEYFRAME_INTERVAL = 30 # Số frame giữa hai keyframe định kỳ
+# Cây chuyển tiếp: host chỉ gửi trực tiếp cho vài viewer, các viewer này chuyển tiếp frame cho viewer khác
+LIVESTREAM_RELAY_MODE = False
+LIVESTREAM_RELAY_DIRECT_FANOUT = 4 # Số viewer host gửi trực tiếp khi bật cây chuyển tiếp
+LIVESTREAM_RELAY_FANOUT = 3 # Số con tối đa của mỗi relay
+LIVESTREAM_RELAY_REPORT_MS = 2000 # Chu kỳ viewer gửi relay_report cho host
+LIVESTREAM_RELAY_STALL_MS = 3000 # Không nhận frame lâu hơn mức này thì báo relay hỏng
+# Âm thanh livestream: "auto" (micro nếu có sounddevice), "device", "synthetic" (sóng sin để thử) hoặc "none"
+LIVESTREAM_AUDIO_SOURCE = "auto"
+LIVESTREAM_AUDIO_SAMPLE_RATE = 16000
+LIVESTREAM_AUDIO_CHANNELS = 1
+LIVESTREAM_AUDIO_FRAME_MS = 20 # Gói nhỏ để độ trễ thấp
+LIVESTREAM_AUDIO_PLAYOUT_TARGET_MS = 60 # Độ trễ jitter buffer phía viewer khi không có video để đồng bộ
+LIVESTREAM_AUDIO_PLAYOUT_MAX_MS = 300
+
 # --- Kiểm tra xem đã cấu hình chưa ---
 if SUPABASE_URL == "YOUR_SUPABASE_URL_DEFAULT" or SUPABASE_KEY == "YOUR_SUPABASE_ANON_KEY_DEFAULT":
     print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
@@ -189,20 +189,32 @@ async def add_message_backup(channel_id: str, user_id: str, content: str) -> boo
         return False
 
 
-async def get_message_backups(channel_id: str, limit: int = 50) -> List[Message]:
-    """Lấy các tin nhắn backup từ server cho một kênh (async), trả về list Message model."""
+async def get_message_backups(channel_id: str, limit: int = 50, before_timestamp_iso: Optional[str] = None,
+                              before_id: Optional[str] = None) -> List[Message]:
+    """
+    Lấy các tin nhắn backup từ server cho một kênh (async), trả về list Message model (cũ trước, mới sau).
+    Phân trang keyset: before_timestamp_iso/before_id là mốc (created_at, id) của tin nhắn cũ nhất đã có,
+    chỉ lấy các tin nhắn đứng trước mốc đó.
+    """
     supabase = get_supabase_client()
     if not supabase: return []
 
     messages_list: List[Message] = []
     try:
-        log_event(f"[API_DB] Fetching message backups for channel {channel_id}, limit {limit}")
-        result = await supabase.table(MESSAGES_TABLE)\
-                          .select("*, profiles(id, display_name)")\
-                          .eq("channel_id", channel_id)\
-                          .order("created_at", desc=True)\
-                          .limit(limit)\
-                          .execute()
+        log_event(f"[API_DB] Fetching message backups for channel {channel_id}, limit {limit}, before {before_timestamp_iso}")
+        query = supabase.table(MESSAGES_TABLE)\
+                        .select("*, profiles(id, display_name)")\
+                        .eq("channel_id", channel_id)
+        if before_timestamp_iso and before_id:
+            # (created_at, id) < (mốc): id phân định các tin nhắn trùng created_at
+            query = query.or_(f'created_at.lt."{before_timestamp_iso}",'
+                              f'and(created_at.eq."{before_timestamp_iso}",id.lt."{before_id}")')
+        elif before_timestamp_iso:
+            query = query.lt("created_at", before_timestamp_iso)
+        result = await query.order("created_at", desc=True)\
+                            .order("id", desc=True)\
+                            .limit(limit)\
+                            .execute()
 
         log_event(f"[API_DB][GET_MSG_BKUPS] Kết quả thô từ Supabase (result.data): {result.data}")
         log_event(f"[API_DB] Fetched {len(result.data)} message backups for channel {channel_id}")
@@ -0,0 +1,172 @@
+# src/core/adaptive_bitrate.py
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from src.utils.logger import log_event
+
+
+@dataclass(frozen=True)
+class QualityRung:
+    """Một bậc chất lượng của livestream: chất lượng JPEG, tỉ lệ độ phân giải và FPS."""
+    jpeg_quality: int
+    scale: float # Tỉ lệ so với độ phân giải gốc của camera
+    fps: int
+
+    def label(self) -> str:
+        return f"{int(round(self.scale * 100))}% · JPEG {self.jpeg_quality} · {self.fps} FPS"
+
+
+# Thang chất lượng mặc định, từ thấp đến cao
+DEFAULT_LADDER: List[QualityRung] = [
+    QualityRung(jpeg_quality=35, scale=0.25, fps=5),
+    QualityRung(jpeg_quality=45, scale=0.5, fps=8),
+    QualityRung(jpeg_quality=55, scale=0.5, fps=12),
+    QualityRung(jpeg_quality=65, scale=0.75, fps=15),
+    QualityRung(jpeg_quality=75, scale=1.0, fps=15),
+    QualityRung(jpeg_quality=80, scale=1.0, fps=20),
+    QualityRung(jpeg_quality=85, scale=1.0, fps=24),
+]
+
+
+def build_ladder(quality_range: Tuple[int, int], scale_range: Tuple[float, float],
+                 fps_range: Tuple[int, int], base: Sequence[QualityRung] = DEFAULT_LADDER) -> List[QualityRung]:
+    """
+    Kẹp thang chất lượng vào các giới hạn cấu hình, bỏ các bậc trùng nhau sau khi kẹp.
+    """
+    ladder: List[QualityRung] = []
+    for rung in base:
+        clamped = QualityRung(
+            jpeg_quality=min(max(rung.jpeg_quality, quality_range[0]), quality_range[1]),
+            scale=min(max(rung.scale, scale_range[0]), scale_range[1]),
+            fps=min(max(rung.fps, fps_range[0]), fps_range[1]),
+        )
+        if not ladder or ladder[-1] != clamped:
+            ladder.append(clamped)
+    return ladder
+
+
+@dataclass(frozen=True)
+class CongestionThresholds:
+    """
+    Ngưỡng đánh giá metrics gửi của một viewer, dùng chung cho AdaptiveBitrateController và
+    SimulcastLayerSelector (config.LIVESTREAM_CONGESTION_THRESHOLDS).
+    """
+    congested_latency_ms: float = 150.0 # Độ trễ hàng đợi gửi từ mức này là nghẽn
+    congested_drain_ms: float = 60.0
+    healthy_latency_ms: float = 40.0    # Khỏe khi cả độ trễ hàng đợi và thời gian drain dưới các mức này
+    healthy_drain_ms: float = 15.0
+    intervals_before_step_up: int = 3   # Số chu kỳ khỏe liên tiếp trước khi nâng một bậc
+    hold_after_step_down: int = 4       # Số chu kỳ không nâng bậc sau khi vừa hạ
+
+
+class CongestionTracker:
+    """
+    Trạng thái nghẽn/khỏe của một nguồn metrics qua các chu kỳ: hạ bậc ngay khi nghẽn, chỉ cho nâng bậc
+    sau intervals_before_step_up chu kỳ khỏe liên tiếp và không trong thời gian giữ sau lần hạ gần nhất.
+    Người gọi quyết định có thực sự đổi bậc không và báo lại bằng stepped_down()/stepped_up().
+    """
+    CONGESTED = "congested"
+    STEADY = "steady"
+    STEP_UP = "step_up"
+
+    __slots__ = ("thresholds", "healthy_streak", "hold")
+
+    def __init__(self, thresholds: CongestionThresholds):
+        self.thresholds = thresholds
+        self.healthy_streak = 0
+        self.hold = 0
+
+    def reset(self):
+        self.healthy_streak = 0
+        self.hold = 0
+
+    def evaluate(self, latency_ms: float, drain_ms: float, new_drops: int) -> str:
+        """Đánh giá một chu kỳ; trả về CONGESTED, STEP_UP (được phép nâng một bậc) hoặc STEADY."""
+        t = self.thresholds
+        if self.hold > 0:
+            self.hold -= 1
+        if new_drops > 0 or latency_ms >= t.congested_latency_ms or drain_ms >= t.congested_drain_ms:
+            self.healthy_streak = 0
+            return self.CONGESTED
+        healthy = latency_ms <= t.healthy_latency_ms and drain_ms <= t.healthy_drain_ms
+        self.healthy_streak = self.healthy_streak + 1 if healthy else 0
+        if self.healthy_streak >= t.intervals_before_step_up and self.hold == 0:
+            return self.STEP_UP
+        return self.STEADY
+
+    def stepped_down(self):
+        self.hold = self.thresholds.hold_after_step_down
+
+    def stepped_up(self):
+        self.healthy_streak = 0
+
+
+DEFAULT_CONGESTION_THRESHOLDS = CongestionThresholds()
+
+
+class AdaptiveBitrateController:
+    """
+    Chọn bậc chất lượng dựa trên metrics gửi của từng viewer (P2PService.get_peer_stats()).
+    Viewer tệ nhất quyết định: hạ ngay một bậc khi có dấu hiệu nghẽn (độ trễ hàng đợi, thời gian drain
+    cao hoặc có frame bị bỏ), chỉ nâng một bậc sau vài chu kỳ khỏe liên tiếp để tránh dao động.
+    """
+
+    def __init__(self, ladder: Optional[Sequence[QualityRung]] = None, start_index: Optional[int] = None,
+                 thresholds: CongestionThresholds = DEFAULT_CONGESTION_THRESHOLDS):
+        self.ladder: List[QualityRung] = list(ladder or DEFAULT_LADDER)
+        if not self.ladder:
+            raise ValueError("Quality ladder must not be empty")
+        if start_index is None:
+            start_index = len(self.ladder) // 2
+        self.index = min(max(start_index, 0), len(self.ladder) - 1)
+        self._congestion = CongestionTracker(thresholds)
+        self._last_drops: Dict[Any, int] = {}
+
+    @property
+    def current(self) -> QualityRung:
+        return self.ladder[self.index]
+
+    def reset(self, start_index: Optional[int] = None):
+        """Đặt lại trạng thái khi bắt đầu một phiên stream mới."""
+        if start_index is not None:
+            self.index = min(max(start_index, 0), len(self.ladder) - 1)
+        self._congestion.reset()
+        self._last_drops.clear()
+
+    def update(self, peer_stats: Dict[Any, Dict[str, Any]]) -> Optional[QualityRung]:
+        """
+        Đánh giá một chu kỳ. Trả về bậc mới nếu bậc chất lượng thay đổi, ngược lại None.
+        """
+        if not peer_stats:
+            self._congestion.healthy_streak = 0
+            return None
+
+        worst_latency = 0.0
+        worst_drain = 0.0
+        new_drops = 0
+        for peer_key, stats in peer_stats.items():
+            worst_latency = max(worst_latency, stats.get("queue_latency_ms", 0.0))
+            worst_drain = max(worst_drain, stats.get("drain_ms", 0.0))
+            dropped = stats.get("dropped_video_frames", 0)
+            new_drops += max(0, dropped - self._last_drops.get(peer_key, dropped))
+            self._last_drops[peer_key] = dropped
+        # Quên các peer đã ngắt kết nối
+        for peer_key in list(self._last_drops):
+            if peer_key not in peer_stats:
+                del self._last_drops[peer_key]
+
+        verdict = self._congestion.evaluate(worst_latency, worst_drain, new_drops)
+        if verdict == CongestionTracker.CONGESTED:
+            if self.index > 0:
+                self.index -= 1
+                self._congestion.stepped_down()
+                log_event(f"[ABR] Congestion (latency={worst_latency:.1f}ms, drain={worst_drain:.1f}ms, drops={new_drops}). Stepping down to {self.current.label()}")
+                return self.current
+            return None
+
+        if verdict == CongestionTracker.STEP_UP and self.index < len(self.ladder) - 1:
+            self.index += 1
+            self._congestion.stepped_up()
+            log_event(f"[ABR] Viewers healthy (latency={worst_latency:.1f}ms, drain={worst_drain:.1f}ms). Stepping up to {self.current.label()}")
+            return self.current
+        return None
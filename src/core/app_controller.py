@@ -18,11 +18,12 @@ if TYPE_CHECKING:
     from src.ui.chat_page import ChatPage
 
 # Import các thành phần cần thiết
+import config
 from src.api import auth as api_auth
 from src.api import database as api_db # Đảm bảo đã import
 from src.p2p.p2p_service import P2PService
 from src.p2p import protocol as p2p_proto
-from src.storage.local_storage_service import LocalStorageService
+from src.storage.local_storage_service import AsyncLocalStorageService
 from .peer_manager import PeerManager
 from .sync_service import SyncService
 # Đảm bảo import đủ các models
@@ -69,6 +70,7 @@ class AppController(QObject):
     channel_error = Signal(str)
     new_message_signal = Signal(Message)
     current_channel_history_cleared = Signal()
+    older_messages_loaded = Signal(list, bool) # Trang tin nhắn cũ hơn (cũ trước), còn trang cũ hơn nữa hay không
     messageSent = Signal(Message)
     messageError = Signal(str)
     requestPageChange = Signal(str)
@@ -85,9 +87,14 @@ class AppController(QObject):
         self.livestream_service: Optional[LivestreamService] = None
         self.livestream_host_window: Optional[LivestreamHostWindow] = None
         self.livestream_viewer_window: Optional[LivestreamViewerWindow] = None
+        # Mốc keyset (timestamp ISO UTC, id) của tin nhắn cũ nhất đang hiển thị ở kênh hiện tại
+        self._history_cursor: Optional[Tuple[str, str]] = None
+        self._older_page_task: Optional[asyncio.Task] = None
+        self.new_message_signal.connect(self._track_history_cursor)
+        self.current_channel_history_cleared.connect(self._reset_history_paging)
 
         log_event("[CTRL] Initializing core components...")
-        self.local_storage = LocalStorageService()
+        self.local_storage = AsyncLocalStorageService() # Truy cập SQLite trên thread DB riêng, không chặn event loop
         self.peer_manager = PeerManager(
             get_current_user_id_func=lambda: self.current_user.id if self.current_user else None
         )
@@ -155,6 +162,8 @@ class AppController(QObject):
                 self.peer_list_updated.connect(chat_page.update_member_list_ui)
                 self.new_message_signal.connect(chat_page.display_message_object)
                 self.current_channel_history_cleared.connect(chat_page.clear_message_display)
+                chat_page.older_messages_requested.connect(self.load_older_messages)
+                self.older_messages_loaded.connect(chat_page.prepend_messages)
 
                 if hasattr(chat_page, 'status_changed') and hasattr(self, 'handle_status_change_request'):
                     chat_page.status_changed.connect(self.handle_status_change_request)
@@ -589,10 +598,13 @@ class AppController(QObject):
          try:
              log_event(f"[CTRL][FETCH_CHAN_DATA] Đang tải lịch sử tin nhắn cho kênh {channel_id}...")
              if is_host:
-                 messages = self.local_storage.get_messages(channel_id, limit=100)
+                 messages = await self.local_storage.get_messages(channel_id, limit=config.CHAT_HISTORY_PAGE_SIZE)
                  log_event(f"[CTRL][FETCH_CHAN_DATA] Đã tải {len(messages)} tin nhắn từ local store (host).")
+             elif await self.sync_service.request_history_from_host(channel_id, self.current_channel.owner_id):
+                 # Host gửi lịch sử qua P2P theo từng phần, SyncService hiển thị khi từng phần tới
+                 log_event(f"[CTRL][FETCH_CHAN_DATA] Đang nhận lịch sử kênh {channel_id} từ host qua P2P.")
              else:
-                 messages = await api_db.get_message_backups(channel_id, limit=100)
+                 messages = await api_db.get_message_backups(channel_id, limit=config.CHAT_HISTORY_PAGE_SIZE)
                  log_event(f"[CTRL][FETCH_CHAN_DATA] Đã tải {len(messages)} tin nhắn từ server backup.")
              for msg_obj in messages:
                  self.new_message_signal.emit(msg_obj)
@@ -643,6 +655,62 @@ class AppController(QObject):
               self.status_update_signal.emit(f"Lỗi tải dữ liệu kênh {channel_name}.")
               self.peer_list_updated.emit([])
 
+    @staticmethod
+    def _history_key(message: Message) -> Tuple[str, str]:
+        """Khóa sắp xếp (timestamp ISO UTC, id) giống thứ tự của local store."""
+        return message.timestamp.astimezone(datetime.timezone.utc).isoformat(), message.id
+
+    @Slot(Message)
+    def _track_history_cursor(self, message: Message):
+        """Ghi lại tin nhắn cũ nhất đã hiển thị (từ local store, host P2P hay server) làm mốc tải trang cũ hơn."""
+        if not self.current_channel or message.channel_id != self.current_channel.id or not message.id:
+            return
+        key = self._history_key(message)
+        if self._history_cursor is None or key < self._history_cursor:
+            self._history_cursor = key
+
+    @Slot()
+    def _reset_history_paging(self):
+        self._history_cursor = None
+        if self._older_page_task and not self._older_page_task.done():
+            self._older_page_task.cancel()
+        self._older_page_task = None
+
+    @Slot()
+    def load_older_messages(self):
+        """ChatPage cuộn gần tới đầu: tải trang tin nhắn ngay trước tin nhắn cũ nhất đang hiển thị."""
+        if self._older_page_task and not self._older_page_task.done():
+            return # Trang trước đó vẫn đang tải, kết quả sẽ được gửi tới ChatPage
+        if not self.current_channel or not self.current_user or self._history_cursor is None:
+            self.older_messages_loaded.emit([], False) # Kênh trống: không có gì cũ hơn
+            return
+        channel = self.current_channel
+        self._older_page_task = asyncio.create_task(self._fetch_older_messages(channel, self._history_cursor),
+                                                    name=f"FetchOlderHistory_{channel.id}")
+
+    async def _fetch_older_messages(self, channel: Channel, cursor: Tuple[str, str]):
+        before_ts_iso, before_id = cursor
+        page_size = config.CHAT_HISTORY_PAGE_SIZE
+        messages: Optional[List[Message]] = None
+        try:
+            if self.current_user and channel.owner_id == self.current_user.id:
+                messages = await self.local_storage.get_messages_before(
+                    channel.id, datetime.datetime.fromisoformat(before_ts_iso), before_id, page_size)
+            else:
+                # Host chỉ stream lịch sử về phía mới hơn; trang cũ hơn của thành viên lấy từ server backup
+                messages = await api_db.get_message_backups(channel.id, page_size, before_ts_iso, before_id)
+        except Exception as e:
+            log_event(f"[ERROR][CTRL] Failed to load messages older than {before_ts_iso} for channel {channel.id}: {e}", exc_info=True)
+        if not self.current_channel or self.current_channel.id != channel.id:
+            return # Đã chuyển kênh trong lúc tải
+        if messages is None:
+            self.older_messages_loaded.emit([], True) # Lỗi tạm thời: cho phép cuộn lên để thử lại
+            return
+        if messages:
+            self._history_cursor = self._history_key(messages[0])
+        log_event(f"[CTRL] Loaded {len(messages)} messages older than {before_ts_iso} for channel {channel.id}.")
+        self.older_messages_loaded.emit(messages, len(messages) == page_size)
+
     @Slot(str)
     def _request_create_channel(self, channel_name: str):
         log_event(f"[CTRL] Received request to create channel: '{channel_name}'")
@@ -760,14 +828,10 @@ class AppController(QObject):
                 sender_display_name=self.current_user.display_name
             )
             log_event(f"[CTRL] Created Message object: ID={message.id}, Channel={message.channel_id}")
-            save_success = self.local_storage.add_message(message)
-            if save_success:
-                log_event(f"[CTRL] Message {message.id} saved to local storage.")
-                self.new_message_signal.emit(message)
-            else:
-                log_event(f"[ERROR][CTRL] Failed to save message {message.id} to local storage!")
-                self.messageError.emit("Lỗi lưu tin nhắn cục bộ.")
-                return
+            # Ghi qua group commit (thread nền) để không chờ đĩa trên event loop; lỗi ghi được báo khi commit xong
+            save_future = asyncio.ensure_future(self.local_storage.add_message(message))
+            save_future.add_done_callback(lambda done, message=message: self._on_message_saved(message, done))
+            self.new_message_signal.emit(message)
             if self.is_online and self.p2p_service:
                 asyncio.create_task(self._broadcast_message_p2p(message), name=f"BroadcastMsg_{message.id}")
             else: log_event(f"[CTRL] Skipping P2P broadcast for message {message.id}: Offline or P2P unavailable.")
@@ -779,6 +843,13 @@ class AppController(QObject):
             log_event(f"[ERROR][CTRL] {error_msg}", exc_info=True)
             self.messageError.emit(error_msg)
 
+    def _on_message_saved(self, message: Message, save_future: asyncio.Future):
+        if not save_future.cancelled() and save_future.exception() is None and save_future.result():
+            log_event(f"[CTRL] Message {message.id} saved to local storage.")
+        else:
+            log_event(f"[ERROR][CTRL] Failed to save message {message.id} to local storage!")
+            self.messageError.emit("Lỗi lưu tin nhắn cục bộ.")
+
     async def _broadcast_message_p2p(self, message: Message):
         if not self.p2p_service: return
         log_event(f"[CTRL][ASYNC] Broadcasting message {message.id} via P2P...")
@@ -804,7 +875,12 @@ class AppController(QObject):
             if self.livestream_service and msg_type in [
                 p2p_proto.MSG_TYPE_LIVESTREAM_START,
                 p2p_proto.MSG_TYPE_LIVESTREAM_END,
-                p2p_proto.MSG_TYPE_VIDEO_FRAME
+                p2p_proto.MSG_TYPE_VIDEO_FRAME,
+                p2p_proto.MSG_TYPE_AUDIO_FRAME,
+                p2p_proto.MSG_TYPE_RELAY_ASSIGN,
+                p2p_proto.MSG_TYPE_RELAY_REPORT,
+                p2p_proto.MSG_TYPE_LIVESTREAM_SUBSCRIBE,
+                p2p_proto.MSG_TYPE_LIVESTREAM_UNSUBSCRIBE
             ]:
                 self.livestream_service.handle_incoming_p2p_livestream_message(peer_addr, message_dict)
                 return
@@ -840,10 +916,15 @@ class AppController(QObject):
                     if is_host:
                         pass
                     self.new_message_signal.emit(msg)
+            elif msg_type == p2p_proto.MSG_TYPE_REQUEST_HISTORY:
+                 self.sync_service.serve_history_request(peer_addr, payload or {})
+            elif msg_type == p2p_proto.MSG_TYPE_HISTORY_CHUNK:
+                 self.sync_service.handle_history_chunk(peer_addr, payload or {})
             elif msg_type == p2p_proto.MSG_TYPE_GREETING:
                  user_id = payload.get("user_id")
                  display_name = payload.get("display_name")
                  log_event(f"[CTRL] Received GREETING from {peer_ip}:{peer_port} - User: {user_id}, Name: {display_name}")
+                 self.sync_service.resume_history_transfer(user_id)
             else:
                  log_event(f"[WARN][CTRL] Received unhandled P2P message type '{msg_type}' from {peer_ip}:{peer_port}")
         except Exception as e:
@@ -900,6 +981,7 @@ class AppController(QObject):
         log_event("[CTRL] Closing AppController resources...")
         self.stop_network_check()
         self.peer_update_timer.stop()
+        self.local_storage.close()
         log_event("[CTRL] AppController state cleared. P2P cleanup handled by main exit.")
 
     @Slot(str)
@@ -952,6 +1034,12 @@ class AppController(QObject):
             except RuntimeError:
                 pass 
             self.livestream_service.host_preview_frame.connect(self.livestream_host_window.update_preview_frame)
+
+            try:
+                self.livestream_service.quality_rung_changed.disconnect(self.livestream_host_window.update_quality_rung)
+            except RuntimeError:
+                pass
+            self.livestream_service.quality_rung_changed.connect(self.livestream_host_window.update_quality_rung)
             
             try:
                 self.livestream_host_window.stop_livestream_requested.disconnect(self.livestream_service.stop_hosting_livestream)
@@ -1002,6 +1090,7 @@ class AppController(QObject):
             except RuntimeError:
                 pass
             self.livestream_service.viewer_new_frame.connect(self.livestream_viewer_window.update_viewer_frame)
+            self.livestream_viewer_window.display_size_changed.connect(self.livestream_service.set_viewer_display_size)
             
             try:
                 self.livestream_viewer_window.stop_viewing_requested.disconnect(self.livestream_service.stop_viewing_livestream)
@@ -0,0 +1,381 @@
+# src/core/audio_track.py
+import collections
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+import numpy as np
+
+from src.utils.logger import log_event
+
+try:
+    import sounddevice as sd # Tuỳ chọn: chỉ cần khi dùng micro/loa thật
+except (ImportError, OSError): # OSError khi có gói nhưng thiếu thư viện PortAudio
+    sd = None
+
+SAMPLE_WIDTH = 2 # PCM 16-bit
+AUDIO_SOURCE_AUTO = "auto"           # Micro thật nếu có sounddevice, nếu không thì không có audio
+AUDIO_SOURCE_DEVICE = "device"
+AUDIO_SOURCE_SYNTHETIC = "synthetic" # Sóng sin, để thử/đo không cần thiết bị
+AUDIO_SOURCE_NONE = "none"
+
+
+def frame_samples(sample_rate: int, frame_ms: int) -> int:
+    """Số mẫu (mỗi kênh) trong một frame audio."""
+    return sample_rate * frame_ms // 1000
+
+
+class AudioSource(ABC):
+    """Nguồn âm thanh: read() chặn đến khi có đủ một frame PCM s16le rồi trả về bytes của frame đó."""
+
+    def __init__(self, sample_rate: int, channels: int, frame_ms: int):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.frame_ms = frame_ms
+        self.samples_per_frame = frame_samples(sample_rate, frame_ms)
+
+    def start(self):
+        pass
+
+    @abstractmethod
+    def read(self) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+
+class SyntheticAudioSource(AudioSource):
+    """
+    Sóng sin liên tục pha giữa các frame (frequency=0 cho im lặng). Với realtime=True, read() chờ đến
+    đúng hạn của frame kế tiếp như một micro thật; realtime=False trả về ngay (test, benchmark).
+    """
+
+    def __init__(self, sample_rate: int = 16000, channels: int = 1, frame_ms: int = 20,
+                 frequency: float = 440.0, amplitude: float = 0.2, realtime: bool = True):
+        super().__init__(sample_rate, channels, frame_ms)
+        self.frequency = frequency
+        self.amplitude = amplitude
+        self.realtime = realtime
+        self._sample_index = 0
+        self._started_at: Optional[float] = None
+
+    def start(self):
+        self._sample_index = 0
+        self._started_at = time.monotonic()
+
+    def read(self) -> Optional[bytes]:
+        if self._started_at is None:
+            self.start()
+        if self.realtime:
+            # Hạn của frame = thời điểm mẫu cuối của nó được "thu"; tính từ mốc đầu để không tích luỹ sai số sleep
+            deadline = self._started_at + (self._sample_index + self.samples_per_frame) / self.sample_rate
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        t = (self._sample_index + np.arange(self.samples_per_frame)) / self.sample_rate
+        self._sample_index += self.samples_per_frame
+        wave = (self.amplitude * 32767 * np.sin(2 * np.pi * self.frequency * t)).astype('<i2')
+        if self.channels > 1:
+            wave = np.repeat(wave, self.channels) # Các kênh giống nhau, xen kẽ
+        return wave.tobytes()
+
+
+class SoundDeviceSource(AudioSource):
+    """Micro thật qua sounddevice (PortAudio), đọc blocking từng frame."""
+
+    def __init__(self, sample_rate: int = 16000, channels: int = 1, frame_ms: int = 20):
+        super().__init__(sample_rate, channels, frame_ms)
+        self._stream = None
+        self.overflows = 0
+
+    def start(self):
+        self._stream = sd.RawInputStream(samplerate=self.sample_rate, channels=self.channels, dtype='int16',
+                                         blocksize=self.samples_per_frame)
+        self._stream.start()
+
+    def read(self) -> Optional[bytes]:
+        if self._stream is None:
+            return None
+        data, overflowed = self._stream.read(self.samples_per_frame)
+        if overflowed:
+            self.overflows += 1
+        return bytes(data)
+
+    def stop(self):
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            stream.stop()
+            stream.close()
+
+
+def create_audio_source(kind: str, sample_rate: int, channels: int, frame_ms: int) -> Optional[AudioSource]:
+    """Tạo nguồn âm thanh theo cấu hình; trả về None nếu không dùng audio hoặc không có thiết bị."""
+    if kind == AUDIO_SOURCE_SYNTHETIC:
+        return SyntheticAudioSource(sample_rate, channels, frame_ms)
+    if kind in (AUDIO_SOURCE_AUTO, AUDIO_SOURCE_DEVICE):
+        if sd is not None:
+            return SoundDeviceSource(sample_rate, channels, frame_ms)
+        if kind == AUDIO_SOURCE_DEVICE:
+            log_event("[AudioTrack] sounddevice is not installed; livestream audio disabled.")
+    return None
+
+
+class AudioCaptureThread(threading.Thread):
+    """
+    Thread thu âm riêng (không chung với thread camera): đọc từng frame từ nguồn và gọi on_frame(seq, timestamp_ms, pcm).
+    timestamp_ms là thời điểm bắt đầu của frame trên đồng hồ time.time() (cùng đồng hồ với video frame),
+    tính theo số mẫu đã thu để đều nhịp; nếu đồng hồ mẫu của card âm thanh trôi lệch quá max_drift_ms
+    so với đồng hồ hệ thống thì mốc được chỉnh lại để tiếng không lệch dần khỏi hình.
+    """
+
+    def __init__(self, source: AudioSource, on_frame: Callable[[int, int, bytes], None], max_drift_ms: float = 40.0):
+        super().__init__(name="LivestreamAudioCapture", daemon=True)
+        self.source = source
+        self.on_frame = on_frame
+        self.max_drift_ms = max_drift_ms
+        self.running = False
+        self.clock_adjustments = 0
+
+    def run(self):
+        self.running = True
+        try:
+            self.source.start()
+            log_event(f"[AudioCaptureThread] Capturing {self.source.sample_rate} Hz x{self.source.channels}, "
+                      f"{self.source.frame_ms} ms frames.")
+            seq = 0
+            base_ms = None
+            while self.running:
+                pcm = self.source.read()
+                if pcm is None:
+                    break
+                now_ms = time.time() * 1000
+                if base_ms is None:
+                    base_ms = now_ms - self.source.frame_ms
+                timestamp_ms = base_ms + seq * self.source.frame_ms
+                drift_ms = (now_ms - self.source.frame_ms) - timestamp_ms
+                if abs(drift_ms) > self.max_drift_ms:
+                    base_ms += drift_ms
+                    timestamp_ms += drift_ms
+                    self.clock_adjustments += 1
+                seq += 1
+                self.on_frame(seq, int(timestamp_ms), pcm)
+        except Exception as e:
+            log_event(f"[AudioCaptureThread] Error capturing audio: {e}", exc_info=True)
+        finally:
+            self.source.stop()
+            log_event("[AudioCaptureThread] Audio capture finished.")
+
+    def stop(self):
+        self.running = False
+
+
+class AudioPlayoutBuffer:
+    """
+    Jitter buffer phát âm thanh phía viewer. Frame được giữ theo seq và phát đều mỗi frame_ms.
+    Độ trễ phát mục tiêu được đo trên cùng trục (giờ hiện tại - timestamp của host) với độ trễ hiển thị
+    video, nên lệch đồng hồ giữa hai máy tự triệt tiêu:
+    - có video: tiếng được hoãn cho khớp độ trễ hình (lip-sync), nhưng không thấp hơn mức mạng cho phép;
+    - không có video: độ trễ mạng nhỏ nhất gần đây + target_delay_ms.
+    Lệch khỏi mục tiêu (do trôi đồng hồ hai máy hoặc mạng đổi) được sửa dần: bỏ một frame khi phát
+    quá trễ, chèn một frame im lặng khi phát quá sớm. Frame mất được thay bằng im lặng.
+    Thread-safe: push() trên event loop, pull() trên thread/callback phát.
+    """
+
+    def __init__(self, sample_rate: int, channels: int, frame_ms: int,
+                 target_delay_ms: float = 60.0, max_delay_ms: float = 300.0, delay_window: int = 100):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.frame_ms = frame_ms
+        self.target_delay_ms = target_delay_ms
+        self.max_delay_ms = max_delay_ms
+        self._silence = bytes(frame_samples(sample_rate, frame_ms) * channels * SAMPLE_WIDTH)
+        self._max_frames = max(2, int(max_delay_ms // frame_ms))
+        self._lock = threading.Lock()
+        self._frames: Dict[int, Tuple[int, bytes]] = {}
+        self._arrival_delays: Deque[float] = collections.deque(maxlen=delay_window)
+        self._next_seq: Optional[int] = None
+        self._playing = False
+        self._consecutive_underruns = 0
+        self._video_delay_ms: Optional[float] = None
+
+        # --- Metrics ---
+        self.played_frames = 0
+        self.concealed_frames = 0 # Frame mất, phát im lặng thay thế
+        self.underruns = 0        # Tới lượt phát nhưng chưa có frame
+        self.late_frames = 0      # Đến sau khi đã qua lượt phát
+        self.overflow_drops = 0   # Bị bỏ vì buffer vượt max_delay_ms
+        self.sync_drops = 0       # Bỏ để bắt kịp (phát quá trễ)
+        self.sync_inserts = 0     # Chèn im lặng để chờ (phát quá sớm)
+        self.playout_delay_ms = 0.0 # EWMA độ trễ phát thực tế (giờ phát - timestamp host)
+
+    @property
+    def silence(self) -> bytes:
+        return self._silence
+
+    def matches(self, sample_rate: int, channels: int) -> bool:
+        return sample_rate == self.sample_rate and channels == self.channels
+
+    def set_video_delay_ms(self, delay_ms: Optional[float]):
+        """Độ trễ hiển thị video hiện tại (giờ hiển thị - timestamp host); None nếu không có video."""
+        self._video_delay_ms = delay_ms
+
+    def reset(self):
+        with self._lock:
+            self._frames.clear()
+            self._arrival_delays.clear()
+            self._next_seq = None
+            self._playing = False
+            self._consecutive_underruns = 0
+
+    def push(self, seq: int, timestamp_ms: int, pcm: bytes, now_ms: Optional[float] = None) -> bool:
+        """Nhận một frame từ mạng. Trả về False nếu frame đến quá muộn để phát."""
+        if now_ms is None:
+            now_ms = time.time() * 1000
+        with self._lock:
+            if (self._next_seq is not None and seq < self._next_seq) or seq in self._frames:
+                self.late_frames += 1
+                return False
+            self._frames[seq] = (timestamp_ms, pcm)
+            self._arrival_delays.append(now_ms - timestamp_ms)
+            while len(self._frames) > self._max_frames:
+                oldest = min(self._frames)
+                del self._frames[oldest]
+                self.overflow_drops += 1
+                if self._next_seq is not None and oldest >= self._next_seq:
+                    self._next_seq = oldest + 1
+        return True
+
+    def target_playout_delay_ms(self) -> float:
+        """Độ trễ phát mục tiêu trên trục (giờ hiện tại - timestamp host)."""
+        network_floor = min(self._arrival_delays) if self._arrival_delays else 0.0
+        if self._video_delay_ms is None:
+            return network_floor + self.target_delay_ms
+        lowest = network_floor + 2 * self.frame_ms # Chừa tối thiểu hai frame cho jitter
+        return min(max(self._video_delay_ms, lowest), network_floor + self.max_delay_ms)
+
+    def pull(self, now_ms: Optional[float] = None) -> bytes:
+        """Lấy frame kế tiếp để phát (luôn trả về đúng một frame, im lặng nếu không có gì để phát)."""
+        if now_ms is None:
+            now_ms = time.time() * 1000
+        with self._lock:
+            if not self._playing:
+                # Tích đủ độ trễ mục tiêu rồi mới bắt đầu phát
+                if not self._frames:
+                    return self._silence
+                first_seq = min(self._frames)
+                if now_ms - self._frames[first_seq][0] < self.target_playout_delay_ms():
+                    return self._silence
+                self._playing = True
+                self._next_seq = first_seq
+
+            head = self._frames.get(self._next_seq)
+            if head is not None:
+                error_ms = (now_ms - head[0]) - self.target_playout_delay_ms()
+                if error_ms < -self.frame_ms:
+                    self.sync_inserts += 1
+                    return self._silence
+                if error_ms > self.frame_ms and self._next_seq + 1 in self._frames:
+                    del self._frames[self._next_seq]
+                    self._next_seq += 1
+                    self.sync_drops += 1
+                    head = self._frames[self._next_seq]
+
+            if head is not None:
+                del self._frames[self._next_seq]
+                self._next_seq += 1
+                self._consecutive_underruns = 0
+                self.played_frames += 1
+                self.playout_delay_ms += 0.1 * ((now_ms - head[0]) - self.playout_delay_ms)
+                return head[1]
+
+            if any(seq > self._next_seq for seq in self._frames):
+                self._next_seq += 1 # Frame này đã mất, các frame sau đã tới
+                self.concealed_frames += 1
+                return self._silence
+
+            self.underruns += 1
+            self._consecutive_underruns += 1
+            if self._consecutive_underruns * self.frame_ms >= self.max_delay_ms:
+                self._playing = False # Nguồn ngắt quãng lâu: tích lại buffer như lúc bắt đầu
+            return self._silence
+
+    def get_stats(self) -> Dict[str, float]:
+        return {
+            "buffered_frames": len(self._frames),
+            "played_frames": self.played_frames,
+            "concealed_frames": self.concealed_frames,
+            "underruns": self.underruns,
+            "late_frames": self.late_frames,
+            "overflow_drops": self.overflow_drops,
+            "sync_drops": self.sync_drops,
+            "sync_inserts": self.sync_inserts,
+            "target_delay_ms": round(self.target_playout_delay_ms(), 2),
+            "playout_delay_ms": round(self.playout_delay_ms, 2),
+        }
+
+
+class AudioPlayer:
+    """
+    Phát từ AudioPlayoutBuffer: qua loa bằng sounddevice nếu có (callback của PortAudio gọi pull());
+    nếu không, một thread rút frame theo nhịp thời gian thực và đưa cho sink (hoặc bỏ đi), để buffer
+    vẫn chạy đúng nhịp khi thử không có thiết bị.
+    """
+
+    def __init__(self, playout_buffer: AudioPlayoutBuffer, use_device: bool = True,
+                 sink: Optional[Callable[[bytes], None]] = None):
+        self.buffer = playout_buffer
+        self.use_device = use_device and sd is not None
+        self.sink = sink
+        self._stream = None
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        if self.use_device:
+            try:
+                self._stream = sd.RawOutputStream(samplerate=self.buffer.sample_rate, channels=self.buffer.channels,
+                                                  dtype='int16', callback=self._device_callback,
+                                                  blocksize=frame_samples(self.buffer.sample_rate, self.buffer.frame_ms))
+                self._stream.start()
+                return
+            except Exception as e:
+                log_event(f"[AudioPlayer] Cannot open audio output ({e}); playing to null sink.")
+                self._stream = None
+        self._thread = threading.Thread(target=self._sink_loop, name="LivestreamAudioPlayout", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            stream.stop()
+            stream.close()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout=1.0)
+
+    def _device_callback(self, outdata, frames, time_info, status):
+        # Cộng độ trễ đầu ra của thiết bị để thời điểm "phát" khớp lúc tiếng thực sự ra loa
+        output_latency_ms = (self._stream.latency * 1000) if self._stream is not None else 0.0
+        data = self.buffer.pull(time.time() * 1000 + output_latency_ms)
+        outdata[:len(data)] = data
+        if len(data) < len(outdata):
+            outdata[len(data):] = bytes(len(outdata) - len(data))
+
+    def _sink_loop(self):
+        started = time.monotonic()
+        pulled = 0
+        frame_s = self.buffer.frame_ms / 1000
+        while self._running:
+            delay = started + pulled * frame_s - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            data = self.buffer.pull()
+            pulled += 1
+            if self.sink is not None:
+                self.sink(data)
@@ -0,0 +1,177 @@
+# src/core/frame_source.py
+import glob
+import os
+from abc import ABC, abstractmethod
+from typing import List, Optional, Union
+
+import cv2
+import numpy as np
+
+from src.utils.logger import log_event
+
+
+class FrameSource(ABC):
+    """
+    Nguồn frame BGR cho livestream. VideoCaptureThread gọi open() một lần, read() mỗi frame
+    (None = hết dữ liệu hoặc lỗi) và close() khi dừng; nhịp FPS do thread quyết định.
+    """
+    name = "source"
+
+    def open(self) -> bool:
+        return True
+
+    @abstractmethod
+    def read(self) -> Optional[np.ndarray]:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class CameraFrameSource(FrameSource):
+    """Camera qua cv2.VideoCapture (hành vi mặc định trước đây của VideoCaptureThread)."""
+
+    def __init__(self, camera_index: int = 0):
+        self.camera_index = camera_index
+        self.name = f"camera {camera_index}"
+        self._cap = None
+
+    def open(self) -> bool:
+        self._cap = cv2.VideoCapture(self.camera_index)
+        return self._cap.isOpened()
+
+    def read(self) -> Optional[np.ndarray]:
+        if self._cap is None or not self._cap.isOpened():
+            return None
+        ret, frame = self._cap.read()
+        return frame if ret else None
+
+    def close(self):
+        if self._cap is not None and self._cap.isOpened():
+            self._cap.release()
+        self._cap = None
+
+
+class VideoFileFrameSource(FrameSource):
+    """Đọc frame từ file video; loop=True thì quay lại đầu khi hết file (chạy tải dài)."""
+
+    def __init__(self, path: str, loop: bool = True):
+        self.path = path
+        self.loop = loop
+        self.name = f"file {os.path.basename(path)}"
+        self._cap = None
+
+    def open(self) -> bool:
+        self._cap = cv2.VideoCapture(self.path)
+        return self._cap.isOpened()
+
+    def read(self) -> Optional[np.ndarray]:
+        if self._cap is None:
+            return None
+        ret, frame = self._cap.read()
+        if not ret and self.loop:
+            self._cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self._cap.read()
+        return frame if ret else None
+
+    def close(self):
+        if self._cap is not None:
+            self._cap.release()
+        self._cap = None
+
+
+class ImageSequenceFrameSource(FrameSource):
+    """Chuỗi ảnh theo thứ tự tên file (thư mục hoặc mẫu glob); ảnh được giải mã một lần rồi giữ trong bộ nhớ."""
+
+    def __init__(self, pattern: str, loop: bool = True):
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*")
+        self.pattern = pattern
+        self.loop = loop
+        self.name = f"images {pattern}"
+        self._frames: List[np.ndarray] = []
+        self._index = 0
+
+    def open(self) -> bool:
+        self._frames = [frame for frame in (cv2.imread(path) for path in sorted(glob.glob(self.pattern)))
+                        if frame is not None]
+        self._index = 0
+        if not self._frames:
+            log_event(f"[FrameSource] No readable images match '{self.pattern}'.")
+        return bool(self._frames)
+
+    def read(self) -> Optional[np.ndarray]:
+        if self._index >= len(self._frames):
+            if not self.loop or not self._frames:
+                return None
+            self._index = 0
+        frame = self._frames[self._index]
+        self._index += 1
+        return frame.copy() # Pipeline có thể giữ frame lâu hơn một vòng đọc
+
+    def close(self):
+        self._frames = []
+
+
+class SyntheticFrameSource(FrameSource):
+    """
+    Frame giả xác định (cùng frame_count thì cùng ảnh): nền đổi màu như create_dummy_frame của
+    preview_livestream, thêm một khối chuyển động và số frame để có vùng thay đổi thật khi đo
+    encoder/delta. Không cần camera, dùng cho benchmark và CI.
+    """
+
+    def __init__(self, width: int = 640, height: int = 480, max_frames: Optional[int] = None, box_size: int = 64):
+        self.width = width
+        self.height = height
+        self.max_frames = max_frames
+        self.box_size = min(box_size, width, height)
+        self.name = f"synthetic {width}x{height}"
+        self.frame_count = 0
+
+    def open(self) -> bool:
+        self.frame_count = 0
+        return True
+
+    def read(self) -> Optional[np.ndarray]:
+        if self.max_frames is not None and self.frame_count >= self.max_frames:
+            return None
+        self.frame_count += 1
+        return self.render(self.frame_count)
+
+    def render(self, frame_count: int) -> np.ndarray:
+        n = frame_count
+        frame = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        frame[:] = ((n * 2 + 100) % 256, (n * 5 + 50) % 256, (n * 10) % 256) # BGR
+        span_x = max(1, self.width - self.box_size)
+        span_y = max(1, self.height - self.box_size)
+        x = (n * 7) % span_x
+        y = (n * 3) % span_y
+        cv2.rectangle(frame, (x, y), (x + self.box_size - 1, y + self.box_size - 1), (255, 255, 255), -1)
+        cv2.putText(frame, f"#{n}", (8, min(self.height - 8, 32)), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 0, 0), 2)
+        return frame
+
+
+def create_frame_source(spec: Union[int, str, FrameSource]) -> FrameSource:
+    """
+    Tạo nguồn frame từ mô tả: số nguyên hoặc "camera:0", "file:<đường dẫn>",
+    "images:<thư mục hoặc glob>", "synthetic" / "synthetic:1280x720".
+    """
+    if isinstance(spec, FrameSource):
+        return spec
+    if isinstance(spec, int):
+        return CameraFrameSource(spec)
+    kind, _, arg = spec.partition(":")
+    if kind == "camera":
+        return CameraFrameSource(int(arg or 0))
+    if kind == "file":
+        return VideoFileFrameSource(arg)
+    if kind == "images":
+        return ImageSequenceFrameSource(arg)
+    if kind == "synthetic":
+        if arg:
+            width, _, height = arg.lower().partition("x")
+            return SyntheticFrameSource(int(width), int(height))
+        return SyntheticFrameSource()
+    if spec.isdigit():
+        return CameraFrameSource(int(spec))
+    raise ValueError(f"Unknown frame source '{spec}'")
@@ -0,0 +1,200 @@
+# src/core/host_pipeline.py
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import cv2
+from PySide6.QtGui import QImage
+
+from src.utils.logger import log_event
+from src.core import simulcast
+from src.core.tile_delta import TileDeltaEncoder
+
+
+class EncodedFrame:
+    """
+    Kết quả của pipeline cho một frame: dữ liệu của từng lớp simulcast (JPEG đầy đủ hoặc tập patch
+    ở chế độ delta, xem layer_keyframes) và ảnh preview đã thu nhỏ.
+    """
+    __slots__ = ("frame_id", "timestamp_ms", "layers", "layer_keyframes", "preview", "encode_ms")
+
+    def __init__(self, frame_id: int, timestamp_ms: int, layer_count: int):
+        self.frame_id = frame_id
+        self.timestamp_ms = timestamp_ms
+        self.layers: List[Optional[memoryview]] = [None] * layer_count
+        self.layer_keyframes: List[bool] = [True] * layer_count
+        self.preview: Optional[QImage] = None
+        self.encode_ms = 0.0
+
+
+def make_preview_image(cv_frame, max_width: int) -> Optional[QImage]:
+    """Thu nhỏ frame BGR và chuyển thành QImage RGB (QImage được phép tạo ngoài thread GUI)."""
+    h, w = cv_frame.shape[:2]
+    if w > max_width:
+        scale = max_width / w
+        cv_frame = cv2.resize(cv_frame, (max_width, max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+    rgb_image = cv2.cvtColor(cv_frame, cv2.COLOR_BGR2RGB)
+    h, w, ch = rgb_image.shape
+    # copy() để QImage sở hữu dữ liệu của mình, không trỏ vào mảng NumPy sắp bị giải phóng
+    return QImage(rgb_image.data, w, h, ch * w, QImage.Format_RGB888).copy()
+
+
+class _PendingFrame:
+    __slots__ = ("encoded", "remaining", "started", "lock")
+
+    def __init__(self, encoded: EncodedFrame, remaining: int):
+        self.encoded = encoded
+        self.remaining = remaining
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+
+
+class HostEncodePipeline:
+    """
+    Pipeline capture -> encode -> send phía host. Thread camera gọi submit() trực tiếp; chuyển màu
+    preview và JPEG của từng lớp chạy song song trong thread pool (OpenCV nhả GIL). Khi mọi phần
+    xong, chỉ EncodedFrame (bytes + QImage nhỏ) được chuyển về event loop qua call_soon_threadsafe.
+    Chỉ một frame được xử lý tại một thời điểm; frame đến khi pipeline bận bị bỏ.
+    Ở chế độ delta, mỗi lớp có TileDeltaEncoder riêng; keyframe được phát định kỳ
+    (keyframe_interval frame) hoặc khi có yêu cầu (viewer mới, viewer đổi lớp).
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, pool: ThreadPoolExecutor,
+                 on_encoded: Callable[[EncodedFrame], None], preview_max_width: int = 640,
+                 delta_mode: bool = False, tile_size: int = 64, keyframe_interval: int = 30,
+                 min_keyframe_gap: int = 5):
+        self._loop = loop
+        self._pool = pool
+        self._on_encoded = on_encoded
+        self.preview_max_width = preview_max_width
+        self._layer_params: Tuple[Tuple[float, int], ...] = ((1.0, 75),)
+        self._busy = threading.Lock()
+        self._frame_id = 0
+        self._running = True
+
+        self.delta_mode = delta_mode
+        self.tile_size = tile_size
+        self.keyframe_interval = keyframe_interval
+        self.min_keyframe_gap = min_keyframe_gap # Giới hạn tần suất keyframe theo yêu cầu
+        self._delta_encoders: List[TileDeltaEncoder] = []
+        self._frames_since_keyframe = 0
+        self._keyframe_requested = True
+
+        # --- Metrics ---
+        self.submitted_frames = 0
+        self.skipped_frames = 0 # Frame bị bỏ vì pipeline còn bận
+        self.encode_ms = 0.0    # EWMA thời gian từ submit đến khi mọi lớp encode xong
+
+    def set_layer_params(self, layer_params: Sequence[Tuple[float, int]]):
+        """Cập nhật (tỉ lệ, chất lượng) của các lớp; gán một tuple mới nên thread camera luôn đọc được bản nhất quán."""
+        self._layer_params = tuple(layer_params)
+
+    def request_keyframe(self):
+        """Yêu cầu frame kế tiếp là keyframe (an toàn khi gọi từ event loop)."""
+        self._keyframe_requested = True
+
+    def reset(self):
+        self._frame_id = 0
+        self._frames_since_keyframe = 0
+        self._keyframe_requested = True
+        for encoder in self._delta_encoders:
+            encoder.reset()
+        self.submitted_frames = 0
+        self.skipped_frames = 0
+        self.encode_ms = 0.0
+        self._running = True
+
+    def stop(self):
+        """Ngừng nhận frame mới; frame đang encode dở vẫn chạy xong nhưng không được gửi về loop."""
+        self._running = False
+
+    def submit(self, cv_frame) -> bool:
+        """Gọi từ thread camera. Trả về False nếu frame bị bỏ."""
+        if not self._running or cv_frame is None:
+            return False
+        if not self._busy.acquire(blocking=False):
+            self.skipped_frames += 1
+            return False
+        try:
+            self._frame_id += 1
+            self.submitted_frames += 1
+            layer_params = self._layer_params
+            force_keyframe = self._next_is_keyframe()
+            while len(self._delta_encoders) < len(layer_params):
+                self._delta_encoders.append(TileDeltaEncoder(self.tile_size))
+            pending = _PendingFrame(EncodedFrame(self._frame_id, int(time.time() * 1000), len(layer_params)),
+                                    remaining=len(layer_params) + 1)
+            preview_future = self._pool.submit(make_preview_image, cv_frame, self.preview_max_width)
+            preview_future.add_done_callback(lambda future: self._on_preview_done(pending, future))
+            for layer_index, (scale, quality) in enumerate(layer_params):
+                if self.delta_mode:
+                    layer_future = self._pool.submit(self._encode_delta_layer, self._delta_encoders[layer_index],
+                                                     cv_frame, scale, quality, force_keyframe)
+                else:
+                    layer_future = self._pool.submit(simulcast.encode_jpeg, cv_frame, scale, quality)
+                layer_future.add_done_callback(lambda future, index=layer_index: self._on_layer_done(pending, index, future))
+            return True
+        except Exception as e:
+            log_event(f"[HostEncodePipeline] Error submitting frame: {e}", exc_info=True)
+            self._busy.release()
+            return False
+
+    def _next_is_keyframe(self) -> bool:
+        """Quyết định keyframe cho frame sắp encode (chỉ gọi trong submit, đang giữ _busy)."""
+        self._frames_since_keyframe += 1
+        due = self._frames_since_keyframe >= self.keyframe_interval
+        requested = self._keyframe_requested and self._frames_since_keyframe >= self.min_keyframe_gap
+        if due or requested or self._frame_id == 1:
+            self._frames_since_keyframe = 0
+            self._keyframe_requested = False
+            return True
+        return False
+
+    @staticmethod
+    def _encode_delta_layer(encoder: TileDeltaEncoder, cv_frame, scale: float, quality: int, force_keyframe: bool):
+        if scale < 1.0:
+            cv_frame = cv2.resize(cv_frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return encoder.encode(cv_frame, quality, force_keyframe)
+
+    def _on_preview_done(self, pending: _PendingFrame, future: Future):
+        try:
+            pending.encoded.preview = future.result()
+        except Exception as e:
+            log_event(f"[HostEncodePipeline] Error creating host preview: {e}")
+        self._part_done(pending)
+
+    def _on_layer_done(self, pending: _PendingFrame, layer_index: int, future: Future):
+        try:
+            result = future.result()
+            if self.delta_mode:
+                pending.encoded.layers[layer_index], pending.encoded.layer_keyframes[layer_index] = result
+            else:
+                pending.encoded.layers[layer_index] = result
+        except Exception as e:
+            log_event(f"[HostEncodePipeline] Error encoding layer {layer_index}: {e}")
+        self._part_done(pending)
+
+    def _part_done(self, pending: _PendingFrame):
+        with pending.lock:
+            pending.remaining -= 1
+            if pending.remaining > 0:
+                return
+        elapsed_ms = (time.perf_counter() - pending.started) * 1000
+        pending.encoded.encode_ms = elapsed_ms
+        self.encode_ms += 0.2 * (elapsed_ms - self.encode_ms)
+        self._busy.release()
+        if not self._running:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._on_encoded, pending.encoded)
+        except RuntimeError:
+            pass # Event loop đã đóng khi ứng dụng thoát
+
+    def get_stats(self) -> dict:
+        return {
+            "submitted_frames": self.submitted_frames,
+            "skipped_frames": self.skipped_frames,
+            "encode_ms": round(self.encode_ms, 2),
+        }
@@ -3,63 +3,83 @@ import asyncio
 import cv2 # Thư viện OpenCV cho camera và xử lý ảnh
 import base64
 import numpy as np # Thư viện NumPy để xử lý mảng
-from typing import Optional, Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Callable
 from PySide6.QtCore import Slot
+import config
 # Đảm bảo import đúng đường dẫn
 try:
     from src.p2p.p2p_service import P2PService
     from src.p2p import protocol as p2p_proto
     from src.utils.logger import log_event
+    from src.core.adaptive_bitrate import AdaptiveBitrateController, CongestionThresholds, QualityRung, build_ladder
+    from src.core import simulcast
+    from src.core.host_pipeline import EncodedFrame, HostEncodePipeline
+    from src.core.viewer_pipeline import DecodedFrame, ViewerDecodePipeline
+    from src.core.relay_tree import HostRelayCoordinator, RelayTreePlanner, ViewerRelayForwarder
+    from src.core.audio_track import AudioCaptureThread, AudioPlayer, AudioPlayoutBuffer, create_audio_source
+    from src.core.frame_source import FrameSource, create_frame_source
 except ImportError: # Fallback cho trường hợp chạy trực tiếp hoặc cấu trúc khác
     print("Attempting relative imports for P2P/Utils in livestream_service...")
     from ..p2p.p2p_service import P2PService
     from ..p2p import protocol as p2p_proto
     from ..utils.logger import log_event
+    from .adaptive_bitrate import AdaptiveBitrateController, CongestionThresholds, QualityRung, build_ladder
+    from . import simulcast
+    from .host_pipeline import EncodedFrame, HostEncodePipeline
+    from .viewer_pipeline import DecodedFrame, ViewerDecodePipeline
+    from .relay_tree import HostRelayCoordinator, RelayTreePlanner, ViewerRelayForwarder
+    from .audio_track import AudioCaptureThread, AudioPlayer, AudioPlayoutBuffer, create_audio_source
+    from .frame_source import FrameSource, create_frame_source
 
 from PySide6.QtCore import QObject, Signal, QThread, QTimer
-from PySide6.QtGui import QImage, QPixmap, Qt # Thêm Qt
+from PySide6.QtGui import QPixmap, Qt # Thêm Qt
 
 class VideoCaptureThread(QThread):
-    new_cv_frame = Signal(object) # Gửi frame OpenCV gốc
+    new_cv_frame = Signal(object) # Gửi frame OpenCV gốc (chỉ khi không có frame_sink)
     finished_capturing = Signal()
     error_signal = Signal(str) # Thêm signal báo lỗi
 
-    def __init__(self, camera_index=0, parent=None):
+    def __init__(self, camera_index=0, parent=None, fps=15, frame_sink: Optional[Callable[[np.ndarray], object]] = None,
+                 source: Optional[FrameSource] = None):
         super().__init__(parent)
         self.camera_index = camera_index
-        self.cap = None
+        # Nguồn frame (camera, file video, chuỗi ảnh hoặc frame giả); mặc định là camera camera_index
+        self.source = source or create_frame_source(camera_index)
+        # Nếu có frame_sink, frame được đưa thẳng vào pipeline encode từ thread này thay vì đi qua
+        # signal Qt về thread GUI
+        self.frame_sink = frame_sink
         self.running = False
-        self.fps = 15 # Giới hạn FPS để giảm tải
+        self.fps = fps # Giới hạn FPS để giảm tải, có thể đổi khi đang chạy qua set_fps()
+
+    def set_fps(self, fps: int):
+        """Đổi FPS khi đang capture (được bộ điều chỉnh chất lượng gọi)."""
+        self.fps = max(1, int(fps))
 
     def run(self):
         try:
-            self.cap = cv2.VideoCapture(self.camera_index)
-            if not self.cap.isOpened():
-                error_msg = f"Cannot open camera {self.camera_index}"
+            if not self.source.open():
+                error_msg = f"Cannot open {self.source.name}"
                 log_event(f"[VideoCaptureThread] {error_msg}")
                 self.error_signal.emit(error_msg)
-                self.finished_capturing.emit()
                 return
 
             self.running = True
-            log_event(f"[VideoCaptureThread] Camera {self.camera_index} opened. Capturing at {self.fps} FPS.")
-
-            time_per_frame = 1.0 / self.fps
+            log_event(f"[VideoCaptureThread] {self.source.name} opened. Capturing at {self.fps} FPS.")
 
-            while self.running and self.cap.isOpened():
+            while self.running:
                 loop_start_time = cv2.getTickCount()
+                time_per_frame = 1.0 / self.fps # Đọc lại mỗi vòng vì FPS có thể thay đổi
 
-                ret, frame = self.cap.read()
-                if not ret:
+                frame = self.source.read()
+                if frame is None:
                     log_event("[VideoCaptureThread] Failed to grab frame or stream ended.")
                     break # Kết thúc vòng lặp nếu không đọc được frame
 
-                # Chỉ emit nếu frame hợp lệ
-                if frame is not None:
-                    self.new_cv_frame.emit(frame)
+                if self.frame_sink is not None:
+                    self.frame_sink(frame)
                 else:
-                    log_event("[VideoCaptureThread] Warning: Grabbed None frame.")
-                    # Có thể thêm logic thử lại hoặc dừng hẳn
+                    self.new_cv_frame.emit(frame)
 
                 # Đảm bảo FPS
                 processing_time = (cv2.getTickCount() - loop_start_time) / cv2.getTickFrequency()
@@ -72,9 +92,8 @@ class VideoCaptureThread(QThread):
             log_event(f"[VideoCaptureThread] {error_msg}", exc_info=True)
             self.error_signal.emit(error_msg) # Gửi lỗi ra ngoài
         finally:
-            if self.cap and self.cap.isOpened(): # Chỉ release nếu đã mở
-                self.cap.release()
-                log_event("[VideoCaptureThread] Camera released.")
+            self.source.close()
+            log_event(f"[VideoCaptureThread] {self.source.name} released.")
             self.finished_capturing.emit()
             log_event("[VideoCaptureThread] Capture thread finished.")
 
@@ -88,8 +107,15 @@ class LivestreamService(QObject):
     livestream_started_signal = Signal(str, str) # streamer_id, streamer_name
     livestream_ended_signal = Signal(str)   # streamer_id
     livestream_error_signal = Signal(str) # Signal mới để báo lỗi chung
-
-    def __init__(self, p2p_service: P2PService, current_user_id: str, current_display_name: str, parent=None):
+    quality_rung_changed = Signal(int, str) # rung_index, rung_label
+
+    def __init__(self, p2p_service: P2PService, current_user_id: str, current_display_name: str, parent=None,
+                 bitrate_controller: Optional[AdaptiveBitrateController] = None,
+                 abr_interval_ms: int = config.LIVESTREAM_ABR_INTERVAL_MS,
+                 simulcast_layers=config.LIVESTREAM_SIMULCAST_LAYERS,
+                 delta_mode: bool = config.LIVESTREAM_DELTA_MODE,
+                 relay_mode: bool = config.LIVESTREAM_RELAY_MODE,
+                 audio_source: str = config.LIVESTREAM_AUDIO_SOURCE):
         super().__init__(parent)
         self.p2p_service = p2p_service
         self.current_user_id = current_user_id
@@ -103,8 +129,51 @@ class LivestreamService(QObject):
         self.capture_thread: Optional[VideoCaptureThread] = None
         self.frame_id_counter = 0
         self.jpeg_quality = 75
-
-    def start_hosting_livestream(self, camera_index=0):
+        self.output_scale = 1.0 # Tỉ lệ độ phân giải gửi đi so với camera
+
+        # Bộ điều chỉnh chất lượng thích ứng theo metrics gửi của từng viewer
+        congestion_thresholds = CongestionThresholds(**config.LIVESTREAM_CONGESTION_THRESHOLDS)
+        self.bitrate_controller = bitrate_controller or AdaptiveBitrateController(build_ladder(
+            config.LIVESTREAM_JPEG_QUALITY_RANGE, config.LIVESTREAM_SCALE_RANGE, config.LIVESTREAM_FPS_RANGE),
+            thresholds=congestion_thresholds)
+        self._abr_timer = QTimer(self)
+        self._abr_timer.setInterval(abr_interval_ms)
+        self._abr_timer.timeout.connect(self._evaluate_stream_quality)
+
+        # Simulcast: mỗi frame được encode thành nhiều lớp song song, mỗi viewer nhận lớp hợp với throughput của mình
+        self.simulcast_layers = [simulcast.SimulcastLayer(scale, quality_drop) for scale, quality_drop in simulcast_layers]
+        self.layer_selector = simulcast.SimulcastLayerSelector(len(self.simulcast_layers), congestion_thresholds)
+        # Một worker cho mỗi lớp và một cho ảnh preview, để mọi phần của một frame chạy song song
+        self._encode_pool = ThreadPoolExecutor(max_workers=len(self.simulcast_layers) + 1, thread_name_prefix="LivestreamEncode")
+        self._encode_pipeline: Optional[HostEncodePipeline] = None
+        self.delta_mode = delta_mode
+        # Viewer đã đăng ký xem stream của mình: user_id -> địa chỉ kết nối đã gửi subscribe.
+        # Chỉ các viewer này nhận frame; peer không mở cửa sổ xem không tốn băng thông.
+        self._subscribers: Dict[str, tuple] = {}
+        self._known_viewers: set = set()
+        self._viewers_awaiting_keyframe: set = set() # Viewer mới/đổi lớp: không gửi frame delta cho đến keyframe
+        # Pipeline giải mã phía viewer (jitter buffer + thread giải mã frame mới nhất)
+        self._decode_pipeline: Optional[ViewerDecodePipeline] = None
+        self._viewer_display_size: Optional[tuple] = None
+
+        # Cây chuyển tiếp: phía host lập cây và giao con cho relay; phía viewer chuyển tiếp frame cho con
+        self.relay_mode = relay_mode
+        self._relay_coordinator = HostRelayCoordinator(
+            p2p_service, current_user_id,
+            RelayTreePlanner(config.LIVESTREAM_RELAY_DIRECT_FANOUT, config.LIVESTREAM_RELAY_FANOUT))
+        self._relay_forwarder = ViewerRelayForwarder(p2p_service, stall_timeout_ms=config.LIVESTREAM_RELAY_STALL_MS)
+        self._stream_uses_relay = False # Stream đang theo dõi có bật cây chuyển tiếp không (từ LIVESTREAM_START)
+        self._relay_report_timer = QTimer(self)
+        self._relay_report_timer.setInterval(config.LIVESTREAM_RELAY_REPORT_MS)
+        self._relay_report_timer.timeout.connect(self._send_relay_report)
+
+        # Âm thanh: thread thu riêng phía host; jitter buffer + đồng bộ tiếng-hình phía viewer
+        self.audio_source = audio_source
+        self._audio_thread: Optional[AudioCaptureThread] = None
+        self._audio_buffer: Optional[AudioPlayoutBuffer] = None
+        self._audio_player: Optional[AudioPlayer] = None
+
+    def start_hosting_livestream(self, camera_index=0, frame_source: Optional[FrameSource] = None):
         log_event(f"[LivestreamService] Attempting start_hosting_livestream (is_hosting={self.is_hosting})") # Log mới
         if self.is_hosting:
             log_event("[LivestreamService] Already hosting.")
@@ -113,6 +182,14 @@ class LivestreamService(QObject):
             log_event("[LivestreamService] Cannot host while viewing another stream.")
             self.livestream_error_signal.emit("Không thể host khi đang xem stream khác.")
             return
+        # Phân giải nguồn frame trước khi đổi trạng thái hay báo cho peer: cấu hình sai thì không bắt đầu stream
+        if frame_source is None and config.LIVESTREAM_FRAME_SOURCE:
+            try:
+                frame_source = create_frame_source(config.LIVESTREAM_FRAME_SOURCE)
+            except ValueError as e:
+                log_event(f"[LivestreamService] Invalid LIVESTREAM_FRAME_SOURCE {config.LIVESTREAM_FRAME_SOURCE!r}: {e}")
+                self.livestream_error_signal.emit(f"Nguồn video không hợp lệ: {config.LIVESTREAM_FRAME_SOURCE}")
+                return
 
         self.is_hosting = True
         self.active_streamer_id = self.current_user_id
@@ -122,66 +199,192 @@ class LivestreamService(QObject):
 
         # Thông báo cho các peer khác biết stream bắt đầu
         log_event("[LivestreamService] Creating LIVESTREAM_START payload...") # Log mới
-        start_payload = p2p_proto.create_livestream_start_payload(self.current_user_id, self.current_display_name)
+        start_payload = p2p_proto.create_livestream_start_payload(self.current_user_id, self.current_display_name,
+                                                                  relay=self.relay_mode)
         start_message = p2p_proto.create_message(p2p_proto.MSG_TYPE_LIVESTREAM_START, start_payload)
         log_event("[LivestreamService] Broadcasting LIVESTREAM_START message...") # Log mới
         asyncio.create_task(self.p2p_service.broadcast_message(start_message))
 
         # Khởi tạo và chạy thread camera
         log_event("[LivestreamService] Creating VideoCaptureThread...") # Log mới
-        self.capture_thread = VideoCaptureThread(camera_index)
-        self.capture_thread.new_cv_frame.connect(self._process_and_send_frame)
+        self.bitrate_controller.reset()
+        self.layer_selector.reset()
+        if self._encode_pipeline is None:
+            self._encode_pipeline = HostEncodePipeline(asyncio.get_event_loop(), self._encode_pool, self._on_frame_encoded,
+                                                       preview_max_width=config.LIVESTREAM_PREVIEW_MAX_WIDTH,
+                                                       delta_mode=self.delta_mode,
+                                                       tile_size=config.LIVESTREAM_DELTA_TILE_SIZE,
+                                                       keyframe_interval=config.LIVESTREAM_KEYFRAME_INTERVAL)
+        self._encode_pipeline.reset()
+        self._known_viewers.clear()
+        self._viewers_awaiting_keyframe.clear()
+        self._relay_coordinator.reset()
+        self._subscribers.clear()
+        self.capture_thread = VideoCaptureThread(camera_index, fps=self.bitrate_controller.current.fps,
+                                                 frame_sink=self._encode_pipeline.submit, source=frame_source)
         self.capture_thread.finished_capturing.connect(self._on_capture_finished)
         self.capture_thread.error_signal.connect(self._on_capture_error) # Kết nối signal lỗi
         log_event("[LivestreamService] Starting VideoCaptureThread...") # Log mới
         self.capture_thread.start()
+        self._apply_quality_rung(self.bitrate_controller.current)
+        self._abr_timer.start()
+        self._start_audio_capture()
 
         # Emit signal báo cho controller/UI biết stream đã bắt đầu (cục bộ)
         log_event("[LivestreamService] Emitting livestream_started_signal...") # Log mới
         self.livestream_started_signal.emit(self.current_user_id, self.current_display_name)
 
-    # **** THAY ĐỔI HÀM NÀY ĐỂ GỬI streamer_id ****
-    def _process_and_send_frame(self, cv_frame):
-        if not self.is_hosting or cv_frame is None:
+    def _start_audio_capture(self):
+        source = create_audio_source(self.audio_source, config.LIVESTREAM_AUDIO_SAMPLE_RATE,
+                                     config.LIVESTREAM_AUDIO_CHANNELS, config.LIVESTREAM_AUDIO_FRAME_MS)
+        if source is None:
+            log_event("[LivestreamService] No audio source; streaming video only.")
             return
-
-        # 1. Hiển thị preview cho host
+        loop = asyncio.get_event_loop()
+        def on_audio_frame(seq: int, timestamp_ms: int, pcm: bytes):
+            try:
+                loop.call_soon_threadsafe(self._on_audio_captured, seq, timestamp_ms, pcm, source)
+            except RuntimeError:
+                pass # Event loop đã đóng khi ứng dụng thoát
+        self._audio_thread = AudioCaptureThread(source, on_audio_frame)
+        self._audio_thread.start()
+
+    def _on_audio_captured(self, seq: int, timestamp_ms: int, pcm: bytes, source):
+        """Chạy trên event loop cho mỗi frame audio: encode một lần rồi đưa vào hàng đợi audio của từng viewer."""
+        if not self.is_hosting:
+            return
+        audio_payload = p2p_proto.create_audio_frame_payload(self.current_user_id, pcm, seq, timestamp_ms,
+                                                             source.sample_rate, source.channels)
+        audio_message = p2p_proto.PreEncodedMessage(p2p_proto.create_message(p2p_proto.MSG_TYPE_AUDIO_FRAME, audio_payload))
+        for peer_addr in self._subscriber_addresses():
+            if self.relay_mode and self._relay_coordinator.is_relayed(self.p2p_service.get_user_id_for_address(peer_addr)):
+                continue
+            self.p2p_service.send_audio_nowait(peer_addr, audio_message)
+
+    def _apply_quality_rung(self, rung: QualityRung):
+        """Áp dụng một bậc chất lượng cho encoder và thread camera, báo cho UI."""
+        self.jpeg_quality = rung.jpeg_quality
+        self.output_scale = rung.scale
+        if self.capture_thread:
+            self.capture_thread.set_fps(rung.fps)
+        if self._encode_pipeline:
+            self._encode_pipeline.set_layer_params(simulcast.resolve_layers(
+                self.simulcast_layers, self.jpeg_quality, self.output_scale, config.LIVESTREAM_JPEG_QUALITY_RANGE[0]))
+        self.quality_rung_changed.emit(self.bitrate_controller.index, rung.label())
+
+    @Slot()
+    def _evaluate_stream_quality(self):
+        """Chạy định kỳ khi đang host: đọc metrics hàng đợi gửi của các peer và đổi bậc nếu cần."""
+        if not self.is_hosting:
+            return
+        subscriber_addrs = self._subscriber_addresses()
+        peer_stats = {addr: stats for addr, stats in self.p2p_service.get_peer_stats().items() if addr in subscriber_addrs}
+        fps = self.capture_thread.fps if self.capture_thread else self.bitrate_controller.current.fps
+        layer_changes = self.layer_selector.update(peer_stats, fps)
+        if layer_changes and self._encode_pipeline:
+            # Viewer đổi lớp chỉ chuyển được tại keyframe: xin keyframe sớm thay vì chờ chu kỳ
+            self._viewers_awaiting_keyframe.update(layer_changes)
+            self._encode_pipeline.request_keyframe()
+        # Viewer yếu đã được chuyển xuống lớp thấp; bậc chung chỉ xét các viewer đang ở lớp cao nhất
+        top_layer_stats = {addr: stats for addr, stats in peer_stats.items() if self.layer_selector.target_layer(addr) == 0}
+        new_rung = self.bitrate_controller.update(top_layer_stats)
+        if new_rung is not None:
+            log_event(f"[LivestreamService][HOST] Quality rung changed to {new_rung.label()}")
+            self._apply_quality_rung(new_rung)
+        if self.relay_mode:
+            # RTT cho lần lập cây kế tiếp; cây hiện tại dùng RTT đo ở chu kỳ trước
+            asyncio.create_task(self.p2p_service.ping_peers())
+            self._relay_coordinator.update(peer_stats, self.layer_selector.get_stats())
+
+    def _subscriber_addresses(self) -> set:
+        """
+        Địa chỉ kết nối hiện tại của các viewer đã đăng ký. Nếu kết nối đã subscribe bị đóng nhưng
+        viewer vẫn còn kết nối khác thì chuyển sang kết nối đó.
+        """
+        connected_peers = self.p2p_service.get_connected_peers_addresses()
+        addresses = set()
+        for user_id, addr in list(self._subscribers.items()):
+            if addr not in connected_peers:
+                addr = self.p2p_service.find_address_for_user(user_id)
+                if addr is None:
+                    continue # Viewer đang mất kết nối; giữ đăng ký để nhận lại frame khi kết nối lại
+                self._subscribers[user_id] = addr
+            addresses.add(addr)
+        return addresses
+
+    def _on_frame_encoded(self, encoded: EncodedFrame):
+        """
+        Chạy trên event loop khi pipeline đã encode xong một frame: hiển thị preview (đã thu nhỏ)
+        và đưa JPEG của đúng lớp simulcast vào hàng đợi từng viewer.
+        """
+        if not self.is_hosting:
+            return
+        frame_id = encoded.frame_id
+        self.frame_id_counter = frame_id
         try:
-            rgb_image = cv2.cvtColor(cv_frame, cv2.COLOR_BGR2RGB)
-            h, w, ch = rgb_image.shape
-            bytes_per_line = ch * w
-            qt_image = QImage(rgb_image.data, w, h, bytes_per_line, QImage.Format_RGB888)
-            pixmap = QPixmap.fromImage(qt_image)
-            self.host_preview_frame.emit(pixmap)
+            # 1. Hiển thị preview cho host
+            if encoded.preview is not None and not encoded.preview.isNull():
+                self.host_preview_frame.emit(QPixmap.fromImage(encoded.preview))
+
+            # 2. Mỗi lớp là một PreEncodedMessage với JPEG thô (không base64): encode một lần,
+            #    dùng chung bytes cho mọi viewer cùng lớp. Peer chỉ hỗ trợ JSON-lines tự nhận base64.
+            layer_messages: List[Optional[p2p_proto.PreEncodedMessage]] = []
+            for layer_index, jpeg_bytes in enumerate(encoded.layers):
+                if jpeg_bytes is None:
+                    log_event(f"[LivestreamService][HOST] Failed to encode frame {frame_id} for layer {layer_index}.")
+                    layer_messages.append(None)
+                    continue
+                self.layer_selector.record_frame_size(layer_index, len(jpeg_bytes))
+                frame_payload = p2p_proto.create_raw_video_frame_payload(
+                    streamer_id=self.current_user_id,
+                    frame_bytes=jpeg_bytes,
+                    frame_id=frame_id,
+                    timestamp_ms=encoded.timestamp_ms,
+                    is_keyframe=encoded.layer_keyframes[layer_index] # Ngoài chế độ delta, mọi frame đều là keyframe
+                )
+                layer_messages.append(p2p_proto.PreEncodedMessage(
+                    p2p_proto.create_message(p2p_proto.MSG_TYPE_VIDEO_FRAME, frame_payload)))
+
+            # Đưa thẳng vào hàng đợi video có giới hạn của từng peer (không tạo task cho mỗi frame);
+            # peer chậm sẽ bị bỏ frame thay vì làm dồn ứ bộ nhớ
+            subscriber_addrs = self._subscriber_addresses()
+            self._known_viewers &= subscriber_addrs
+            self._viewers_awaiting_keyframe &= subscriber_addrs
+            for peer_addr in subscriber_addrs:
+                if self.relay_mode and self._relay_coordinator.is_relayed(self.p2p_service.get_user_id_for_address(peer_addr)):
+                    continue # Viewer này nhận frame qua relay
+                if peer_addr not in self._known_viewers:
+                    self._known_viewers.add(peer_addr)
+                    if self.delta_mode:
+                        self._viewers_awaiting_keyframe.add(peer_addr)
+                        self._encode_pipeline.request_keyframe()
+                target_keyframe = encoded.layer_keyframes[self.layer_selector.target_layer(peer_addr)]
+                layer_index = self.layer_selector.layer_for_frame(peer_addr, is_keyframe=target_keyframe)
+                is_keyframe = encoded.layer_keyframes[layer_index]
+                if peer_addr in self._viewers_awaiting_keyframe:
+                    if not is_keyframe:
+                        continue
+                    self._viewers_awaiting_keyframe.discard(peer_addr)
+                frame_message = layer_messages[layer_index]
+                if frame_message is None:
+                    if self.delta_mode:
+                        # Chuỗi delta của lớp này bị đứt: viewer phải chờ keyframe, không thay bằng lớp khác
+                        self._viewers_awaiting_keyframe.add(peer_addr)
+                        self._encode_pipeline.request_keyframe()
+                        continue
+                    frame_message = self._nearest_layer_message(layer_messages, layer_index)
+                if frame_message is not None:
+                    self.p2p_service.send_video_nowait(peer_addr, frame_message)
         except Exception as e:
-            log_event(f"[LivestreamService][HOST] Error converting frame for host preview: {e}")
-
-        # 2. Nén frame thành JPEG
-        try:
-            encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), self.jpeg_quality]
-            result, encoded_jpeg = cv2.imencode('.jpg', cv_frame, encode_param)
-            if not result:
-                log_event("[LivestreamService][HOST] Failed to encode frame to JPEG.")
-                return
+            log_event(f"[LivestreamService][HOST] Error processing or sending frame {frame_id}: {e}", exc_info=True)
 
-            # 3. Chuyển thành base64
-            frame_data_base64 = base64.b64encode(encoded_jpeg).decode('utf-8')
-
-            # 4. Tạo payload và gửi (THÊM streamer_id VÀO ĐÂY)
-            self.frame_id_counter += 1
-            frame_payload = p2p_proto.create_video_frame_payload(
-                streamer_id=self.current_user_id, # **** Thêm streamer_id ****
-                frame_data_base64=frame_data_base64,
-                frame_id=self.frame_id_counter
-            )
-            frame_message = p2p_proto.create_message(p2p_proto.MSG_TYPE_VIDEO_FRAME, frame_payload)
-
-            # Gửi bất đồng bộ
-            asyncio.create_task(self.p2p_service.broadcast_message(frame_message),
-                                name=f"SendVideoFrame_{self.frame_id_counter}")
-            # log_event(f"[LivestreamService][HOST] Sent video frame {self.frame_id_counter}") # Log nhiều quá
-        except Exception as e:
-            log_event(f"[LivestreamService][HOST] Error processing or sending frame: {e}", exc_info=True)
+    @staticmethod
+    def _nearest_layer_message(layer_messages: List[Optional[p2p_proto.PreEncodedMessage]], layer_index: int) -> Optional[p2p_proto.PreEncodedMessage]:
+        """Frame của lớp yêu cầu; nếu lớp đó encode lỗi thì lấy lớp thấp hơn gần nhất, rồi đến lớp cao hơn."""
+        for index in list(range(layer_index, len(layer_messages))) + list(range(layer_index - 1, -1, -1)):
+            if layer_messages[index] is not None:
+                return layer_messages[index]
+        return None
 
     @Slot(str)
     def _on_capture_error(self, error_message: str):
@@ -206,6 +409,12 @@ class LivestreamService(QObject):
 
         log_event(f"[LivestreamService] User {self.current_user_id} stopping livestream.")
         self.is_hosting = False # Đặt cờ trước
+        self._abr_timer.stop()
+        if self._encode_pipeline:
+            self._encode_pipeline.stop()
+        if self._audio_thread:
+            self._audio_thread.stop()
+            self._audio_thread = None
 
         # Dừng thread camera
         if self.capture_thread:
@@ -245,6 +454,7 @@ class LivestreamService(QObject):
                 log_event(f"[LivestreamService] Received LIVESTREAM_START from {streamer_name} ({streamer_id})")
                 self.active_streamer_id = streamer_id
                 self.active_streamer_name = streamer_name
+                self._stream_uses_relay = bool(payload.get("relay"))
                 # Không tự động đặt is_viewing = True ở đây, đợi người dùng chọn xem
                 # self.is_viewing = True
                 log_event(f"[LivestreamService][P2P_RECV] Emitting livestream_started_signal for {streamer_id}") # Log mới
@@ -257,6 +467,8 @@ class LivestreamService(QObject):
         elif msg_type == p2p_proto.MSG_TYPE_LIVESTREAM_END:
             streamer_id = payload.get("streamer_id")
             log_event(f"[LivestreamService][P2P_RECV] LIVESTREAM_END processing: streamer_id={streamer_id}") # Log mới
+            if streamer_id and streamer_id == self._relay_forwarder.streamer_id:
+                self._stop_relaying()
             if streamer_id and streamer_id == self.active_streamer_id: # Chỉ xử lý nếu đang xem stream này
                 log_event(f"[LivestreamService] Received LIVESTREAM_END from {self.active_streamer_name} ({streamer_id})")
                 if self.is_viewing: # Chỉ dừng xem nếu đang trong trạng thái xem
@@ -271,9 +483,43 @@ class LivestreamService(QObject):
             else:
                  log_event(f"[LivestreamService][P2P_RECV] Received LIVESTREAM_END for inactive/different streamer {streamer_id}. Ignoring.")
 
+        elif msg_type in (p2p_proto.MSG_TYPE_LIVESTREAM_SUBSCRIBE, p2p_proto.MSG_TYPE_LIVESTREAM_UNSUBSCRIBE):
+            viewer_id = self.p2p_service.get_user_id_for_address(peer_addr)
+            if not self.is_hosting or payload.get("streamer_id") != self.current_user_id:
+                return # Subscribe được broadcast khi viewer chưa có kết nối trực tiếp tới host
+            if not viewer_id:
+                log_event(f"[LivestreamService][HOST] Ignored {msg_type} from {peer_addr} before greeting.")
+                return
+            if msg_type == p2p_proto.MSG_TYPE_LIVESTREAM_SUBSCRIBE:
+                self._subscribers[viewer_id] = peer_addr
+                self._known_viewers.discard(peer_addr) # Coi như viewer mới: ở chế độ delta sẽ chờ keyframe
+                log_event(f"[LivestreamService][HOST] Viewer {viewer_id} subscribed ({len(self._subscribers)} viewers).")
+            else:
+                self._subscribers.pop(viewer_id, None)
+                log_event(f"[LivestreamService][HOST] Viewer {viewer_id} unsubscribed ({len(self._subscribers)} viewers).")
+
+        elif msg_type == p2p_proto.MSG_TYPE_RELAY_ASSIGN:
+            if self._relay_forwarder.handle_assign(self.p2p_service.get_user_id_for_address(peer_addr), payload):
+                self._relay_report_timer.start()
+            else:
+                log_event(f"[LivestreamService][P2P_RECV] Ignored stale or unauthorized relay_assign from {peer_addr}.")
+
+        elif msg_type == p2p_proto.MSG_TYPE_RELAY_REPORT:
+            reporter_id = self.p2p_service.get_user_id_for_address(peer_addr)
+            if self.is_hosting and self.relay_mode and reporter_id and payload.get("streamer_id") == self.current_user_id:
+                self._relay_coordinator.handle_report(reporter_id, payload)
+
+        elif msg_type == p2p_proto.MSG_TYPE_AUDIO_FRAME:
+            streamer_id = payload.get("streamer_id")
+            self._relay_forwarder.on_frame(streamer_id, message_dict)
+            if self.is_viewing and self.active_streamer_id == streamer_id and payload.get("audio_bytes") is not None:
+                self._play_audio_frame(payload)
+
         elif msg_type == p2p_proto.MSG_TYPE_VIDEO_FRAME:
             # Lấy streamer_id từ payload (quan trọng)
             streamer_id = payload.get("streamer_id")
+            # Chuyển tiếp cho các con được giao (kể cả khi không tự xem), trước khi giải mã
+            self._relay_forwarder.on_frame(streamer_id, message_dict)
 
             # *** Bỏ qua frame của chính mình ***
             if streamer_id and streamer_id == self.current_user_id:
@@ -283,43 +529,105 @@ class LivestreamService(QObject):
             # Log chi tiết hơn
             log_event(f"[LivestreamService][P2P_RECV] Received VIDEO_FRAME from alleged streamer {streamer_id}. is_viewing={self.is_viewing}, viewing_streamer_id={self.active_streamer_id}")
 
-            # Chỉ xử lý nếu đang trong trạng thái xem ĐÚNG stream này
-            if self.is_viewing and self.active_streamer_id == streamer_id and payload.get("frame_data"):
-                frame_id = payload.get("frame_id", "N/A")
-                # log_event(f"[LivestreamService][VIEWER] Processing VIDEO_FRAME (ID: {frame_id}) from {self.active_streamer_id}. Data length: {len(payload.get('frame_data'))}") # Log nhiều quá, bỏ bớt
+            # Frame nhị phân mang JPEG thô trong 'frame_bytes'; peer cũ gửi base64 trong 'frame_data'
+            has_frame_data = payload.get("frame_bytes") is not None or bool(payload.get("frame_data"))
+
+            # Chỉ xử lý nếu đang trong trạng thái xem ĐÚNG stream này. Callback đọc P2P chỉ đẩy JPEG vào
+            # jitter buffer; giải mã, chuyển màu và co giãn chạy trên thread giải mã của pipeline
+            if self.is_viewing and self.active_streamer_id == streamer_id and has_frame_data and self._decode_pipeline:
+                frame_id = payload.get("frame_id", 0)
                 try:
-                    frame_data_base64 = payload.get("frame_data")
-                    # log_event(f"[LivestreamService][VIEWER] Received frame_data (base64) length: {len(frame_data_base64)}") # Log kích thước nếu cần
-                    jpg_as_np = base64.b64decode(frame_data_base64)
-                    # log_event(f"[LivestreamService][VIEWER] Decoded base64 to JPEG bytes length: {len(jpg_as_np)}") # Log kích thước nếu cần
-                    frame = cv2.imdecode(np.frombuffer(jpg_as_np, dtype=np.uint8), cv2.IMREAD_COLOR)
-                    if frame is not None:
-                        # log_event(f"[LivestreamService][VIEWER] Frame decoded by OpenCV. Shape: {frame.shape}") # Log nếu cần
-                        # Chuyển sang QPixmap để hiển thị trên UI của viewer
-                        rgb_image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                        h, w, ch = rgb_image.shape
-                        bytes_per_line = ch * w
-                        qt_image = QImage(rgb_image.data, w, h, bytes_per_line, QImage.Format_RGB888)
-                        pixmap = QPixmap.fromImage(qt_image)
-                        if not pixmap.isNull():
-                            # log_event(f"[LivestreamService][VIEWER] QPixmap created, emitting viewer_new_frame. Size: {pixmap.size()}") # Log nếu cần
-                            self.viewer_new_frame.emit(pixmap)
-                            # log_event(f"[LivestreamService][VIEWER] Emitted viewer_new_frame for frame_id {frame_id}") # Log nếu cần
-                        else:
-                            log_event("[LivestreamService][VIEWER] ERROR: Created QPixmap is Null.")
-                    else:
-                        log_event("[LivestreamService][VIEWER] ERROR: Failed to decode frame (cv2.imdecode returned None).")
+                    jpg_bytes = payload.get("frame_bytes")
+                    if jpg_bytes is None:
+                        jpg_bytes = base64.b64decode(payload.get("frame_data"))
+                    self._decode_pipeline.push(frame_id, payload.get("timestamp_ms", 0), jpg_bytes,
+                                               is_keyframe=payload.get("keyframe", True))
                 except base64.binascii.Error as b64e: # Bắt lỗi decode base64 cụ thể
                      log_event(f"[LivestreamService][VIEWER] ERROR decoding base64 for frame {frame_id}: {b64e}")
                 except Exception as e:
-                    log_event(f"[LivestreamService][VIEWER] ERROR processing received video frame {frame_id}: {e}", exc_info=True)
+                    log_event(f"[LivestreamService][VIEWER] ERROR queueing received video frame {frame_id}: {e}", exc_info=True)
             elif not self.is_viewing:
                 log_event("[LivestreamService][P2P_RECV] Received video frame but not in viewing state. Ignoring.")
             elif self.active_streamer_id != streamer_id:
                 log_event(f"[LivestreamService][P2P_RECV] Received video frame from {streamer_id} but currently expecting frames from {self.active_streamer_id}. Ignoring.")
-            elif not payload.get("frame_data"):
-                log_event("[LivestreamService][P2P_RECV] Received video frame with empty 'frame_data'. Ignoring.")
+            elif not has_frame_data:
+                log_event("[LivestreamService][P2P_RECV] Received video frame with empty frame data. Ignoring.")
+
 
+    def _send_subscription(self, streamer_id: str, subscribe: bool):
+        """Gửi subscribe/unsubscribe tới host của stream (broadcast nếu chưa có kết nối trực tiếp)."""
+        msg_type = p2p_proto.MSG_TYPE_LIVESTREAM_SUBSCRIBE if subscribe else p2p_proto.MSG_TYPE_LIVESTREAM_UNSUBSCRIBE
+        message = p2p_proto.create_message(msg_type, p2p_proto.create_livestream_subscribe_payload(streamer_id))
+        host_addr = self.p2p_service.find_address_for_user(streamer_id)
+        if host_addr is not None:
+            asyncio.create_task(self.p2p_service.send_message(host_addr[0], host_addr[1], message))
+        else:
+            asyncio.create_task(self.p2p_service.broadcast_message(message))
+
+    @Slot()
+    def _send_relay_report(self):
+        """Định kỳ báo cho host các peer kết nối được, con không tới được và việc bị đứt frame."""
+        if self._relay_forwarder.streamer_id is None:
+            self._relay_report_timer.stop()
+            return
+        asyncio.create_task(self._relay_forwarder.send_report())
+
+    def _stop_relaying(self):
+        if self._relay_forwarder.streamer_id is not None:
+            log_event(f"[LivestreamService] Stopped relaying stream {self._relay_forwarder.streamer_id} "
+                      f"({self._relay_forwarder.forwarded_frames} frames forwarded).")
+        self._relay_forwarder.reset()
+        self._relay_report_timer.stop()
+
+    def _play_audio_frame(self, payload: dict):
+        """Đưa frame audio vào jitter buffer; tạo buffer/bộ phát ở frame đầu tiên hoặc khi định dạng đổi."""
+        sample_rate, channels = payload.get("sample_rate", 0), payload.get("channels", 0)
+        if payload.get("codec", p2p_proto.AUDIO_CODEC_PCM_S16LE) != p2p_proto.AUDIO_CODEC_PCM_S16LE or not sample_rate or not channels:
+            return
+        if self._audio_buffer is None or not self._audio_buffer.matches(sample_rate, channels):
+            self._stop_audio_playback()
+            frame_ms = max(1, round(len(payload["audio_bytes"]) / (2 * channels) * 1000 / sample_rate))
+            self._audio_buffer = AudioPlayoutBuffer(sample_rate, channels, frame_ms,
+                                                    target_delay_ms=config.LIVESTREAM_AUDIO_PLAYOUT_TARGET_MS,
+                                                    max_delay_ms=config.LIVESTREAM_AUDIO_PLAYOUT_MAX_MS)
+            self._audio_player = AudioPlayer(self._audio_buffer)
+            self._audio_player.start()
+            log_event(f"[LivestreamService][VIEWER] Audio playout started ({sample_rate} Hz x{channels}, {frame_ms} ms frames).")
+        self._audio_buffer.push(payload.get("seq", 0), payload.get("timestamp_ms", 0), bytes(payload["audio_bytes"]))
+
+    def _stop_audio_playback(self):
+        if self._audio_player:
+            self._audio_player.stop()
+            log_event(f"[LivestreamService][VIEW] Audio playout stats: {self._audio_buffer.get_stats()}")
+        self._audio_player = None
+        self._audio_buffer = None
+
+    def _on_frame_decoded(self, decoded: DecodedFrame):
+        """Chạy trên event loop khi thread giải mã đã có ảnh hoàn chỉnh cho frame mới nhất."""
+        if not self.is_viewing:
+            return
+        if self._audio_buffer and self._decode_pipeline:
+            # Tiếng được hoãn theo độ trễ hiển thị hình để khớp môi
+            self._audio_buffer.set_video_delay_ms(self._decode_pipeline.latency_ms)
+        pixmap = QPixmap.fromImage(decoded.image)
+        if not pixmap.isNull():
+            self.viewer_new_frame.emit(pixmap)
+        else:
+            log_event("[LivestreamService][VIEWER] ERROR: Created QPixmap is Null.")
+
+    @Slot(int, int)
+    def set_viewer_display_size(self, width: int, height: int):
+        """Kích thước khung hiển thị của viewer; thread giải mã co giãn frame sẵn theo kích thước này."""
+        self._viewer_display_size = (width, height) if width > 0 and height > 0 else None
+        if self._decode_pipeline:
+            self._decode_pipeline.display_size = self._viewer_display_size
+
+    def get_viewer_stats(self) -> dict:
+        """Bộ đếm của pipeline giải mã (thời gian giải mã, số frame bị bỏ, độ trễ đầu-cuối) và của bộ phát audio."""
+        stats = self._decode_pipeline.get_stats() if self._decode_pipeline else {}
+        if self._audio_buffer:
+            stats["audio"] = self._audio_buffer.get_stats()
+        return stats
 
     # **** THÊM LOGGING VÀO HÀM NÀY ****
     def start_viewing_livestream(self, streamer_id: str, streamer_name: str):
@@ -340,6 +648,16 @@ class LivestreamService(QObject):
         self.is_viewing = True
         self.active_streamer_id = streamer_id
         self.active_streamer_name = streamer_name
+        if self._decode_pipeline is None:
+            self._decode_pipeline = ViewerDecodePipeline(asyncio.get_event_loop(), self._on_frame_decoded)
+        self._decode_pipeline.display_size = self._viewer_display_size
+        self._decode_pipeline.start()
+        self._send_subscription(streamer_id, subscribe=True)
+        if self._stream_uses_relay:
+            # Báo cáo giúp host biết viewer này kết nối được với ai và có bị đứt frame qua relay không
+            if self._relay_forwarder.streamer_id != streamer_id:
+                self._relay_forwarder.reset(streamer_id)
+            self._relay_report_timer.start()
         log_event(f"[LivestreamService][VIEW] Now viewing: {self.active_streamer_name}. is_viewing={self.is_viewing}") # Log mới
         # UI sẽ mở cửa sổ viewer và lắng nghe signal viewer_new_frame
         return True
@@ -352,6 +670,13 @@ class LivestreamService(QObject):
         log_event(f"[LivestreamService] Stopping view of livestream from {self.active_streamer_name}.")
         streamer_id_being_stopped = self.active_streamer_id # Lưu lại để emit signal
         self.is_viewing = False
+        if self._decode_pipeline:
+            log_event(f"[LivestreamService][VIEW] Decode pipeline stats: {self._decode_pipeline.get_stats()}")
+            self._decode_pipeline.stop()
+        self._stop_audio_playback()
+        self._stop_relaying()
+        if streamer_id_being_stopped:
+            self._send_subscription(streamer_id_being_stopped, subscribe=False)
         self.active_streamer_id = None
         self.active_streamer_name = None
         # Emit signal để báo cho UI biết đã dừng xem (ví dụ: đóng cửa sổ viewer)
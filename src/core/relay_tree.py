@@ -0,0 +1,262 @@
+# src/core/relay_tree.py
+import asyncio
+import collections
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set
+
+from src.p2p import protocol as p2p_proto
+from src.utils.logger import log_event
+
+
+@dataclass
+class ViewerLink:
+    """Chất lượng đường truyền host đo được tới một viewer, và các peer mà viewer đó kết nối được."""
+    user_id: str
+    throughput_bps: float = 0.0
+    rtt_ms: Optional[float] = None
+    reachable: Set[str] = field(default_factory=set)
+    can_relay: bool = True # False nếu viewer vừa bị báo là relay hỏng
+
+    def score(self) -> float:
+        # Throughput cao, RTT thấp được ưu tiên làm relay ở tầng gần host
+        rtt = self.rtt_ms if self.rtt_ms is not None else 100.0
+        return self.throughput_bps / (1.0 + rtt / 50.0)
+
+
+class RelayTreePlanner:
+    """
+    Dựng cây chuyển tiếp livestream: host gửi trực tiếp cho tối đa direct_fanout viewer tốt nhất,
+    các viewer còn lại được gắn (theo chiều rộng, tầng nông trước) vào relay còn chỗ mà chúng có
+    kết nối tới. Viewer không gắn được vào relay nào sẽ nhận trực tiếp từ host.
+    """
+
+    def __init__(self, direct_fanout: int = 4, relay_fanout: int = 3):
+        self.direct_fanout = max(1, direct_fanout)
+        self.relay_fanout = max(1, relay_fanout)
+
+    def plan(self, viewers: Dict[str, ViewerLink]) -> Dict[str, Optional[str]]:
+        """Trả về {user_id viewer: user_id cha}; cha None nghĩa là nhận trực tiếp từ host."""
+        ranked = sorted(viewers.values(), key=lambda link: link.score(), reverse=True)
+        parents: Dict[str, Optional[str]] = {}
+        if len(ranked) <= self.direct_fanout:
+            return {link.user_id: None for link in ranked}
+
+        relays: collections.deque = collections.deque()
+        child_count: Dict[str, int] = {}
+        remaining: List[ViewerLink] = []
+        for link in ranked:
+            if link.can_relay and len(relays) < self.direct_fanout:
+                parents[link.user_id] = None
+                relays.append(link)
+                child_count[link.user_id] = 0
+            else:
+                remaining.append(link)
+
+        for link in remaining:
+            parent = self._find_parent(link, relays, child_count)
+            parents[link.user_id] = parent.user_id if parent else None
+            if parent is not None and link.can_relay:
+                relays.append(link)
+                child_count[link.user_id] = 0
+        return parents
+
+    def _find_parent(self, link: ViewerLink, relays: collections.deque,
+                     child_count: Dict[str, int]) -> Optional[ViewerLink]:
+        # relays giữ thứ tự theo tầng (BFS) nên relay đầu tiên còn chỗ là relay gần host nhất
+        for relay in relays:
+            if child_count[relay.user_id] < self.relay_fanout and link.user_id in relay.reachable:
+                child_count[relay.user_id] += 1
+                return relay
+        return None
+
+
+def children_by_parent(parents: Dict[str, Optional[str]]) -> Dict[str, List[str]]:
+    """Đảo bản đồ cha -> danh sách con (chỉ các relay, bỏ host)."""
+    children: Dict[str, List[str]] = {}
+    for child, parent in parents.items():
+        if parent is not None:
+            children.setdefault(parent, []).append(child)
+    for child_list in children.values():
+        child_list.sort()
+    return children
+
+
+class HostRelayCoordinator:
+    """
+    Phía host: dựng lại cây chuyển tiếp mỗi chu kỳ từ metrics gửi (throughput, RTT) và báo cáo của viewer,
+    gửi relay_assign cho relay có danh sách con thay đổi. Relay rớt kết nối biến mất khỏi metrics nên
+    con của nó tự được gắn lại (re-parent) ở chu kỳ kế tiếp; relay bị con báo đứt frame thì bị loại
+    khỏi vai trò relay trong một thời gian.
+    """
+
+    def __init__(self, p2p_service, streamer_id: str, planner: Optional[RelayTreePlanner] = None,
+                 bad_relay_cooldown_s: float = 10.0):
+        self.p2p_service = p2p_service
+        self.streamer_id = streamer_id
+        self.planner = planner or RelayTreePlanner()
+        self.bad_relay_cooldown_s = bad_relay_cooldown_s
+        self._parents: Dict[str, Optional[str]] = {}
+        self._assigned_children: Dict[str, List[str]] = {}
+        self._reachable: Dict[str, Set[str]] = {}
+        self._bad_relays: Dict[str, float] = {} # user_id -> thời điểm hết bị loại
+        self._epoch = 0
+        self.reparent_count = 0
+
+    def reset(self):
+        self._parents.clear()
+        self._assigned_children.clear()
+        self._reachable.clear()
+        self._bad_relays.clear()
+        self.reparent_count = 0
+
+    def is_relayed(self, user_id: Optional[str]) -> bool:
+        """True nếu viewer đang nhận frame qua một relay (host không gửi trực tiếp)."""
+        return user_id is not None and self._parents.get(user_id) is not None
+
+    def handle_report(self, user_id: str, payload: Dict):
+        """Cập nhật từ relay_report của viewer."""
+        self._reachable[user_id] = set(payload.get("reachable") or [])
+        for missing in payload.get("missing_children") or []:
+            self._reachable[user_id].discard(missing)
+        if payload.get("stalled"):
+            parent = self._parents.get(user_id)
+            if parent is not None:
+                log_event(f"[RELAY] Viewer {user_id} stalled behind relay {parent}. Excluding relay for {self.bad_relay_cooldown_s:.0f}s.")
+                self._bad_relays[parent] = time.monotonic() + self.bad_relay_cooldown_s
+
+    def update(self, peer_stats: Dict, layer_stats: Dict) -> None:
+        """Lập lại cây từ metrics hiện tại và gửi relay_assign cho các relay có thay đổi."""
+        now = time.monotonic()
+        for user_id in [uid for uid, until in self._bad_relays.items() if until <= now]:
+            del self._bad_relays[user_id]
+
+        viewers: Dict[str, ViewerLink] = {}
+        addresses: Dict[str, tuple] = {}
+        for addr, stats in peer_stats.items():
+            user_id = stats.get("peer_user_id")
+            if not user_id or user_id in viewers:
+                continue # Chưa greeting, hoặc kết nối thứ hai tới cùng một viewer
+            addresses[user_id] = addr
+            viewers[user_id] = ViewerLink(
+                user_id=user_id,
+                throughput_bps=layer_stats.get(addr, {}).get("throughput_bps", 0.0),
+                rtt_ms=stats.get("rtt_ms"),
+                reachable=self._reachable.get(user_id, set()),
+                can_relay=user_id not in self._bad_relays,
+            )
+
+        new_parents = self.planner.plan(viewers)
+        self.reparent_count += sum(1 for uid, parent in new_parents.items()
+                                   if uid in self._parents and self._parents[uid] != parent)
+        new_children = children_by_parent(new_parents)
+        self._parents = new_parents
+
+        # Chỉ gửi cho relay có danh sách con thay đổi (kể cả relay vừa mất hết con)
+        for relay_id in set(new_children) | set(self._assigned_children):
+            children = new_children.get(relay_id, [])
+            if self._assigned_children.get(relay_id, []) == children:
+                continue
+            address = addresses.get(relay_id)
+            if address is None:
+                self._assigned_children.pop(relay_id, None) # Relay đã rớt
+                continue
+            self._epoch += 1
+            assign = p2p_proto.create_message(p2p_proto.MSG_TYPE_RELAY_ASSIGN,
+                                              p2p_proto.create_relay_assign_payload(self.streamer_id, children, self._epoch))
+            asyncio.create_task(self.p2p_service.send_message(address[0], address[1], assign), name=f"RelayAssign_{relay_id}")
+            if children:
+                self._assigned_children[relay_id] = children
+            else:
+                self._assigned_children.pop(relay_id, None)
+            log_event(f"[RELAY] Assigned {len(children)} children to relay {relay_id}: {children}")
+
+    def get_stats(self) -> Dict:
+        return {
+            "direct_viewers": sum(1 for parent in self._parents.values() if parent is None),
+            "relayed_viewers": sum(1 for parent in self._parents.values() if parent is not None),
+            "relays": len(self._assigned_children),
+            "bad_relays": len(self._bad_relays),
+            "reparent_count": self.reparent_count,
+        }
+
+
+class ViewerRelayForwarder:
+    """
+    Phía viewer: giữ danh sách con do host giao và chuyển tiếp nguyên frame đã encode (không giải mã,
+    không encode lại JPEG) tới từng con; đồng thời gửi relay_report định kỳ cho host.
+    """
+
+    def __init__(self, p2p_service, stall_timeout_ms: int = 3000):
+        self.p2p_service = p2p_service
+        self.stall_timeout_ms = stall_timeout_ms
+        self.streamer_id: Optional[str] = None
+        self.children: List[str] = []
+        self._epoch = -1
+        self._missing_children: Set[str] = set()
+        self._last_frame_at: Optional[float] = None
+        self.forwarded_frames = 0
+
+    def reset(self, streamer_id: Optional[str] = None):
+        self.streamer_id = streamer_id
+        self.children = []
+        self._epoch = -1
+        self._missing_children.clear()
+        self._last_frame_at = time.monotonic() if streamer_id else None
+        self.forwarded_frames = 0
+
+    def handle_assign(self, from_user_id: Optional[str], payload: Dict) -> bool:
+        """Nhận relay_assign; chỉ chấp nhận từ chính host của stream và theo epoch tăng dần."""
+        streamer_id = payload.get("streamer_id")
+        epoch = payload.get("epoch", 0)
+        if not streamer_id or from_user_id != streamer_id:
+            return False
+        if streamer_id != self.streamer_id:
+            self.reset(streamer_id)
+        if epoch <= self._epoch:
+            return False
+        self._epoch = epoch
+        self.children = [child for child in payload.get("children") or [] if isinstance(child, str)]
+        self._missing_children.clear()
+        log_event(f"[RELAY] Now relaying stream {streamer_id} to {len(self.children)} children: {self.children}")
+        return True
+
+    def on_frame(self, streamer_id: str, message_dict: Dict):
+        """
+        Gọi cho mỗi video_frame/audio_frame của stream đang theo dõi: ghi nhận thời điểm nhận video
+        và chuyển tiếp cho các con.
+        """
+        if streamer_id != self.streamer_id:
+            return
+        is_audio = message_dict.get("type") == p2p_proto.MSG_TYPE_AUDIO_FRAME
+        if not is_audio:
+            self._last_frame_at = time.monotonic()
+        if not self.children:
+            return
+        # Encode một lần (chỉ ghép header + dữ liệu nhận được), dùng chung cho mọi con
+        frame_message = p2p_proto.PreEncodedMessage(message_dict)
+        send = self.p2p_service.send_audio_nowait if is_audio else self.p2p_service.send_video_nowait
+        for child_id in self.children:
+            child_addr = self.p2p_service.find_address_for_user(child_id)
+            if child_addr is None:
+                self._missing_children.add(child_id)
+                continue
+            send(child_addr, frame_message)
+        if not is_audio:
+            self.forwarded_frames += 1
+
+    def is_stalled(self) -> bool:
+        return self._last_frame_at is not None and (time.monotonic() - self._last_frame_at) * 1000 > self.stall_timeout_ms
+
+    async def send_report(self):
+        """Gửi relay_report cho host: peer kết nối được, con không tới được, có bị đứt frame không."""
+        if not self.streamer_id:
+            return
+        host_addr = self.p2p_service.find_address_for_user(self.streamer_id)
+        if host_addr is None:
+            return
+        payload = p2p_proto.create_relay_report_payload(
+            self.streamer_id, sorted(self.p2p_service.get_connected_user_ids()),
+            sorted(self._missing_children), self.is_stalled())
+        await self.p2p_service.send_message(host_addr[0], host_addr[1],
+                                            p2p_proto.create_message(p2p_proto.MSG_TYPE_RELAY_REPORT, payload))
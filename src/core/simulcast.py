@@ -0,0 +1,144 @@
+# src/core/simulcast.py
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import cv2 # OpenCV nhả GIL khi resize/imencode nên encode song song bằng thread được
+
+from src.core.adaptive_bitrate import DEFAULT_CONGESTION_THRESHOLDS, CongestionThresholds, CongestionTracker
+from src.utils.logger import log_event
+
+
+@dataclass(frozen=True)
+class SimulcastLayer:
+    """Một lớp simulcast, tính tương đối so với bậc chất lượng hiện tại của bộ điều chỉnh thích ứng."""
+    scale: float         # Tỉ lệ độ phân giải so với bậc hiện tại
+    quality_drop: int    # Số điểm chất lượng JPEG giảm so với bậc hiện tại
+
+    def resolve(self, base_quality: int, base_scale: float, min_quality: int) -> Tuple[float, int]:
+        """Trả về (tỉ lệ so với frame gốc, chất lượng JPEG) thực tế của lớp."""
+        return base_scale * self.scale, max(min_quality, base_quality - self.quality_drop)
+
+
+def encode_jpeg(cv_frame, scale: float, quality: int) -> Optional[memoryview]:
+    """Thu nhỏ (nếu cần) và nén JPEG một frame. Chạy trong thread pool, không chạm tới Qt."""
+    if scale < 1.0:
+        cv_frame = cv2.resize(cv_frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    result, encoded_jpeg = cv2.imencode('.jpg', cv_frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    if not result:
+        return None
+    return memoryview(encoded_jpeg.reshape(-1)) # Không copy; protocol ghép thẳng vào frame nhị phân
+
+
+class _ViewerLayerState:
+    __slots__ = ("target_layer", "active_layer", "congestion", "last_sent_bytes", "last_drops", "last_time", "throughput_bps")
+
+    def __init__(self, start_layer: int, stats: Dict[str, Any], thresholds: CongestionThresholds):
+        self.target_layer = start_layer
+        self.active_layer = start_layer
+        self.congestion = CongestionTracker(thresholds)
+        self.last_sent_bytes = stats.get("sent_bytes", 0)
+        self.last_drops = stats.get("dropped_video_frames", 0)
+        self.last_time = time.monotonic()
+        self.throughput_bps = 0.0
+
+
+class SimulcastLayerSelector:
+    """
+    Chọn lớp simulcast cho từng viewer dựa trên throughput đo được (bytes đã gửi mỗi giây)
+    và tình trạng hàng đợi gửi. Khi nghẽn, viewer được chuyển xuống lớp cao nhất mà throughput
+    hiện tại gánh được; khi khỏe vài chu kỳ liên tiếp thì thử nâng một lớp.
+    Lớp chỉ thực sự đổi ở keyframe (layer_for_frame) để viewer không nhận frame delta lệch lớp.
+    """
+
+    def __init__(self, layer_count: int, thresholds: CongestionThresholds = DEFAULT_CONGESTION_THRESHOLDS,
+                 headroom: float = 0.85):
+        if layer_count < 1:
+            raise ValueError("Simulcast needs at least one layer")
+        self.layer_count = layer_count
+        self.thresholds = thresholds
+        self.headroom = headroom # Chỉ dùng một phần throughput đo được để chừa chỗ cho chat/control
+        self._viewers: Dict[Any, _ViewerLayerState] = {}
+        self._layer_frame_bytes: List[float] = [0.0] * layer_count # EWMA kích thước frame mỗi lớp
+
+    def reset(self):
+        self._viewers.clear()
+        self._layer_frame_bytes = [0.0] * self.layer_count
+
+    def record_frame_size(self, layer_index: int, size: int):
+        """Ghi nhận kích thước một frame đã encode của lớp để ước lượng bitrate cần thiết."""
+        previous = self._layer_frame_bytes[layer_index]
+        self._layer_frame_bytes[layer_index] = size if previous == 0 else previous + 0.2 * (size - previous)
+
+    def layer_bitrate_bps(self, layer_index: int, fps: float) -> float:
+        return self._layer_frame_bytes[layer_index] * fps
+
+    def target_layer(self, peer_key: Any) -> int:
+        state = self._viewers.get(peer_key)
+        return state.target_layer if state else 0
+
+    def layer_for_frame(self, peer_key: Any, is_keyframe: bool) -> int:
+        """Lớp dùng cho frame sắp gửi tới viewer; chỉ chuyển sang lớp mục tiêu tại keyframe."""
+        state = self._viewers.get(peer_key)
+        if state is None:
+            return 0
+        if is_keyframe and state.active_layer != state.target_layer:
+            state.active_layer = state.target_layer
+        return state.active_layer
+
+    def update(self, peer_stats: Dict[Any, Dict[str, Any]], fps: float) -> Dict[Any, int]:
+        """Đánh giá một chu kỳ cho mọi viewer. Trả về {peer: lớp mục tiêu mới} cho các viewer đổi lớp."""
+        now = time.monotonic()
+        changes: Dict[Any, int] = {}
+        for peer_key in list(self._viewers):
+            if peer_key not in peer_stats:
+                del self._viewers[peer_key]
+
+        for peer_key, stats in peer_stats.items():
+            state = self._viewers.get(peer_key)
+            if state is None:
+                self._viewers[peer_key] = _ViewerLayerState(0, stats, self.thresholds)
+                continue
+            elapsed = max(now - state.last_time, 1e-3)
+            sent_bytes = stats.get("sent_bytes", 0)
+            dropped = stats.get("dropped_video_frames", 0)
+            state.throughput_bps = (sent_bytes - state.last_sent_bytes) / elapsed
+            new_drops = max(0, dropped - state.last_drops)
+            state.last_sent_bytes, state.last_drops, state.last_time = sent_bytes, dropped, now
+
+            latency = stats.get("queue_latency_ms", 0.0)
+            drain = stats.get("drain_ms", 0.0)
+            previous_target = state.target_layer
+            verdict = state.congestion.evaluate(latency, drain, new_drops)
+            if verdict == CongestionTracker.CONGESTED:
+                state.target_layer = self._sustainable_layer(state, fps)
+                if state.target_layer != previous_target:
+                    state.congestion.stepped_down()
+            elif verdict == CongestionTracker.STEP_UP and state.target_layer > 0:
+                state.target_layer -= 1
+                state.congestion.stepped_up()
+
+            if state.target_layer != previous_target:
+                changes[peer_key] = state.target_layer
+                log_event(f"[SIMULCAST] Viewer {peer_key} layer {previous_target} -> {state.target_layer} (throughput={state.throughput_bps / 1024:.0f}KB/s, latency={latency:.1f}ms, drops={new_drops})")
+        return changes
+
+    def _sustainable_layer(self, state: _ViewerLayerState, fps: float) -> int:
+        """Lớp tốt nhất mà throughput đo được gánh nổi; tối thiểu thấp hơn lớp hiện tại một bậc."""
+        budget = state.throughput_bps * self.headroom
+        layer = min(state.target_layer + 1, self.layer_count - 1)
+        for candidate in range(layer, self.layer_count):
+            layer = candidate
+            if self.layer_bitrate_bps(candidate, fps) <= budget:
+                break
+        return layer
+
+    def get_stats(self) -> Dict[Any, Dict[str, Any]]:
+        return {peer_key: {"target_layer": state.target_layer, "active_layer": state.active_layer,
+                           "throughput_bps": round(state.throughput_bps)}
+                for peer_key, state in self._viewers.items()}
+
+
+def resolve_layers(layers: Sequence[SimulcastLayer], base_quality: int, base_scale: float, min_quality: int) -> List[Tuple[float, int]]:
+    """Danh sách (tỉ lệ, chất lượng) thực tế của từng lớp cho bậc chất lượng hiện tại."""
+    return [layer.resolve(base_quality, base_scale, min_quality) for layer in layers]
@@ -1,23 +1,76 @@
 # src/core/sync_service.py
 import asyncio
 import datetime
-from typing import TYPE_CHECKING, Optional, List
+from typing import TYPE_CHECKING, Any, Dict, Optional, List, Tuple
 from src.api import database as api_db
-from src.storage.local_storage_service import LocalStorageService
+from src.storage.local_storage_service import AsyncLocalStorageService
 from src.p2p.p2p_service import P2PService
+from src.p2p import protocol as p2p_proto
 from src.models.message import Message
 from src.utils.logger import log_event
+import config
 
 if TYPE_CHECKING:
     from .app_controller import AppController
 
+_HISTORY_MESSAGE_OVERHEAD_BYTES = 200 # Ước lượng phần khung JSON của mỗi tin nhắn trong res_history
+_HISTORY_MAX_INITIAL_LIMIT = 1000 # Giới hạn 'limit' peer được yêu cầu (phần này nằm trong bộ nhớ của host)
+
+
+def _parse_timestamp_iso(timestamp_iso: Optional[str]) -> Optional[datetime.datetime]:
+    if not timestamp_iso:
+        return None
+    try:
+        timestamp = datetime.datetime.fromisoformat(timestamp_iso.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=datetime.timezone.utc)
+
+
+def message_to_history_dict(message: Message) -> Dict[str, Any]:
+    """Một tin nhắn trong payload res_history."""
+    return {
+        "id": message.id,
+        "user_id": message.user_id,
+        "content": message.content,
+        "timestamp_iso": message.timestamp.astimezone(datetime.timezone.utc).isoformat(),
+        "sender_display_name": message.sender_display_name,
+    }
+
+
+def message_from_history_dict(channel_id: str, data: Dict[str, Any]) -> Optional[Message]:
+    """Ngược lại với message_to_history_dict; None nếu dữ liệu thiếu trường bắt buộc."""
+    timestamp = _parse_timestamp_iso(data.get("timestamp_iso"))
+    if not data.get("user_id") or data.get("content") is None or timestamp is None:
+        return None
+    return Message(channel_id=channel_id, user_id=data["user_id"], content=data["content"], timestamp=timestamp,
+                   id=data.get("id"), sender_display_name=data.get("sender_display_name"))
+
+
+class _HistoryTransfer:
+    """Trạng thái một lần tải lịch sử từ host (phía peer thành viên), đủ để tải tiếp khi bị ngắt."""
+    __slots__ = ("host_user_id", "cursor_timestamp_iso", "cursor_id", "until_timestamp_iso", "received", "complete",
+                 "first_chunk")
+
+    def __init__(self, host_user_id: str):
+        self.host_user_id = host_user_id
+        self.cursor_timestamp_iso: Optional[str] = None # Mốc (timestamp, id) của tin nhắn cuối cùng đã nhận
+        self.cursor_id: Optional[str] = None
+        self.until_timestamp_iso: Optional[str] = None # Mốc trên của host ở lần tải đầu, giữ nguyên khi tải tiếp
+        self.received = 0
+        self.complete = False
+        self.first_chunk = asyncio.Event()
+
+
 class SyncService:
     """Xử lý logic đồng bộ hóa dữ liệu."""
 
-    def __init__(self, controller: 'AppController', local_storage: LocalStorageService, p2p_service: P2PService):
+    def __init__(self, controller: 'AppController', local_storage: AsyncLocalStorageService, p2p_service: P2PService):
         self.controller = controller
         self.local_storage = local_storage
         self.p2p_service = p2p_service
+        self._history_transfers: Dict[str, _HistoryTransfer] = {} # channel_id -> lần tải lịch sử từ host
+        self._history_serving: Dict[Tuple[Tuple[str, int], str], asyncio.Task] = {} # (peer_addr, channel_id) -> task gửi
         log_event("[SYNC_SVC] Initialized.")
 
     async def backup_message_to_server(self, message: Message):
@@ -67,16 +120,8 @@ class SyncService:
                 server_messages = await api_db.get_message_backups(channel_id, limit=200) # Lấy nhiều hơn chút
                 log_event(f"[SYNC_SVC][HOST] Fetched {len(server_messages)} messages from server.")
 
-                new_messages_added = 0
-                # TODO: Chạy local_storage trong thread
-                for msg in reversed(server_messages):
-                    # Cần hàm kiểm tra message tồn tại bằng ID trong local_store
-                    # if not self.local_storage.message_exists(msg.id):
-                    #     if self.local_storage.add_message(msg):
-                    #         new_messages_added += 1
-                    # Tạm thời cứ add
-                    if self.local_storage.add_message(msg):
-                        new_messages_added += 1
+                # INSERT OR REPLACE theo id nên message đã có không bị nhân đôi; cả lô ghi trong một transaction
+                new_messages_added = await self.local_storage.add_messages(list(reversed(server_messages)))
 
                 log_event(f"[SYNC_SVC][HOST] Added {new_messages_added} messages from server backup to local store.")
                 # TODO: Có thể cần emit signal để UI refresh nếu có message mới từ server
@@ -95,4 +140,182 @@ class SyncService:
 
         except Exception as e:
              log_event(f"[ERROR][SYNC_SVC] Error during basic sync for channel {channel_id}: {e}")
-             self.controller.status_update_signal.emit("Lỗi đồng bộ hóa.")
\ No newline at end of file
+             self.controller.status_update_signal.emit("Lỗi đồng bộ hóa.")
+
+    # --- Lịch sử kênh qua P2P: phía host ---
+    def _is_hosting_channel(self, channel_id: str) -> bool:
+        current_user = self.controller.current_user
+        if not current_user or not channel_id:
+            return False
+        current_channel = self.controller.current_channel
+        channel = current_channel if current_channel and current_channel.id == channel_id \
+            else self.controller._find_channel_by_id(channel_id)
+        return bool(channel and channel.owner_id == current_user.id)
+
+    def serve_history_request(self, peer_addr: Tuple[str, int], payload: Dict[str, Any]):
+        """
+        Xử lý req_history từ một peer: nếu mình là host của kênh, gửi lịch sử từ local store
+        trong một task riêng. Yêu cầu mới cho cùng kênh từ cùng peer thay thế lần gửi đang chạy.
+        """
+        channel_id = payload.get("channel_id")
+        if not self._is_hosting_channel(channel_id):
+            log_event(f"[WARN][SYNC_SVC] Ignoring history request for channel {channel_id} from {peer_addr}: not the host.")
+            return
+        key = (peer_addr, channel_id)
+        previous = self._history_serving.get(key)
+        if previous and not previous.done():
+            previous.cancel()
+        task = asyncio.create_task(self._stream_history(peer_addr, channel_id, payload),
+                                   name=f"ServeHistory_{peer_addr[0]}:{peer_addr[1]}_{channel_id}")
+        self._history_serving[key] = task
+        task.add_done_callback(lambda done, key=key: self._history_serving.pop(key, None)
+                               if self._history_serving.get(key) is done else None)
+
+    async def _stream_history(self, peer_addr: Tuple[str, int], channel_id: str, payload: Dict[str, Any]):
+        """
+        Gửi lịch sử theo từng phần (res_history, lớp ưu tiên bulk). Sau mỗi phần chờ hàng đợi bulk của
+        kết nối trống rồi nghỉ một chút, nên chat/control trên cùng kết nối luôn chỉ phải chờ tối đa một phần.
+        Chỉ gửi tin nhắn có từ trước lúc nhận yêu cầu đầu tiên (tải tiếp dùng lại mốc until_timestamp_iso
+        của lần đó); tin nhắn mới hơn peer đã nhận qua broadcast chat.
+        """
+        since = _parse_timestamp_iso(payload.get("since_timestamp_iso"))
+        since_id = payload.get("since_id") if since else None
+        chunk_messages = max(1, config.P2P_HISTORY_CHUNK_MESSAGES)
+        requested_at = datetime.datetime.now(datetime.timezone.utc)
+        until = _parse_timestamp_iso(payload.get("until_timestamp_iso")) if since else None
+        if until is not None:
+            requested_at = min(requested_at, until)
+        requested_at_iso = requested_at.isoformat()
+        if since is None:
+            # Chưa có mốc: chỉ gửi 'limit' tin nhắn mới nhất (đã nằm gọn trong bộ nhớ)
+            limit = payload.get("limit")
+            limit = min(limit, _HISTORY_MAX_INITIAL_LIMIT) if isinstance(limit, int) and limit > 0 \
+                else config.P2P_HISTORY_INITIAL_LIMIT
+            pending = await self.local_storage.get_messages(channel_id, limit=limit)
+            exhausted = True
+        else:
+            pending, exhausted = [], False
+        cursor_ts, cursor_id = since, since_id
+        sent_messages = sent_chunks = 0
+        log_event(f"[SYNC_SVC][HOST] Serving history of channel {channel_id} to {peer_addr} "
+                  f"(since={payload.get('since_timestamp_iso')}).")
+        try:
+            while True:
+                if not pending and not exhausted:
+                    page = await self.local_storage.get_messages_after(channel_id, cursor_ts, cursor_id, chunk_messages)
+                    exhausted = len(page) < chunk_messages
+                    if page:
+                        cursor_ts, cursor_id = page[-1].timestamp, page[-1].id
+                    pending = [message for message in page if message.timestamp <= requested_at]
+                    exhausted = exhausted or len(pending) < len(page)
+                chunk, pending = self._take_history_chunk(pending, chunk_messages)
+                is_last_chunk = exhausted and not pending
+                message = p2p_proto.create_message(p2p_proto.MSG_TYPE_HISTORY_CHUNK, p2p_proto.create_history_chunk_payload(
+                    channel_id, [message_to_history_dict(item) for item in chunk], is_last_chunk, requested_at_iso))
+                if peer_addr not in self.p2p_service.get_connected_peers_addresses() or \
+                        not await self.p2p_service.send_message(peer_addr[0], peer_addr[1], message):
+                    log_event(f"[WARN][SYNC_SVC][HOST] Connection to {peer_addr} lost while serving history "
+                              f"of {channel_id} after {sent_messages} messages; the peer can resume.")
+                    return
+                sent_messages += len(chunk)
+                sent_chunks += 1
+                if is_last_chunk:
+                    break
+                if not await self.p2p_service.wait_bulk_drained(peer_addr):
+                    return
+                await asyncio.sleep(config.P2P_HISTORY_CHUNK_INTERVAL_MS / 1000.0)
+            log_event(f"[SYNC_SVC][HOST] Served {sent_messages} messages of channel {channel_id} "
+                      f"to {peer_addr} in {sent_chunks} chunks.")
+        except asyncio.CancelledError:
+            log_event(f"[SYNC_SVC][HOST] History transfer of {channel_id} to {peer_addr} superseded by a new request.")
+            raise
+        except Exception as e:
+            log_event(f"[ERROR][SYNC_SVC][HOST] Error serving history of {channel_id} to {peer_addr}: {e}", exc_info=True)
+
+    @staticmethod
+    def _take_history_chunk(messages: List[Message], max_messages: int) -> Tuple[List[Message], List[Message]]:
+        """Tách phần đầu của messages thành một chunk giới hạn theo số tin nhắn và số byte ước lượng."""
+        budget = config.P2P_HISTORY_CHUNK_MAX_BYTES
+        size = 0
+        count = 0
+        for message in messages[:max_messages]:
+            size += len(message.content or "") + _HISTORY_MESSAGE_OVERHEAD_BYTES
+            if count and size > budget:
+                break
+            count += 1
+        return messages[:count], messages[count:]
+
+    # --- Lịch sử kênh qua P2P: phía thành viên ---
+    def _find_host_address(self, host_user_id: str) -> Optional[Tuple[str, int]]:
+        addr = self.p2p_service.find_address_for_user(host_user_id)
+        if addr is None:
+            peer = self.controller.peer_manager.find_peer_by_user_id(host_user_id)
+            if peer and peer.ip_address and peer.port:
+                addr = peer.get_address_tuple()
+        return addr
+
+    async def request_history_from_host(self, channel_id: str, host_user_id: str) -> bool:
+        """
+        Yêu cầu host gửi lịch sử kênh qua P2P (các phần đến qua handle_history_chunk và được hiển thị ngay).
+        Trả về True nếu phần đầu tiên đến trong P2P_HISTORY_REQUEST_TIMEOUT_S; False để người gọi tải từ server.
+        """
+        transfer = _HistoryTransfer(host_user_id)
+        self._history_transfers[channel_id] = transfer
+        if not await self._send_history_request(channel_id, transfer):
+            return False
+        try:
+            await asyncio.wait_for(transfer.first_chunk.wait(), config.P2P_HISTORY_REQUEST_TIMEOUT_S)
+            return True
+        except asyncio.TimeoutError:
+            log_event(f"[WARN][SYNC_SVC] Host {host_user_id} did not answer history request for {channel_id}.")
+            if self._history_transfers.get(channel_id) is transfer:
+                del self._history_transfers[channel_id]
+            return False
+
+    async def _send_history_request(self, channel_id: str, transfer: _HistoryTransfer) -> bool:
+        host_addr = self._find_host_address(transfer.host_user_id)
+        if host_addr is None:
+            log_event(f"[SYNC_SVC] No P2P address for host {transfer.host_user_id} of channel {channel_id}.")
+            return False
+        payload = p2p_proto.create_history_request_payload(
+            channel_id, transfer.cursor_timestamp_iso, transfer.cursor_id,
+            None if transfer.cursor_timestamp_iso else config.P2P_HISTORY_INITIAL_LIMIT,
+            transfer.until_timestamp_iso if transfer.cursor_timestamp_iso else None)
+        log_event(f"[SYNC_SVC] Requesting history of {channel_id} from host at {host_addr} "
+                  f"(since={transfer.cursor_timestamp_iso}).")
+        return await self.p2p_service.send_message(host_addr[0], host_addr[1], p2p_proto.create_message(
+            p2p_proto.MSG_TYPE_REQUEST_HISTORY, payload))
+
+    def handle_history_chunk(self, peer_addr: Tuple[str, int], payload: Dict[str, Any]):
+        """Hiển thị một phần lịch sử từ host và ghi lại mốc để tải tiếp nếu kết nối bị ngắt."""
+        channel_id = payload.get("channel_id")
+        transfer = self._history_transfers.get(channel_id)
+        if transfer is None or transfer.complete:
+            log_event(f"[WARN][SYNC_SVC] Unexpected history chunk for channel {channel_id} from {peer_addr}.")
+            return
+        current_channel = self.controller.current_channel
+        if not current_channel or current_channel.id != channel_id:
+            del self._history_transfers[channel_id] # Đã rời kênh, bỏ phần còn lại
+            return
+        if transfer.until_timestamp_iso is None:
+            transfer.until_timestamp_iso = payload.get("until_timestamp_iso")
+        for data in payload.get("messages") or []:
+            message = message_from_history_dict(channel_id, data)
+            if message is None:
+                log_event(f"[WARN][SYNC_SVC] Invalid history message from {peer_addr}: {data}")
+                continue
+            self.controller.new_message_signal.emit(message)
+            transfer.cursor_timestamp_iso = data["timestamp_iso"]
+            transfer.cursor_id = message.id
+            transfer.received += 1
+        transfer.first_chunk.set()
+        if payload.get("is_last_chunk"):
+            transfer.complete = True
+            log_event(f"[SYNC_SVC] History of channel {channel_id} received from host: {transfer.received} messages.")
+
+    def resume_history_transfer(self, host_user_id: Optional[str]):
+        """Gọi khi nhận greeting (kết nối lại): tải tiếp các lần tải lịch sử dở dang từ host này."""
+        for channel_id, transfer in list(self._history_transfers.items()):
+            if transfer.host_user_id == host_user_id and not transfer.complete and transfer.first_chunk.is_set():
+                log_event(f"[SYNC_SVC] Resuming history of {channel_id} from {transfer.cursor_timestamp_iso}.")
+                asyncio.create_task(self._send_history_request(channel_id, transfer), name=f"ResumeHistory_{channel_id}")
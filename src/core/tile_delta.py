@@ -0,0 +1,138 @@
+# src/core/tile_delta.py
+from typing import Any, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from src.p2p import protocol as p2p_proto
+from src.utils.logger import log_event
+
+
+def changed_tile_mask(reference: np.ndarray, frame: np.ndarray, tile_size: int, threshold: float) -> np.ndarray:
+    """
+    So sánh hai frame BGR cùng kích thước theo từng tile (vector hoá, không vòng lặp Python).
+    Trả về mảng bool (số hàng tile, số cột tile): True nếu sai khác trung bình của tile vượt ngưỡng.
+    """
+    h, w = frame.shape[:2]
+    rows = -(-h // tile_size)
+    cols = -(-w // tile_size)
+    diff = cv2.absdiff(reference, frame).max(axis=2) # Kênh lệch nhiều nhất của mỗi pixel
+    if rows * tile_size == h and cols * tile_size == w:
+        tile_means = diff.reshape(rows, tile_size, cols, tile_size).mean(axis=(1, 3), dtype=np.float32)
+        return tile_means > threshold
+    # Tile ở mép phải/dưới bị thiếu pixel: đệm 0 rồi chia cho số pixel thật của từng tile
+    diff = np.pad(diff, ((0, rows * tile_size - h), (0, cols * tile_size - w)))
+    tile_sums = diff.reshape(rows, tile_size, cols, tile_size).sum(axis=(1, 3), dtype=np.float32)
+    row_heights = np.minimum(tile_size, h - np.arange(rows) * tile_size)
+    col_widths = np.minimum(tile_size, w - np.arange(cols) * tile_size)
+    return tile_sums / np.outer(row_heights, col_widths) > threshold
+
+
+def _tile_runs(mask: np.ndarray) -> List[Tuple[int, int, int]]:
+    """Gộp các tile thay đổi liền nhau trên cùng một hàng thành (hàng, cột đầu, số tile) để giảm số patch."""
+    runs = []
+    for row in np.flatnonzero(mask.any(axis=1)):
+        # Biên của các đoạn True liên tiếp trong hàng
+        padded = np.concatenate(([False], mask[row], [False]))
+        edges = np.flatnonzero(padded[1:] != padded[:-1])
+        for start, end in zip(edges[::2], edges[1::2]):
+            runs.append((int(row), int(start), int(end - start)))
+    return runs
+
+
+class TileDeltaEncoder:
+    """
+    Encoder delta theo tile cho một lớp simulcast. Giữ một frame tham chiếu (ảnh mà viewer đang có),
+    chỉ nén JPEG các vùng tile thay đổi. Phát keyframe khi được yêu cầu, khi kích thước frame đổi
+    hoặc khi quá nhiều tile thay đổi (JPEG đầy đủ khi đó rẻ hơn nhiều patch).
+    Không thread-safe: mỗi lớp có encoder riêng và pipeline chỉ encode một frame tại một thời điểm.
+    """
+
+    def __init__(self, tile_size: int = 64, threshold: float = 6.0, max_changed_ratio: float = 0.5):
+        self.tile_size = tile_size
+        self.threshold = threshold
+        self.max_changed_ratio = max_changed_ratio
+        self._reference: Optional[np.ndarray] = None
+
+    def reset(self):
+        self._reference = None
+
+    def encode(self, frame: np.ndarray, quality: int, force_keyframe: bool) -> Tuple[Optional[Any], bool]:
+        """Trả về (frame_bytes, is_keyframe); frame_bytes là JPEG đầy đủ hoặc tập patch đã đóng gói."""
+        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+        if not force_keyframe and self._reference is not None and self._reference.shape == frame.shape:
+            mask = changed_tile_mask(self._reference, frame, self.tile_size, self.threshold)
+            if mask.mean() <= self.max_changed_ratio:
+                patches = []
+                h, w = frame.shape[:2]
+                tile = self.tile_size
+                for row, col, count in _tile_runs(mask):
+                    y, x = row * tile, col * tile
+                    patch_h, patch_w = min(tile, h - y), min(count * tile, w - x)
+                    region = frame[y:y + patch_h, x:x + patch_w]
+                    result, encoded = cv2.imencode('.jpg', region, encode_param)
+                    if not result:
+                        log_event(f"[TileDelta] Failed to encode patch at ({x},{y}); sending keyframe instead.")
+                        break
+                    patches.append((x, y, patch_w, patch_h, memoryview(encoded.reshape(-1))))
+                    # Cập nhật tham chiếu đúng như viewer sẽ thấy sau khi ghép patch
+                    self._reference[y:y + patch_h, x:x + patch_w] = region
+                else:
+                    return p2p_proto.pack_tile_patches(patches), False
+
+        result, encoded = cv2.imencode('.jpg', frame, encode_param)
+        if not result:
+            return None, True
+        self._reference = frame.copy()
+        return memoryview(encoded.reshape(-1)), True
+
+
+class TileCompositor:
+    """
+    Phía viewer: giữ một frame buffer bền vững, thay bằng keyframe và ghép các patch của frame delta lên.
+    Frame delta chỉ được ghép khi liền mạch với frame trước (frame_id liên tiếp); nếu hụt frame
+    thì chờ keyframe kế tiếp để không hiển thị ảnh sai.
+    """
+
+    def __init__(self):
+        self._canvas: Optional[np.ndarray] = None
+        self._last_frame_id: Optional[int] = None
+        self.waiting_for_keyframe = True
+        self.discarded_deltas = 0
+
+    def reset(self):
+        self._canvas = None
+        self._last_frame_id = None
+        self.waiting_for_keyframe = True
+        self.discarded_deltas = 0
+
+    def apply(self, frame_id: int, is_keyframe: bool, frame_bytes: Any) -> Optional[np.ndarray]:
+        """Áp dụng một frame; trả về frame buffer hiện tại (BGR) hoặc None nếu chưa hiển thị được."""
+        if is_keyframe:
+            frame = cv2.imdecode(np.frombuffer(frame_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if frame is None:
+                self.waiting_for_keyframe = True
+                return None
+            self._canvas = frame
+            self._last_frame_id = frame_id
+            self.waiting_for_keyframe = False
+            return self._canvas
+
+        if self.waiting_for_keyframe or self._canvas is None or frame_id != self._last_frame_id + 1:
+            self.waiting_for_keyframe = True
+            self.discarded_deltas += 1
+            return None
+        canvas_h, canvas_w = self._canvas.shape[:2]
+        try:
+            for x, y, width, height, jpeg_bytes in p2p_proto.unpack_tile_patches(frame_bytes):
+                patch = cv2.imdecode(np.frombuffer(jpeg_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if patch is None or x + width > canvas_w or y + height > canvas_h or patch.shape[:2] != (height, width):
+                    raise ValueError(f"Bad tile patch at ({x},{y}) size {width}x{height}")
+                self._canvas[y:y + height, x:x + width] = patch
+        except ValueError as e:
+            log_event(f"[TileDelta] Cannot apply delta frame {frame_id}: {e}. Waiting for keyframe.")
+            self.waiting_for_keyframe = True
+            self.discarded_deltas += 1
+            return None
+        self._last_frame_id = frame_id
+        return self._canvas
@@ -0,0 +1,226 @@
+# src/core/viewer_pipeline.py
+import asyncio
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PySide6.QtGui import QImage
+
+from src.utils.logger import log_event
+from src.core.tile_delta import TileCompositor
+
+_EWMA_ALPHA = 0.2
+
+
+class DecodedFrame:
+    """Frame đã giải mã sẵn sàng hiển thị: QImage đã co giãn vừa khung hình của viewer."""
+    __slots__ = ("frame_id", "timestamp_ms", "image", "decode_ms", "latency_ms")
+
+    def __init__(self, frame_id: int, image: QImage, decode_ms: float, latency_ms: float, timestamp_ms: int = 0):
+        self.frame_id = frame_id
+        self.timestamp_ms = timestamp_ms # Thời điểm capture phía host (đồng hồ time.time())
+        self.image = image
+        self.decode_ms = decode_ms
+        self.latency_ms = latency_ms
+
+
+class _BufferedFrame:
+    __slots__ = ("frame_id", "timestamp_ms", "jpeg_bytes", "is_keyframe", "received_at")
+
+    def __init__(self, frame_id: int, timestamp_ms: int, jpeg_bytes: Any, is_keyframe: bool, received_at: float):
+        self.frame_id = frame_id
+        self.timestamp_ms = timestamp_ms
+        self.jpeg_bytes = jpeg_bytes
+        self.is_keyframe = is_keyframe
+        self.received_at = received_at
+
+
+def decode_jpeg_to_image(jpeg_bytes: Any, display_size: Optional[Tuple[int, int]]) -> Optional[QImage]:
+    """
+    Giải mã JPEG, co giãn vừa display_size (giữ tỉ lệ) và chuyển thành QImage RGB,
+    để thread GUI chỉ còn việc gắn ảnh lên QLabel.
+    """
+    frame = cv2.imdecode(np.frombuffer(jpeg_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if frame is None:
+        return None
+    return frame_to_image(frame, display_size)
+
+
+def frame_to_image(frame: np.ndarray, display_size: Optional[Tuple[int, int]]) -> QImage:
+    """Co giãn frame BGR vừa display_size (giữ tỉ lệ) và chuyển thành QImage RGB sở hữu dữ liệu riêng."""
+    if display_size:
+        h, w = frame.shape[:2]
+        scale = min(display_size[0] / w, display_size[1] / h)
+        if scale > 0 and abs(scale - 1.0) > 0.01:
+            interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR
+            frame = cv2.resize(frame, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=interpolation)
+    rgb_image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    h, w, ch = rgb_image.shape
+    return QImage(rgb_image.data, w, h, ch * w, QImage.Format_RGB888).copy()
+
+
+class ViewerDecodePipeline:
+    """
+    Pipeline giải mã phía viewer. Callback đọc P2P chỉ đẩy JPEG vào một jitter buffer nhỏ theo frame_id
+    (push), một thread riêng luôn giải mã frame MỚI NHẤT và bỏ các frame đã bị thay thế, nên độ trễ
+    không tăng dần khi frame đến nhanh hơn tốc độ giải mã. QImage hoàn chỉnh được trả về event loop.
+    Frame delta (tile patch) không bỏ qua được: chúng được ghép theo thứ tự vào TileCompositor kể từ
+    keyframe mới nhất trong buffer, và chỉ frame cuối cùng được chuyển thành ảnh để hiển thị.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, on_decoded: Callable[[DecodedFrame], None],
+                 max_buffered_frames: int = 3):
+        self._loop = loop
+        self._on_decoded = on_decoded
+        self.max_buffered_frames = max_buffered_frames
+        self.display_size: Optional[Tuple[int, int]] = None # (width, height) của khung hiển thị
+
+        self._buffer: Dict[int, _BufferedFrame] = {}
+        self._condition = threading.Condition()
+        self._last_frame_id = 0 # frame_id mới nhất đã được lấy ra giải mã
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+        self._compositor = TileCompositor() # Chỉ thread giải mã chạm vào
+
+        # --- Metrics ---
+        self.received_frames = 0
+        self.decoded_frames = 0
+        self.dropped_superseded = 0 # Bị frame mới hơn thay thế trước khi kịp giải mã
+        self.dropped_late = 0       # Đến sau một frame mới hơn đã được giải mã (sai thứ tự)
+        self.decode_errors = 0
+        self.decode_ms = 0.0        # EWMA thời gian giải mã + chuyển màu + thu nhỏ
+        self.buffer_wait_ms = 0.0   # EWMA thời gian frame nằm trong jitter buffer
+        self.latency_ms = 0.0       # EWMA độ trễ đầu-cuối (đồng hồ host -> hiển thị, cần đồng hồ hai máy gần khớp)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._reset_state()
+        self._running = True
+        self._thread = threading.Thread(target=self._decode_loop, name="LivestreamViewerDecode", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._buffer.clear()
+            self._condition.notify_all()
+        thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=1.0)
+
+    def _reset_state(self):
+        self._buffer.clear()
+        self._last_frame_id = 0
+        self._compositor.reset()
+        self.received_frames = self.decoded_frames = 0
+        self.dropped_superseded = self.dropped_late = self.decode_errors = 0
+        self.decode_ms = self.buffer_wait_ms = self.latency_ms = 0.0
+
+    def push(self, frame_id: int, timestamp_ms: int, jpeg_bytes: Any, is_keyframe: bool = True) -> bool:
+        """Đưa một frame vào jitter buffer (gọi trên event loop). Trả về False nếu frame bị bỏ ngay."""
+        with self._condition:
+            if not self._running:
+                return False
+            self.received_frames += 1
+            if frame_id <= self._last_frame_id or frame_id in self._buffer:
+                self.dropped_late += 1
+                return False
+            self._buffer[frame_id] = _BufferedFrame(frame_id, timestamp_ms, jpeg_bytes, is_keyframe, time.monotonic())
+            self._trim_buffer()
+            self._condition.notify()
+        return True
+
+    def _trim_buffer(self):
+        """
+        Giữ buffer trong max_buffered_frames bằng cách bỏ các frame cũ hơn keyframe mới nhất trong buffer
+        (đã bị keyframe đó thay thế). Frame từ keyframe đó trở đi, hoặc cả buffer nếu chưa có keyframe,
+        là chuỗi delta mà TileCompositor cần đủ: bỏ một frame sẽ làm viewer đứng hình tới keyframe định kỳ,
+        nên buffer được phép vượt giới hạn (thread giải mã lấy hết chuỗi ở lần kế tiếp).
+        """
+        if len(self._buffer) <= self.max_buffered_frames:
+            return
+        keyframe_ids = [frame_id for frame_id, item in self._buffer.items() if item.is_keyframe]
+        if not keyframe_ids:
+            return
+        newest_keyframe = max(keyframe_ids)
+        for frame_id in sorted(self._buffer):
+            if frame_id >= newest_keyframe or len(self._buffer) <= self.max_buffered_frames:
+                break
+            del self._buffer[frame_id]
+            self.dropped_superseded += 1
+
+    def _take_batch(self) -> Optional[List[_BufferedFrame]]:
+        """
+        Chờ có frame rồi lấy các frame cần xử lý (gọi trên thread giải mã): từ keyframe mới nhất
+        trong buffer trở đi; frame cũ hơn keyframe đó bị bỏ vì đã bị thay thế.
+        """
+        with self._condition:
+            while self._running and not self._buffer:
+                self._condition.wait()
+            if not self._running:
+                return None
+            frames = [self._buffer[frame_id] for frame_id in sorted(self._buffer)]
+            self._buffer.clear()
+            start = 0
+            for index, item in enumerate(frames):
+                if item.is_keyframe:
+                    start = index
+            self.dropped_superseded += start
+            self._last_frame_id = frames[-1].frame_id
+            return frames[start:]
+
+    def _decode_loop(self):
+        log_event("[ViewerDecodePipeline] Decode thread started.")
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                break
+            item = batch[-1]
+            started = time.monotonic()
+            self.buffer_wait_ms += _EWMA_ALPHA * ((started - batch[0].received_at) * 1000 - self.buffer_wait_ms)
+            image = None
+            try:
+                canvas = None
+                for buffered in batch:
+                    canvas = self._compositor.apply(buffered.frame_id, buffered.is_keyframe, buffered.jpeg_bytes)
+                if canvas is not None and all(not b.is_keyframe and len(b.jpeg_bytes) == 0 for b in batch):
+                    continue # Chỉ toàn frame delta rỗng (cảnh tĩnh): ảnh đang hiển thị vẫn đúng
+                if canvas is not None:
+                    image = frame_to_image(canvas, self.display_size)
+                elif self._compositor.waiting_for_keyframe and not item.is_keyframe:
+                    continue # Đang chờ keyframe sau khi hụt frame delta, không phải lỗi giải mã
+            except Exception as e:
+                log_event(f"[ViewerDecodePipeline] Error decoding frame {item.frame_id}: {e}")
+            if image is None:
+                self.decode_errors += 1
+                continue
+            decode_ms = (time.monotonic() - started) * 1000
+            latency_ms = max(0.0, time.time() * 1000 - item.timestamp_ms)
+            self.decoded_frames += 1
+            self.decode_ms += _EWMA_ALPHA * (decode_ms - self.decode_ms)
+            self.latency_ms += _EWMA_ALPHA * (latency_ms - self.latency_ms)
+            if not self._running:
+                break
+            try:
+                decoded = DecodedFrame(item.frame_id, image, decode_ms, latency_ms, item.timestamp_ms)
+                self._loop.call_soon_threadsafe(self._on_decoded, decoded)
+            except RuntimeError:
+                break # Event loop đã đóng khi ứng dụng thoát
+        log_event("[ViewerDecodePipeline] Decode thread finished.")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "received_frames": self.received_frames,
+            "decoded_frames": self.decoded_frames,
+            "dropped_superseded": self.dropped_superseded,
+            "dropped_late": self.dropped_late,
+            "decode_errors": self.decode_errors,
+            "discarded_deltas": self._compositor.discarded_deltas,
+            "buffered_frames": len(self._buffer),
+            "decode_ms": round(self.decode_ms, 2),
+            "buffer_wait_ms": round(self.buffer_wait_ms, 2),
+            "latency_ms": round(self.latency_ms, 2),
+        }
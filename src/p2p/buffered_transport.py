@@ -0,0 +1,181 @@
+# src/p2p/buffered_transport.py
+import asyncio
+import collections
+from typing import Any, Callable, Deque, List, Optional
+
+from src.utils.logger import log_event
+from . import protocol
+
+# --- Transport của P2PService, chọn lúc khởi tạo ---
+TRANSPORT_STREAMS = "streams"   # asyncio.start_server + StreamReader: mỗi kết nối một task đọc
+TRANSPORT_PROTOCOL = "protocol" # BufferedProtocol: tách frame ngay trong callback của event loop, không có task đọc
+
+WRITE_COALESCE_BYTES = 64 * 1024 # Dữ liệu chờ ghi vượt mức này thì ghi ngay thay vì đợi vòng lặp kế tiếp
+
+
+class ProtocolWriter:
+    """
+    Vỏ có giao diện như StreamWriter (write/drain/close/wait_closed/is_closing/get_extra_info) quanh
+    transport của P2PBufferedProtocol, để PeerConnection dùng chung cho cả hai transport.
+    Các lần write() trong cùng một vòng event loop được gom lại và ghi bằng một lần transport.writelines();
+    writelines() ghi ngay.
+    """
+
+    def __init__(self, transport: asyncio.Transport, owner: 'P2PBufferedProtocol'):
+        self._transport = transport
+        self._owner = owner
+        self._pending: List[bytes] = []
+        self._pending_bytes = 0
+        self._flush_scheduled = False
+
+    def write(self, data: bytes):
+        if not data or self._transport.is_closing():
+            return
+        self._pending.append(data)
+        self._pending_bytes += len(data)
+        if self._pending_bytes >= WRITE_COALESCE_BYTES:
+            self.flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._scheduled_flush)
+
+    def writelines(self, chunks):
+        """Lô đã được người gọi gom sẵn (xem PeerConnection) nên ghi ngay cùng phần đang chờ."""
+        for data in chunks:
+            if data:
+                self._pending.append(data)
+                self._pending_bytes += len(data)
+        self.flush()
+
+    def _scheduled_flush(self):
+        self._flush_scheduled = False
+        self.flush()
+
+    def flush(self):
+        """Ghi toàn bộ dữ liệu đang gom xuống transport."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        self._pending_bytes = 0
+        if not self._transport.is_closing():
+            self._transport.writelines(pending)
+
+    async def drain(self):
+        """Giống StreamWriter.drain(): chỉ chờ khi buffer ghi của transport vượt ngưỡng (pause_writing)."""
+        if self._owner.exception is not None:
+            raise self._owner.exception
+        if self._transport.is_closing():
+            raise ConnectionResetError("Connection lost")
+        if self._owner.is_writing_paused:
+            self.flush()
+            await self._owner.wait_writable()
+
+    def is_closing(self) -> bool:
+        return self._transport.is_closing()
+
+    def close(self):
+        self.flush()
+        self._transport.close()
+
+    async def wait_closed(self):
+        await self._owner.wait_closed()
+
+    def get_extra_info(self, name: str, default: Any = None) -> Any:
+        return self._transport.get_extra_info(name, default)
+
+
+class P2PBufferedProtocol(asyncio.BufferedProtocol):
+    """
+    Một kết nối P2P trên asyncio.BufferedProtocol: socket ghi thẳng vào buffer của FrameDecoder
+    (get_buffer/buffer_updated), message hoàn chỉnh được chuyển ngay cho on_messages trong callback.
+    Việc đọc bị tạm dừng từ connection_made cho tới khi attach() gắn PeerConnection đã đăng ký,
+    để không có message nào được xử lý trước khi kết nối có mặt trong registry.
+    """
+
+    def __init__(self, on_messages: Callable[[Any, List[dict]], None],
+                 on_lost: Callable[['P2PBufferedProtocol', Optional[Exception]], None],
+                 on_made: Optional[Callable[['P2PBufferedProtocol'], None]] = None):
+        self._on_messages = on_messages
+        self._on_lost = on_lost
+        self._on_made = on_made
+        self._decoder = protocol.FrameDecoder()
+        self.transport: Optional[asyncio.Transport] = None
+        self.writer: Optional[ProtocolWriter] = None
+        self.conn = None # PeerConnection, gắn bởi attach()
+        self.peer_addr_str = "unknown peer"
+        self.exception: Optional[Exception] = None
+        self.is_writing_paused = False
+        self._drain_waiters: Deque[asyncio.Future] = collections.deque()
+        self._closed: Optional[asyncio.Future] = None
+
+    # --- Vòng đời kết nối ---
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        self.writer = ProtocolWriter(transport, self)
+        self._closed = asyncio.get_running_loop().create_future()
+        peer_addr = transport.get_extra_info('peername')
+        if peer_addr:
+            self.peer_addr_str = f"{peer_addr[0]}:{peer_addr[1]}"
+        transport.pause_reading() # Chờ attach()
+        if self._on_made:
+            self._on_made(self)
+
+    def attach(self, conn):
+        """Gắn PeerConnection đã đăng ký và bắt đầu đọc dữ liệu."""
+        self.conn = conn
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if exc is not None:
+            self.exception = exc
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                if exc is None:
+                    waiter.set_result(None)
+                else:
+                    waiter.set_exception(exc)
+        self._drain_waiters.clear()
+        if not self._closed.done():
+            self._closed.set_result(None)
+        self._on_lost(self, exc)
+
+    def eof_received(self) -> bool:
+        log_event(f"[P2P_LISTENER] Connection closed by {self.peer_addr_str} (EOF).")
+        return False # Để transport tự đóng
+
+    # --- Nhận dữ liệu ---
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self._decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes: int):
+        try:
+            messages = self._decoder.buffer_updated(nbytes)
+        except ValueError as e:
+            log_event(f"[ERROR][P2P_LISTENER] Corrupted stream from {self.peer_addr_str}: {e}. Closing connection.")
+            self.transport.close()
+            return
+        if messages and self.conn is not None:
+            self._on_messages(self.conn, messages)
+
+    # --- Điều khiển luồng ghi ---
+    def pause_writing(self):
+        self.is_writing_paused = True
+
+    def resume_writing(self):
+        self.is_writing_paused = False
+        while self._drain_waiters:
+            waiter = self._drain_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def wait_writable(self):
+        if not self.is_writing_paused or self.transport.is_closing():
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._drain_waiters.append(waiter)
+        await waiter
+
+    async def wait_closed(self):
+        if self._closed is not None:
+            await self._closed
@@ -1,10 +1,17 @@
 # src/p2p/p2p_service.py
 import asyncio
-from typing import Dict, Callable, Optional, Tuple, Set, Any, List # Thêm List
+import socket
+import time
+from types import MappingProxyType
+from typing import Dict, Callable, Optional, Tuple, Set, Any, List, Union, Mapping # Thêm List
 from . import protocol # Import protocol đã sửa
+from .peer_connection import (PeerConnection, priority_for_type, PRIORITY_BULK, PRIORITY_CONTROL, PRIORITY_VIDEO,
+                              DEFAULT_MAX_RELIABLE_QUEUE, DEFAULT_MAX_VIDEO_QUEUE, DROP_TO_KEYFRAME)
+from .buffered_transport import P2PBufferedProtocol, TRANSPORT_PROTOCOL, TRANSPORT_STREAMS
 from src.core.peer_manager import PeerManager # <<< Import PeerManager
 from src.utils.logger import log_event # <<< Sử dụng log_event
 from src.p2p import protocol as p2p_proto
+import config
 # ...existing code...
 class P2PService:
     """
@@ -12,26 +19,58 @@ class P2PService:
     kết nối đi đến các peer, gửi và nhận dữ liệu.
     """
     # >>> SỬA ĐỔI __INIT__ ĐỂ NHẬN PEER_MANAGER <<<
-    def __init__(self, peer_manager: PeerManager, message_callback: Callable[[Tuple[str, int], Dict[str, Any]], None]):
+    def __init__(self, peer_manager: PeerManager, message_callback: Callable[[Tuple[str, int], Dict[str, Any]], None],
+                 max_reliable_queue: int = DEFAULT_MAX_RELIABLE_QUEUE, max_video_queue: int = DEFAULT_MAX_VIDEO_QUEUE,
+                 video_drop_policy: str = DROP_TO_KEYFRAME, transport: str = config.P2P_TRANSPORT,
+                 write_batch_bytes: int = config.P2P_WRITE_BATCH_BYTES,
+                 write_batch_delay_ms: float = config.P2P_WRITE_BATCH_DELAY_MS,
+                 socket_sndbuf: Optional[int] = config.P2P_SOCKET_SNDBUF,
+                 socket_rcvbuf: Optional[int] = config.P2P_SOCKET_RCVBUF,
+                 compression: bool = config.P2P_COMPRESSION,
+                 compression_min_bytes: int = config.P2P_COMPRESSION_MIN_BYTES):
         """
         Khởi tạo P2P Service.
         Args:
             peer_manager: Instance của PeerManager để tương tác.
             message_callback: Hàm sẽ được gọi khi nhận được message P2P hợp lệ.
                               Callback nhận (peer_address_tuple, message_dict).
+            max_reliable_queue: Số message control/chat/bulk tối đa chờ gửi cho mỗi peer.
+            max_video_queue: Số frame video tối đa chờ gửi cho mỗi peer trước khi bỏ frame.
+            video_drop_policy: DROP_TO_KEYFRAME hoặc DROP_OLDEST.
+            transport: TRANSPORT_STREAMS (StreamReader, mỗi kết nối một task đọc) hoặc
+                       TRANSPORT_PROTOCOL (BufferedProtocol, tách frame ngay trong callback nhận dữ liệu).
+            write_batch_bytes, write_batch_delay_ms: ngưỡng gom message thành lô khi ghi (xem PeerConnection).
+            socket_sndbuf, socket_rcvbuf: SO_SNDBUF/SO_RCVBUF cho mọi socket P2P (None = mặc định hệ điều hành).
+            compression: Quảng bá và dùng nén payload JSON (zstd/zlib) với peer hỗ trợ framing nhị phân.
+            compression_min_bytes: Payload JSON nhỏ hơn mức này được gửi không nén.
         """
+        if transport not in (TRANSPORT_STREAMS, TRANSPORT_PROTOCOL):
+            raise ValueError(f"Unknown P2P transport '{transport}'")
         self.peer_manager = peer_manager # <<< Lưu trữ peer_manager
         self._message_callback = message_callback
         self._server: Optional[asyncio.AbstractServer] = None
         self._listen_host: Optional[str] = None
         self._listen_port: Optional[int] = None
-        # Lưu các kết nối đang hoạt động: key=peer_address_tuple (ip, port), value=StreamWriter
-        self._active_writers: Dict[Tuple[str, int], asyncio.StreamWriter] = {}
+        # Lưu các kết nối đang hoạt động: key=peer_address_tuple (ip, port), value=PeerConnection
+        # (writer + hàng đợi gửi có giới hạn + coroutine gửi riêng + trạng thái framing).
+        # Copy-on-write: mapping không bao giờ bị sửa tại chỗ, mỗi thay đổi thành viên tạo snapshot mới
+        # dưới self._lock. Đường gửi/broadcast chỉ đọc tham chiếu hiện tại, không cần lock.
+        self._connections: Mapping[Tuple[str, int], PeerConnection] = MappingProxyType({})
         self._active_listeners: Set[asyncio.Task] = set() # Lưu các task lắng nghe
-        self._lock = asyncio.Lock() # Dùng lock của asyncio vì môi trường là async
+        self._max_reliable_queue = max_reliable_queue
+        self._max_video_queue = max_video_queue
+        self._video_drop_policy = video_drop_policy
+        self.transport = transport
+        self._write_batch_bytes = write_batch_bytes
+        self._write_batch_delay_ms = write_batch_delay_ms
+        self._socket_sndbuf = socket_sndbuf
+        self._socket_rcvbuf = socket_rcvbuf
+        self._compressions = list(p2p_proto.SUPPORTED_COMPRESSIONS) if compression else []
+        self._compression_min_bytes = compression_min_bytes
+        self._lock = asyncio.Lock() # Chỉ tuần tự hóa thay đổi thành viên (connect/disconnect), không dùng khi gửi
         self.host = '0.0.0.0' # <<< Thêm thuộc tính host mặc định
         self.port = 65432   # <<< Thêm thuộc tính port mặc định
-        log_event("[P2P_SERVICE] Initialized.")
+        log_event(f"[P2P_SERVICE] Initialized ({transport} transport).")
 
     def is_listening(self) -> bool:
          """Kiểm tra xem server có đang lắng nghe không."""
@@ -43,10 +82,69 @@ class P2PService:
 
     def get_connected_peers_addresses(self) -> Set[Tuple[str, int]]:
         """Trả về tập hợp các địa chỉ (ip, port) đang có kết nối P2P."""
-        # Cần lock để đảm bảo an toàn khi đọc từ nhiều coroutine
-        # Tuy nhiên, tạo set từ keys thường là atomic, nên có thể bỏ lock nếu chỉ đọc keys
-        # async with self._lock: # Cẩn thận hơn thì dùng lock
-        return set(self._active_writers.keys())
+        # Snapshot bất biến nên đọc trực tiếp, không cần lock
+        return set(self._connections.keys())
+
+    def get_user_id_for_address(self, peer_addr: Tuple[str, int]) -> Optional[str]:
+        """user_id của peer tại địa chỉ này (đã biết sau greeting)."""
+        conn = self._connections.get(peer_addr)
+        return conn.peer_user_id if conn else None
+
+    def find_address_for_user(self, user_id: str) -> Optional[Tuple[str, int]]:
+        """
+        Địa chỉ kết nối tới user_id. Hai peer có thể nối với nhau theo cả hai chiều;
+        khi đó chọn kết nối đang ít dữ liệu chờ gửi nhất.
+        """
+        best_addr, best_depth = None, None
+        for addr, conn in self._connections.items():
+            if conn.peer_user_id == user_id and not conn.is_closed:
+                depth = conn.queue_depth()
+                if best_depth is None or depth < best_depth:
+                    best_addr, best_depth = addr, depth
+        return best_addr
+
+    def get_connected_user_ids(self) -> Set[str]:
+        """user_id của mọi peer đang kết nối (đã greeting)."""
+        return {conn.peer_user_id for conn in self._connections.values() if conn.peer_user_id}
+
+    async def wait_bulk_drained(self, peer_addr: Tuple[str, int]) -> bool:
+        """
+        Chờ tới khi kết nối tới peer_addr không còn message bulk nào trong hàng đợi gửi
+        (message đang chờ đã được lấy ra ghi socket). False nếu không có kết nối hoặc kết nối đã đóng.
+        """
+        conn = self._connections.get(peer_addr)
+        if conn is None:
+            return False
+        return await conn.wait_queue_empty(PRIORITY_BULK)
+
+    async def ping_peers(self):
+        """Gửi ping tới mọi peer để cập nhật RTT (xem PeerConnection.rtt_ms)."""
+        ping_message = protocol.pre_encode(p2p_proto.create_message(
+            p2p_proto.MSG_TYPE_PING, p2p_proto.create_ping_payload(time.monotonic() * 1000)))
+        await asyncio.gather(*(self._send_to_connection(conn, ping_message) for conn in self._connections.values()),
+                             return_exceptions=True)
+
+    def get_peer_stats(self) -> Dict[Tuple[str, int], Dict[str, Any]]:
+        """Metrics gửi của từng peer: độ sâu hàng đợi, số frame bị bỏ, độ trễ hàng đợi, thời gian drain."""
+        return {addr: conn.get_stats() for addr, conn in self._connections.items()}
+
+    def _publish_connections(self, connections: Dict[Tuple[str, int], PeerConnection]):
+        """Thay snapshot kết nối bằng bản mới (chỉ gọi khi đang giữ self._lock)."""
+        self._connections = MappingProxyType(connections)
+
+    async def _remove_connection(self, peer_addr: Tuple[str, int], expected: Optional[PeerConnection] = None) -> Optional[PeerConnection]:
+        """
+        Gỡ kết nối khỏi registry (copy-on-write). Nếu có 'expected', chỉ gỡ khi kết nối hiện tại
+        đúng là đối tượng đó (tránh gỡ nhầm kết nối mới đã thay thế). Trả về kết nối đã gỡ.
+        """
+        async with self._lock:
+            current = self._connections.get(peer_addr)
+            if current is None or (expected is not None and current is not expected):
+                return None
+            connections = dict(self._connections)
+            del connections[peer_addr]
+            self._publish_connections(connections)
+            return current
 
     async def start_server(self, host: Optional[str] = None, port: Optional[int] = None) -> Tuple[Optional[str], Optional[int]]:
         """
@@ -68,11 +166,22 @@ class P2PService:
 
         try:
             log_event(f"[P2P_SERVICE] Attempting to start server on {listen_host}:{listen_port}...")
-            self._server = await asyncio.start_server(
-                self._handle_incoming_connection, # Hàm xử lý kết nối đến
-                listen_host,
-                listen_port
-            )
+            if self.transport == TRANSPORT_PROTOCOL:
+                self._server = await asyncio.get_running_loop().create_server(
+                    lambda: P2PBufferedProtocol(self._dispatch_messages, self._on_protocol_connection_lost,
+                                                on_made=self._on_protocol_connection_made),
+                    listen_host,
+                    listen_port
+                )
+            else:
+                self._server = await asyncio.start_server(
+                    self._handle_incoming_connection, # Hàm xử lý kết nối đến
+                    listen_host,
+                    listen_port
+                )
+            # Socket được accept kế thừa buffer của socket lắng nghe (RCVBUF cần có trước khi bắt tay TCP)
+            for server_socket in self._server.sockets:
+                self._tune_socket(server_socket)
             # Lấy địa chỉ và cổng thực tế đang lắng nghe
             actual_addr = self._server.sockets[0].getsockname()
             self._listen_host, self._listen_port = actual_addr[0], actual_addr[1]
@@ -117,28 +226,23 @@ class P2PService:
              log_event("[P2P_SERVICE] Listener tasks cancelled.")
         self._active_listeners.clear()
 
-        # Đóng các writer đang hoạt động
-        writers_to_close: List[asyncio.StreamWriter] = []
+        # Đóng các kết nối đang hoạt động (dừng coroutine gửi và đóng writer)
+        connections_to_close: List[PeerConnection] = []
         async with self._lock:
-             if self._active_writers:
-                 log_event(f"[P2P_SERVICE] Closing {len(self._active_writers)} active connections...")
-                 writers_to_close = list(self._active_writers.values()) # Tạo bản sao list writer
-                 self._active_writers.clear() # Xóa dict gốc
-
-        closed_count = 0
-        close_tasks = []
-        for writer in writers_to_close:
-             if not writer.is_closing():
-                 close_tasks.append(asyncio.create_task(self._close_writer_safe(writer)))
-
-        if close_tasks:
-             results = await asyncio.gather(*close_tasks, return_exceptions=True)
+             if self._connections:
+                 log_event(f"[P2P_SERVICE] Closing {len(self._connections)} active connections...")
+                 connections_to_close = list(self._connections.values())
+                 self._publish_connections({}) # Snapshot rỗng
+
+        if connections_to_close:
+             results = await asyncio.gather(*(conn.close() for conn in connections_to_close), return_exceptions=True)
+             closed_count = 0
              for result in results:
-                  if result is True: # _close_writer_safe trả về True nếu thành công
+                  if isinstance(result, Exception):
+                       log_event(f"[ERROR][P2P_SERVICE] Error closing connection during shutdown: {result}")
+                  else:
                        closed_count += 1
-                  elif isinstance(result, Exception):
-                       log_event(f"[ERROR][P2P_SERVICE] Error closing writer during shutdown: {result}", exc_info=True)
-             log_event(f"[P2P_SERVICE] Closed {closed_count}/{len(writers_to_close)} connections.")
+             log_event(f"[P2P_SERVICE] Closed {closed_count}/{len(connections_to_close)} connections.")
 
         log_event("[P2P_SERVICE] P2P service stopped.")
 
@@ -172,40 +276,41 @@ class P2PService:
              log_event(f"[P2P_SERVICE] Attempted to connect to self ({peer_addr}). Skipping.")
              return False
 
-        async with self._lock:
-            if peer_addr in self._active_writers:
-                 writer = self._active_writers[peer_addr]
-                 if not writer.is_closing():
-                      # log_event(f"[P2P_SERVICE] Already connected to {peer_addr}. Skipping.")
-                      return True # Đã kết nối, trả về True
-                 else:
-                      # Writer đang đóng, loại bỏ nó để thử kết nối lại
-                      log_event(f"[P2P_SERVICE] Found closing writer for {peer_addr}. Removing before reconnect.")
-                      self._active_writers.pop(peer_addr, None)
+        existing_conn = self._connections.get(peer_addr)
+        if existing_conn:
+             if not existing_conn.is_closed:
+                  # log_event(f"[P2P_SERVICE] Already connected to {peer_addr}. Skipping.")
+                  return True # Đã kết nối, trả về True
+             else:
+                  # Kết nối đang đóng, loại bỏ nó để thử kết nối lại
+                  log_event(f"[P2P_SERVICE] Found closing writer for {peer_addr}. Removing before reconnect.")
+                  await self._remove_connection(peer_addr, existing_conn)
 
         log_event(f"[P2P_SERVICE] Attempting to connect to {peer_addr}...")
         reader = None
         writer = None
         try:
             # Đặt timeout cho việc kết nối
-            reader, writer = await asyncio.wait_for(
-                asyncio.open_connection(host, port), timeout=5.0 # Giảm timeout xuống 5s
-            )
+            if self.transport == TRANSPORT_PROTOCOL:
+                _, buffered_protocol = await asyncio.wait_for(
+                    asyncio.get_running_loop().create_connection(
+                        lambda: P2PBufferedProtocol(self._dispatch_messages, self._on_protocol_connection_lost),
+                        host, port),
+                    timeout=5.0
+                )
+                writer = buffered_protocol.writer
+            else:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(host, port), timeout=5.0 # Giảm timeout xuống 5s
+                )
             log_event(f"[P2P_SERVICE] Connection established to {peer_addr}.")
             # Đăng ký kết nối và bắt đầu lắng nghe
-            await self._register_connection(reader, writer, peer_addr)
-
-            # Gửi message GREETING ngay sau khi kết nối thành công
-            # Cần lấy thông tin user hiện tại từ PeerManager hoặc AppController
-            # Tạm thời dùng ID giả định
-            my_user_id = self.peer_manager._get_current_user_id() # Sử dụng callback đã có # Cần hàm này trong PeerManager
-            my_display_name = "Unknown User" # Cần lấy tên hiển thị
-            if my_user_id:
-                 greeting_payload = p2p_proto.create_greeting_payload(my_user_id, my_display_name)
-                 greeting_msg = p2p_proto.create_message(p2p_proto.MSG_TYPE_GREETING, greeting_payload)
-                 await self._send_message_to_writer(writer, greeting_msg, peer_addr) # Gửi qua writer mới
-            else:
-                 log_event("[WARN][P2P_SERVICE] Cannot send greeting: My user ID not available.")
+            conn = await self._register_connection(writer, peer_addr, reader)
+            if self.transport == TRANSPORT_PROTOCOL:
+                buffered_protocol.attach(conn)
+
+            # Gửi message GREETING ngay sau khi kết nối thành công (kèm các chế độ framing hỗ trợ)
+            await self._send_greeting(conn)
 
             return True
         except asyncio.TimeoutError:
@@ -224,7 +329,7 @@ class P2PService:
         finally:
              # Đảm bảo đóng writer nếu kết nối thành công nhưng đăng ký thất bại
              # Hoặc nếu có lỗi sau khi kết nối nhưng trước khi đăng ký xong
-             if writer and peer_addr not in self._active_writers:
+             if writer and peer_addr not in self._connections:
                   log_event(f"[P2P_SERVICE] Closing writer for {peer_addr} due to registration failure or early error.")
                   await self._close_writer_safe(writer)
 
@@ -232,44 +337,39 @@ class P2PService:
     async def disconnect_from_peer(self, host: str, port: int):
         """Ngắt kết nối chủ động đến một peer."""
         peer_addr = (host, port)
-        writer = None
-        async with self._lock:
-             if peer_addr in self._active_writers:
-                 writer = self._active_writers.pop(peer_addr) # Lấy và xóa khỏi dict
-                 log_event(f"[P2P_SERVICE] Removing connection entry for {peer_addr}.")
-             # else: Không có kết nối để ngắt
+        conn = await self._remove_connection(peer_addr)
+        if conn:
+             log_event(f"[P2P_SERVICE] Removing connection entry for {peer_addr}.")
+        # else: Không có kết nối để ngắt
 
-        if writer:
+        if conn:
             log_event(f"[P2P_SERVICE] Closing connection to {peer_addr}...")
-            await self._close_writer_safe(writer)
+            await self._close_connection_safe(conn)
             log_event(f"[P2P_SERVICE] Connection to {peer_addr} closed.")
 
 
-    async def send_message(self, target_host: str, target_port: int, message_dict: Dict[str, Any]) -> bool:
+    async def send_message(self, target_host: str, target_port: int, message_dict: Union[Dict[str, Any], protocol.PreEncodedMessage]) -> bool:
         """Gửi message đến một peer cụ thể. Sẽ thử kết nối nếu chưa có."""
         peer_addr = (target_host, target_port)
-        writer = None
-        async with self._lock:
-             writer = self._active_writers.get(peer_addr)
-             if writer and writer.is_closing():
-                  log_event(f"[WARN][P2P_SERVICE] Attempted to get writer for {peer_addr}, but it's closing. Removing.")
-                  self._active_writers.pop(peer_addr, None)
-                  writer = None # Đặt lại là None để thử kết nối lại
-
-        if writer:
-            # Đã có kết nối, gửi trực tiếp
-            return await self._send_message_to_writer(writer, message_dict, peer_addr)
+        conn = self._connections.get(peer_addr) # Đọc snapshot, không cần lock
+        if conn and conn.is_closed:
+             # Listener/coroutine gửi của kết nối sẽ tự gỡ nó khỏi registry
+             log_event(f"[WARN][P2P_SERVICE] Attempted to get writer for {peer_addr}, but it's closing.")
+             conn = None # Đặt lại là None để thử kết nối lại
+
+        if conn:
+            # Đã có kết nối, đưa vào hàng đợi gửi của peer
+            return await self._send_to_connection(conn, message_dict)
         else:
             # Chưa có kết nối, thử kết nối lại
             log_event(f"[P2P_SERVICE] No active connection to {peer_addr}. Attempting to connect before sending...")
             if await self.connect_to_peer(target_host, target_port):
                  # Đợi một chút để đảm bảo kết nối ổn định và writer được đăng ký
                  await asyncio.sleep(0.1)
-                 async with self._lock:
-                      writer = self._active_writers.get(peer_addr) # Thử lấy lại writer
-                 if writer and not writer.is_closing():
+                 conn = self._connections.get(peer_addr) # Thử lấy lại kết nối
+                 if conn and not conn.is_closed:
                       log_event(f"[P2P_SERVICE] Reconnected to {peer_addr}. Retrying send.")
-                      return await self._send_message_to_writer(writer, message_dict, peer_addr)
+                      return await self._send_to_connection(conn, message_dict)
                  else:
                       log_event(f"[ERROR][P2P_SERVICE] Failed to get writer after successful reconnect to {peer_addr}.")
                       return False
@@ -277,34 +377,34 @@ class P2PService:
                  log_event(f"[ERROR][P2P_SERVICE] Failed to reconnect to {peer_addr} for sending.")
                  return False
 
-    async def broadcast_message(self, message_dict: Dict[str, Any], exclude_addr: Optional[Tuple[str, int]] = None):
-        """Gửi message đến tất cả các peer đang kết nối (trừ exclude_addr nếu có)."""
-        current_writers_map: Dict[Tuple[str, int], asyncio.StreamWriter] = {}
-        async with self._lock:
-             # Lấy bản sao của dict writers để tránh lỗi thay đổi khi đang duyệt
-             current_writers_map = self._active_writers.copy()
+    async def broadcast_message(self, message: Union[Dict[str, Any], protocol.PreEncodedMessage], exclude_addr: Optional[Tuple[str, int]] = None):
+        """
+        Gửi message đến tất cả các peer đang kết nối (trừ exclude_addr nếu có).
+        Message chỉ được serialize một lần cho mỗi chế độ framing; mọi peer dùng chung bytes.
+        Có thể truyền sẵn PreEncodedMessage (ví dụ frame đã encode) để bỏ qua bước encode.
+        Hàm chỉ chờ khi hàng đợi control/chat của một peer đầy (backpressure); video không bao giờ chờ.
+        """
+        encoded_message = protocol.pre_encode(message)
+        # Snapshot bất biến: duyệt an toàn mà không cần lock hay copy
+        current_connections = self._connections
 
-        if not current_writers_map:
+        if not current_connections:
              # log_event("[P2P_SERVICE] No active peers to broadcast to.") # Log này hơi thừa
              return
 
-        target_peers = list(current_writers_map.items())
+        target_peers = list(current_connections.items())
         if exclude_addr:
-             target_peers = [(addr, writer) for addr, writer in target_peers if addr != exclude_addr]
+             target_peers = [(addr, conn) for addr, conn in target_peers if addr != exclude_addr]
 
         if not target_peers:
              # log_event(f"[P2P_SERVICE] No peers to broadcast to after excluding {exclude_addr}.")
              return
 
-        msg_type = message_dict.get('type', 'unknown')
+        msg_type = encoded_message.msg_type
         log_event(f"[P2P_SERVICE] Broadcasting message type '{msg_type}' to {len(target_peers)} peers...")
-        tasks = []
-        for addr, writer in target_peers:
-             # Tạo task gửi cho mỗi peer, truyền cả addr để log lỗi nếu cần
-             tasks.append(asyncio.create_task(self._send_message_to_writer(writer, message_dict, addr), name=f"Send_{msg_type}_To_{addr[0]}:{addr[1]}"))
-
-        # Đợi tất cả các task gửi hoàn thành
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        # Mỗi peer có coroutine gửi riêng, ở đây chỉ đưa bytes (dùng chung) vào hàng đợi
+        results = await asyncio.gather(*(self._send_to_connection(conn, encoded_message) for _, conn in target_peers),
+                                       return_exceptions=True)
 
         # Kiểm tra lỗi và log
         failed_sends = 0
@@ -313,13 +413,56 @@ class P2PService:
               if isinstance(result, Exception):
                    log_event(f"[ERROR][P2P_SERVICE] Broadcast to {addr[0]}:{addr[1]} failed with exception: {result}", exc_info=True)
                    failed_sends += 1
-              elif result is False: # _send_message_to_writer trả về bool
+              elif result is False: # _send_to_connection trả về bool
                    log_event(f"[WARN][P2P_SERVICE] Broadcast to {addr[0]}:{addr[1]} possibly failed (send returned False).")
                    failed_sends += 1
         if failed_sends > 0:
              log_event(f"[WARN][P2P_SERVICE] Broadcast completed with {failed_sends} potential failures.")
         # else: log_event("[P2P_SERVICE] Broadcast completed successfully.") # Log này hơi thừa
 
+    def broadcast_nowait(self, message: Union[Dict[str, Any], protocol.PreEncodedMessage], exclude_addr: Optional[Tuple[str, int]] = None) -> int:
+        """
+        Broadcast không chờ, dành cho video: frame được đưa thẳng vào hàng đợi của từng peer
+        theo chính sách bỏ frame, không tạo task mới cho mỗi frame.
+        Trả về số peer đã nhận frame vào hàng đợi.
+        """
+        encoded_message = protocol.pre_encode(message)
+        if priority_for_type(encoded_message.msg_type) != PRIORITY_VIDEO:
+            # Message tin cậy cần backpressure, chuyển sang đường async
+            asyncio.create_task(self.broadcast_message(encoded_message, exclude_addr), name=f"Broadcast_{encoded_message.msg_type}")
+            return len(self._connections)
+        queued = 0
+        for addr, conn in self._connections.items():
+            if addr == exclude_addr or conn.is_closed:
+                continue
+            message_bytes = encoded_message.get_bytes(conn.send_framing)
+            if message_bytes and conn.enqueue_video_nowait(message_bytes, encoded_message.is_keyframe):
+                queued += 1
+        return queued
+
+    def send_video_nowait(self, peer_addr: Tuple[str, int], message: Union[Dict[str, Any], protocol.PreEncodedMessage]) -> bool:
+        """
+        Gửi frame video tới đúng một peer (ví dụ lớp simulcast riêng của viewer) mà không chờ.
+        Trả về False nếu peer không còn kết nối hoặc frame bị bỏ theo chính sách hàng đợi.
+        """
+        conn = self._connections.get(peer_addr)
+        if conn is None or conn.is_closed:
+            return False
+        encoded_message = protocol.pre_encode(message)
+        message_bytes = encoded_message.get_bytes(conn.send_framing)
+        return bool(message_bytes) and conn.enqueue_video_nowait(message_bytes, encoded_message.is_keyframe)
+
+    def send_audio_nowait(self, peer_addr: Tuple[str, int], message: Union[Dict[str, Any], protocol.PreEncodedMessage]) -> bool:
+        """
+        Gửi gói âm thanh tới một peer mà không chờ (hàng đợi audio riêng, ưu tiên hơn video).
+        Trả về False nếu peer không còn kết nối hoặc không nhận được audio (peer chỉ hỗ trợ JSON-lines).
+        """
+        conn = self._connections.get(peer_addr)
+        if conn is None or conn.is_closed:
+            return False
+        message_bytes = protocol.pre_encode(message).get_bytes(conn.send_framing)
+        return bool(message_bytes) and conn.enqueue_audio_nowait(message_bytes)
+
 
     # --- Các hàm xử lý nội bộ ---
 
@@ -332,64 +475,87 @@ class P2PService:
              return
 
         log_event(f"[P2P_SERVICE] Incoming connection from {peer_addr[0]}:{peer_addr[1]}")
-        await self._register_connection(reader, writer, peer_addr)
+        await self._register_connection(writer, peer_addr, reader)
 
-    async def _register_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, peer_addr: Tuple[str, int]):
-        """Đăng ký một kết nối mới (đến hoặc đi) và bắt đầu lắng nghe."""
+    def _on_protocol_connection_made(self, buffered_protocol: P2PBufferedProtocol):
+        """Kết nối đến trên transport protocol: đăng ký rồi mới cho phép đọc (xem P2PBufferedProtocol.attach)."""
+        peer_addr = buffered_protocol.writer.get_extra_info('peername')
+        if not peer_addr or not isinstance(peer_addr, tuple):
+            log_event("[ERROR][P2P_SERVICE] Could not get valid peer address for incoming connection.")
+            buffered_protocol.transport.close()
+            return
+        log_event(f"[P2P_SERVICE] Incoming connection from {peer_addr[0]}:{peer_addr[1]}")
+        asyncio.create_task(self._register_incoming_protocol(buffered_protocol, peer_addr[:2]),
+                            name=f"Register_{peer_addr[0]}:{peer_addr[1]}")
+
+    async def _register_incoming_protocol(self, buffered_protocol: P2PBufferedProtocol, peer_addr: Tuple[str, int]):
+        conn = await self._register_connection(buffered_protocol.writer, peer_addr)
+        buffered_protocol.attach(conn)
+
+    def _on_protocol_connection_lost(self, buffered_protocol: P2PBufferedProtocol, exc: Optional[Exception]):
+        """Tương đương phần dọn dẹp cuối _listen_to_writer cho transport protocol."""
+        conn = buffered_protocol.conn
+        if exc is not None:
+            log_event(f"[P2P_LISTENER] Connection to {buffered_protocol.peer_addr_str} lost: {exc}")
+        if conn is not None:
+            asyncio.create_task(self._drop_broken_connection(conn), name=f"DropConnection_{conn.peer_addr_str}")
+
+    async def _register_connection(self, writer: asyncio.StreamWriter, peer_addr: Tuple[str, int],
+                                   reader: Optional[asyncio.StreamReader] = None) -> PeerConnection:
+        """
+        Đăng ký một kết nối mới (đến hoặc đi) và khởi động coroutine gửi. Với transport streams
+        (có reader) thì tạo thêm task lắng nghe; transport protocol nhận dữ liệu qua callback.
+        """
         log_event(f"[P2P_SERVICE] Registering connection for {peer_addr[0]}:{peer_addr[1]}")
+        self._tune_socket(writer.get_extra_info('socket'))
+        conn = PeerConnection(peer_addr, writer, on_broken=self._on_connection_broken,
+                              max_reliable=self._max_reliable_queue, max_video=self._max_video_queue,
+                              video_drop_policy=self._video_drop_policy,
+                              write_batch_bytes=self._write_batch_bytes,
+                              write_batch_delay_ms=self._write_batch_delay_ms)
         async with self._lock:
-             # Đóng và xóa kết nối cũ nếu có từ cùng địa chỉ
-             existing_writer = self._active_writers.pop(peer_addr, None)
-             if existing_writer and not existing_writer.is_closing():
+             connections = dict(self._connections)
+             # Đóng và thay kết nối cũ nếu có từ cùng địa chỉ
+             existing_conn = connections.get(peer_addr)
+             if existing_conn and not existing_conn.is_closed:
                   log_event(f"[WARN][P2P_SERVICE] Closing existing active writer for {peer_addr} before registering new one.")
-                  # Không await ở đây để tránh deadlock nếu _close_writer_safe cần lock
-                  asyncio.create_task(self._close_writer_safe(existing_writer))
+                  # Không await ở đây để tránh deadlock nếu việc đóng cần lock
+                  asyncio.create_task(self._close_connection_safe(existing_conn))
 
-             # Thêm writer mới vào danh sách
-             self._active_writers[peer_addr] = writer
+             # Thêm kết nối mới vào snapshot mới, trạng thái framing bắt đầu từ JSON-lines
+             connections[peer_addr] = conn
+             self._publish_connections(connections)
+        conn.start()
+        if reader is None:
+            return conn
 
         # Tạo task riêng để lắng nghe dữ liệu từ kết nối này
         listener_task_name = f"Listener_From_{peer_addr[0]}:{peer_addr[1]}"
-        listener_task = asyncio.create_task(self._listen_to_writer(reader, writer, peer_addr), name=listener_task_name)
+        listener_task = asyncio.create_task(self._listen_to_writer(reader, conn), name=listener_task_name)
         self._active_listeners.add(listener_task)
         # Xóa task khỏi set khi nó hoàn thành (bằng callback hoặc cách khác)
         listener_task.add_done_callback(lambda t: self._active_listeners.discard(t))
         log_event(f"[P2P_SERVICE] Started listener task: {listener_task_name}")
+        return conn
 
 
-    async def _listen_to_writer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, peer_addr: Tuple[str, int]):
+    async def _listen_to_writer(self, reader: asyncio.StreamReader, conn: PeerConnection):
         """Vòng lặp lắng nghe và xử lý dữ liệu từ một kết nối cụ thể."""
-        peer_addr_str = f"{peer_addr[0]}:{peer_addr[1]}"
+        peer_addr = conn.peer_addr
+        peer_addr_str = conn.peer_addr_str
         log_event(f"[P2P_LISTENER] Started listening to {peer_addr_str}")
-        buffer = b"" # Buffer để xử lý dữ liệu nhận được không đầy đủ
+        # Decoder tách frame (JSON-lines hoặc nhị phân) mà không quét lại/cắt lại toàn bộ buffer
+        decoder = protocol.FrameDecoder()
         while True: # Lặp vô hạn cho đến khi có lỗi hoặc kết nối đóng
             try:
-                # Đọc dữ liệu, read(n) sẽ đợi đến khi có đủ n bytes hoặc EOF
-                # Sử dụng read(4096) để đọc một chunk lớn
-                chunk = await reader.read(4096)
+                # read(n) trả về ngay những gì đang có (tối đa n bytes); chunk lớn giảm số vòng lặp và số lần cấp phát
+                chunk = await reader.read(protocol.RECV_BUFFER_SIZE)
                 if not chunk: # Kết nối đóng bởi peer (EOF)
                     log_event(f"[P2P_LISTENER] Connection closed by {peer_addr_str} (EOF).")
                     break
 
-                buffer += chunk
                 # Xử lý tất cả các message hoàn chỉnh trong buffer
-                while b'\n' in buffer:
-                    line, buffer = buffer.split(b'\n', 1) # Tách message đầu tiên
-                    if line: # Bỏ qua dòng trống nếu có
-                        message_dict = protocol.decode_message(line)
-                        if message_dict:
-                            # Gọi callback đã đăng ký để xử lý message
-                            if self._message_callback:
-                                try:
-                                    # Gọi trực tiếp vì môi trường đã là async
-                                    # (Hoặc dùng asyncio.create_task nếu callback có thể block lâu)
-                                    self._message_callback(peer_addr, message_dict)
-                                except Exception as cb_e:
-                                    log_event(f"[ERROR][P2P_LISTENER] Error in message callback for {peer_addr_str}: {cb_e}", exc_info=True)
-                            else:
-                                 log_event(f"[WARN][P2P_LISTENER] No message callback set for message from {peer_addr_str}")
-                        # else: Message không hợp lệ, decode_message đã log lỗi
-                    # Tiếp tục vòng lặp while b'\n' in buffer để xử lý message tiếp theo nếu có
+                self._dispatch_messages(conn, decoder.feed(chunk))
 
             except asyncio.IncompleteReadError:
                 log_event(f"[P2P_LISTENER] Connection to {peer_addr_str} closed unexpectedly (IncompleteReadError).")
@@ -406,51 +572,152 @@ class P2PService:
 
         # --- Dọn dẹp sau khi vòng lặp kết thúc ---
         log_event(f"[P2P_LISTENER] Stopping listener for {peer_addr_str}")
-        # Xóa writer khỏi danh sách active nếu nó vẫn còn ở đó
-        async with self._lock:
-            if self._active_writers.get(peer_addr) is writer:
-                 self._active_writers.pop(peer_addr, None)
-                 log_event(f"[P2P_LISTENER] Removed writer for {peer_addr_str} from active list.")
+        # Xóa kết nối khỏi danh sách active nếu nó vẫn còn ở đó
+        if await self._remove_connection(peer_addr, conn):
+             log_event(f"[P2P_LISTENER] Removed writer for {peer_addr_str} from active list.")
+
+        # Dừng coroutine gửi và đóng writer nếu chưa đóng
+        await self._close_connection_safe(conn)
 
-        # Đóng writer nếu chưa đóng
-        await self._close_writer_safe(writer)
 
+    def _tune_socket(self, sock):
+        """
+        TCP_NODELAY để lô chứa control/chat không bị Nagle giữ lại (việc gom đã do PeerConnection làm),
+        và SO_SNDBUF/SO_RCVBUF lớn để bulk/video không phải chờ buffer của hệ điều hành.
+        """
+        if sock is None:
+            return
+        try:
+            if sock.family in (socket.AF_INET, socket.AF_INET6):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self._socket_sndbuf:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self._socket_sndbuf)
+            if self._socket_rcvbuf:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._socket_rcvbuf)
+        except OSError as e:
+            log_event(f"[WARN][P2P_SERVICE] Could not tune socket options: {e}")
 
-    async def _send_message_to_writer(self, writer: asyncio.StreamWriter, message_dict: Dict[str, Any], peer_addr: Tuple[str, int]) -> bool:
-        """Hàm nội bộ để gửi message qua một writer cụ thể, đảm bảo có '\n'."""
-        peer_addr_str = f"{peer_addr[0]}:{peer_addr[1]}"
-        message_bytes = protocol.encode_message(message_dict) # encode_message đã thêm '\n'
+    def _dispatch_messages(self, conn: PeerConnection, messages: List[Dict[str, Any]]):
+        """
+        Xử lý các message đã decode của một kết nối (dùng chung cho cả hai transport, chạy đồng bộ
+        nên gọi được từ callback buffer_updated): greeting/ping ở tầng P2P, còn lại chuyển lên ứng dụng.
+        """
+        for message_dict in messages:
+            msg_type = message_dict.get("type")
+            if msg_type == protocol.MSG_TYPE_GREETING:
+                self._handle_greeting(conn, message_dict.get("payload") or {})
+            elif msg_type in (protocol.MSG_TYPE_PING, protocol.MSG_TYPE_PONG):
+                # Ping/pong chỉ phục vụ đo RTT ở tầng P2P, không chuyển lên ứng dụng
+                self._handle_ping(conn, msg_type, message_dict.get("payload") or {})
+                continue
+            # Gọi callback đã đăng ký để xử lý message
+            if self._message_callback:
+                try:
+                    # Gọi trực tiếp vì môi trường đã là async
+                    # (Hoặc dùng asyncio.create_task nếu callback có thể block lâu)
+                    self._message_callback(conn.peer_addr, message_dict)
+                except Exception as cb_e:
+                    log_event(f"[ERROR][P2P_LISTENER] Error in message callback for {conn.peer_addr_str}: {cb_e}", exc_info=True)
+            else:
+                 log_event(f"[WARN][P2P_LISTENER] No message callback set for message from {conn.peer_addr_str}")
+
+    def _enqueue_soon(self, conn: PeerConnection, message_bytes: bytes, priority: int):
+        """Đưa message vào hàng đợi từ code đồng bộ; chỉ tạo task chờ khi hàng đợi tin cậy đang đầy."""
+        if not conn.enqueue_nowait(message_bytes, priority) and not conn.is_closed:
+            asyncio.create_task(conn.enqueue(message_bytes, priority), name=f"Enqueue_{conn.peer_addr_str}")
+
+    async def _send_to_connection(self, conn: PeerConnection, message: Union[Dict[str, Any], protocol.PreEncodedMessage],
+                                  priority: Optional[int] = None) -> bool:
+        """
+        Hàm nội bộ để đưa message vào hàng đợi gửi của một kết nối, theo chế độ framing đã thương lượng.
+        Việc ghi socket và drain do coroutine gửi của kết nối đảm nhận.
+        """
+        encoded_message = protocol.pre_encode(message)
+        message_bytes = encoded_message.get_bytes(conn.send_framing) # Lấy từ cache nếu đã encode cho framing này
         if not message_bytes:
-            log_event(f"[ERROR][P2P_SERVICE] Failed to encode message for {peer_addr_str}. Msg: {message_dict.get('type', 'unknown')}")
+            log_event(f"[ERROR][P2P_SERVICE] Failed to encode message for {conn.peer_addr_str}. Msg: {encoded_message.msg_type}")
             return False
 
-        if writer.is_closing():
-             log_event(f"[WARN][P2P_SERVICE] Attempted to send message to closing writer for {peer_addr_str}.")
-             # Xóa writer lỗi khỏi danh sách active
-             async with self._lock:
-                  if self._active_writers.get(peer_addr) is writer:
-                       self._active_writers.pop(peer_addr, None)
+        if conn.is_closed:
+             # Không gỡ ở đây (tránh lock trên đường gửi); listener/coroutine gửi sẽ gỡ kết nối lỗi
+             log_event(f"[WARN][P2P_SERVICE] Attempted to send message to closing writer for {conn.peer_addr_str}.")
              return False
 
+        if priority is None:
+            priority = priority_for_type(encoded_message.msg_type)
+        return await conn.enqueue(message_bytes, priority, encoded_message.is_keyframe)
+
+    def _on_connection_broken(self, conn: PeerConnection):
+        """Callback từ coroutine gửi khi socket lỗi: gỡ kết nối khỏi danh sách và đóng writer."""
+        asyncio.create_task(self._drop_broken_connection(conn), name=f"DropConnection_{conn.peer_addr_str}")
+
+    async def _drop_broken_connection(self, conn: PeerConnection):
+        await self._remove_connection(conn.peer_addr, conn)
+        await self._close_connection_safe(conn)
+
+    async def _close_connection_safe(self, conn: PeerConnection) -> bool:
+        """Đóng một PeerConnection (coroutine gửi + writer) một cách an toàn."""
         try:
-            # log_event(f"[P2P_SERVICE] Sending {len(message_bytes)} bytes (type: {message_dict.get('type')}) to {peer_addr_str}") # Log chi tiết nếu cần debug
-            writer.write(message_bytes)
-            await writer.drain() # Đảm bảo dữ liệu được gửi đi hết khỏi buffer hệ thống
+            await conn.close()
             return True
-        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as conn_err:
-            log_event(f"[ERROR][P2P_SERVICE] Connection error while sending to {peer_addr_str}: {conn_err}. Closing connection.")
-            # Đóng và xóa kết nối lỗi
-            # Không gọi disconnect_from_peer ở đây để tránh gọi lại lock
-            async with self._lock:
-                 if self._active_writers.get(peer_addr) is writer:
-                      self._active_writers.pop(peer_addr, None)
-            # Đóng writer an toàn
-            await self._close_writer_safe(writer)
-            return False
         except Exception as e:
-            log_event(f"[ERROR][P2P_SERVICE] Unexpected error sending message to {peer_addr_str}: {e}", exc_info=True)
+            log_event(f"[ERROR][P2P_SERVICE] Error closing connection for {conn.peer_addr_str}: {e}", exc_info=True)
             return False
 
+    def _build_greeting(self, conn: PeerConnection) -> Optional[bytes]:
+        """GREETING (luôn ở dạng JSON-lines) kèm danh sách chế độ framing mình hỗ trợ; đánh dấu conn đã greeting."""
+        my_user_id = self.peer_manager._get_current_user_id() # Sử dụng callback đã có
+        my_display_name = "Unknown User" # Cần lấy tên hiển thị
+        if not my_user_id:
+            log_event("[WARN][P2P_SERVICE] Cannot send greeting: My user ID not available.")
+            return None
+        # Đánh dấu ngay để greeting phản hồi của peer không kích hoạt gửi lại
+        conn.greeted = True
+        greeting_payload = p2p_proto.create_greeting_payload(my_user_id, my_display_name,
+                                                             compression=self._compressions)
+        greeting_msg = p2p_proto.create_message(p2p_proto.MSG_TYPE_GREETING, greeting_payload)
+        return p2p_proto.encode_message_for(greeting_msg, p2p_proto.FRAMING_JSON_LINES)
+
+    async def _send_greeting(self, conn: PeerConnection) -> bool:
+        """Gửi GREETING cho kết nối vừa mở."""
+        greeting_bytes = self._build_greeting(conn)
+        return bool(greeting_bytes) and await conn.enqueue(greeting_bytes, PRIORITY_CONTROL)
+
+    def _handle_greeting(self, conn: PeerConnection, payload: Dict[str, Any]):
+        """
+        Thương lượng framing khi nhận GREETING: phản hồi greeting nếu mình chưa gửi,
+        sau đó chuyển chế độ gửi sang binary (và bật nén) nếu cả hai bên đều hỗ trợ.
+        Greeting phản hồi đã được encode JSON-lines nên việc đổi framing ngay sau đó không ảnh hưởng nó.
+        """
+        conn.peer_user_id = payload.get("user_id") or conn.peer_user_id
+        if not conn.greeted:
+            greeting_bytes = self._build_greeting(conn)
+            if greeting_bytes:
+                self._enqueue_soon(conn, greeting_bytes, PRIORITY_CONTROL)
+        framing = p2p_proto.negotiate_framing(payload.get("framing"))
+        if conn.send_framing != framing:
+            conn.send_framing = framing
+            log_event(f"[P2P_SERVICE] Negotiated '{framing}' framing for sending to {conn.peer_addr_str}.")
+        # Ngữ cảnh nén chỉ tạo một lần: thay ngữ cảnh giữa chừng sẽ làm lệch bộ giải nén của peer
+        if framing == p2p_proto.FRAMING_BINARY and conn.compressor is None:
+            codec = p2p_proto.negotiate_compression(payload.get("compression"), self._compressions)
+            if codec:
+                conn.compressor = p2p_proto.StreamCompressor(codec, min_bytes=self._compression_min_bytes)
+                log_event(f"[P2P_SERVICE] Negotiated '{codec}' compression for sending to {conn.peer_addr_str}.")
+
+    def _handle_ping(self, conn: PeerConnection, msg_type: str, payload: Dict[str, Any]):
+        """Trả lời ping bằng pong (giữ nguyên sent_ms); khi nhận pong thì cập nhật RTT của kết nối."""
+        sent_ms = payload.get("sent_ms")
+        if not isinstance(sent_ms, (int, float)):
+            return
+        if msg_type == protocol.MSG_TYPE_PING:
+            pong = p2p_proto.create_message(p2p_proto.MSG_TYPE_PONG, p2p_proto.create_ping_payload(sent_ms))
+            pong_bytes = p2p_proto.encode_message_for(pong, conn.send_framing)
+            if pong_bytes:
+                self._enqueue_soon(conn, pong_bytes, PRIORITY_CONTROL)
+        else:
+            conn.record_rtt(max(0.0, time.monotonic() * 1000 - sent_ms))
+
     # Thêm phương thức listen() nếu chưa có (cần thiết cho main.py)
     async def listen(self):
         """Chạy server P2P và giữ nó hoạt động."""
@@ -0,0 +1,367 @@
+# src/p2p/peer_connection.py
+import asyncio
+import collections
+import time
+from typing import Callable, Deque, Dict, Any, List, Optional, Tuple
+
+from src.utils.logger import log_event
+from . import protocol
+
+# --- Lớp ưu tiên khi gửi (số nhỏ được gửi trước) ---
+PRIORITY_CONTROL = 0 # greeting, livestream_start/end, ack... không bao giờ bị bỏ
+PRIORITY_CHAT = 1    # Tin nhắn chat, không bao giờ bị bỏ
+PRIORITY_AUDIO = 2   # Gói âm thanh nhỏ, cần độ trễ thấp; bỏ gói cũ nhất khi hàng đợi đầy
+PRIORITY_BULK = 3    # Dữ liệu lớn (lịch sử, danh sách peer), không bị bỏ nhưng nhường chat/control/audio
+PRIORITY_VIDEO = 4   # Frame video, được phép bỏ khi hàng đợi đầy
+_PRIORITY_COUNT = 5
+_UNRELIABLE_PRIORITIES = (PRIORITY_AUDIO, PRIORITY_VIDEO)
+_URGENT_PRIORITIES = (PRIORITY_CONTROL, PRIORITY_CHAT, PRIORITY_AUDIO) # Được ghi ngay, không chờ gom thêm
+
+# --- Chính sách bỏ frame video khi hàng đợi đầy ---
+DROP_OLDEST = "drop_oldest"           # Bỏ frame cũ nhất cho đến khi đủ chỗ
+DROP_TO_KEYFRAME = "drop_to_keyframe" # Bỏ mọi frame trước keyframe mới nhất; frame delta mồ côi bị bỏ đến keyframe kế tiếp
+
+DEFAULT_MAX_RELIABLE_QUEUE = 256 # Số message control/chat/bulk tối đa đang chờ trước khi người gửi phải đợi
+DEFAULT_MAX_VIDEO_QUEUE = 8      # Khoảng 0.5s video ở 15 FPS
+DEFAULT_MAX_AUDIO_QUEUE = 10     # 200ms âm thanh với gói 20ms; trễ hơn thì gói không còn giá trị phát
+DEFAULT_WRITE_BATCH_BYTES = 64 * 1024 # Gom message tới cỡ này rồi ghi một lần (một syscall send)
+DEFAULT_WRITE_BATCH_DELAY_MS = 2.0    # Lô chỉ có bulk/video được chờ thêm tối đa chừng này để gom
+_EWMA_ALPHA = 0.2
+
+_PRIORITY_BY_TYPE = {
+    protocol.MSG_TYPE_CHAT_MESSAGE: PRIORITY_CHAT,
+    protocol.MSG_TYPE_HISTORY_CHUNK: PRIORITY_BULK,
+    protocol.MSG_TYPE_PEER_LIST_RESPONSE: PRIORITY_BULK,
+    protocol.MSG_TYPE_VIDEO_FRAME: PRIORITY_VIDEO,
+    protocol.MSG_TYPE_AUDIO_FRAME: PRIORITY_AUDIO,
+}
+
+def priority_for_type(msg_type: Optional[str]) -> int:
+    """Lớp ưu tiên mặc định theo loại message (mặc định là control)."""
+    return _PRIORITY_BY_TYPE.get(msg_type, PRIORITY_CONTROL)
+
+
+class _QueuedFrame:
+    __slots__ = ("data", "priority", "is_keyframe", "enqueued_at")
+
+    def __init__(self, data: bytes, priority: int, is_keyframe: bool):
+        self.data = data
+        self.priority = priority
+        self.is_keyframe = is_keyframe
+        self.enqueued_at = time.monotonic()
+
+
+class PeerConnection:
+    """
+    Một kết nối P2P đang hoạt động: writer, trạng thái thương lượng và một coroutine gửi riêng
+    đọc từ hàng đợi có giới hạn. Peer chậm chỉ làm đầy hàng đợi của chính nó thay vì
+    làm chồng chất task gửi trong toàn bộ ứng dụng.
+    """
+
+    def __init__(self, peer_addr: Tuple[str, int], writer: asyncio.StreamWriter, # Hoặc ProtocolWriter
+                 on_broken: Optional[Callable[['PeerConnection'], None]] = None,
+                 max_reliable: int = DEFAULT_MAX_RELIABLE_QUEUE,
+                 max_video: int = DEFAULT_MAX_VIDEO_QUEUE,
+                 video_drop_policy: str = DROP_TO_KEYFRAME,
+                 max_audio: int = DEFAULT_MAX_AUDIO_QUEUE,
+                 write_batch_bytes: int = DEFAULT_WRITE_BATCH_BYTES,
+                 write_batch_delay_ms: float = DEFAULT_WRITE_BATCH_DELAY_MS):
+        self.peer_addr = peer_addr
+        self.peer_addr_str = f"{peer_addr[0]}:{peer_addr[1]}"
+        self.writer = writer
+        self.send_framing = protocol.FRAMING_JSON_LINES # Đổi sau khi greeting thương lượng xong
+        self.greeted = False # Mình đã gửi greeting trên kết nối này chưa
+        self.peer_user_id: Optional[str] = None # user_id của peer, biết được từ greeting
+        self.compressor: Optional[protocol.StreamCompressor] = None # Đặt sau khi greeting thương lượng nén
+        self.max_reliable = max_reliable
+        self.max_video = max_video
+        self.video_drop_policy = video_drop_policy
+        self.max_audio = max_audio
+        self.write_batch_bytes = max(1, write_batch_bytes)
+        self.write_batch_delay_ms = write_batch_delay_ms
+
+        self._on_broken = on_broken
+        self._queues: List[Deque[_QueuedFrame]] = [collections.deque() for _ in range(_PRIORITY_COUNT)]
+        self._reliable_count = 0
+        self._has_data = asyncio.Event()
+        self._reliable_space = asyncio.Event()
+        self._reliable_space.set()
+        self._video_needs_keyframe = False
+        self._closed = False
+        self._writer_task: Optional[asyncio.Task] = None
+        self._linger: Optional[asyncio.Future] = None # Đang chờ gom thêm dữ liệu cho lô bulk/video
+
+        # --- Metrics ---
+        self.sent_messages = 0
+        self.sent_bytes = 0
+        self.dropped_video_frames = 0
+        self.dropped_audio_frames = 0
+        self.queue_latency_ms = 0.0 # EWMA thời gian một message nằm trong hàng đợi
+        self.drain_ms = 0.0         # EWMA thời gian writer.drain()
+        self.rtt_ms: Optional[float] = None # EWMA round-trip time đo bằng ping/pong
+        self.max_queue_depth = 0
+        self.flushes = 0          # Số lần ghi xuống transport (mỗi lần xấp xỉ một syscall send)
+        self.urgent_flushes = 0   # Lô có control/chat/audio nên được ghi ngay
+        self.size_flushes = 0     # Lô đạt write_batch_bytes
+        self.max_flush_bytes = 0
+
+    def start(self):
+        """Khởi động coroutine gửi của kết nối."""
+        if self._writer_task is None:
+            self._writer_task = asyncio.create_task(self._writer_loop(), name=f"Writer_To_{self.peer_addr_str}")
+
+    @property
+    def is_closed(self) -> bool:
+        return self._closed or self.writer.is_closing()
+
+    def queue_depth(self) -> int:
+        return self._reliable_count + len(self._queues[PRIORITY_AUDIO]) + len(self._queues[PRIORITY_VIDEO])
+
+    async def enqueue(self, data: bytes, priority: int, is_keyframe: bool = True) -> bool:
+        """
+        Đưa bytes đã encode vào hàng đợi gửi.
+        Control/chat/bulk không bao giờ bị bỏ: nếu hàng đợi đầy, người gửi phải đợi (backpressure).
+        Video và audio không bao giờ chờ, áp dụng chính sách bỏ frame.
+        """
+        if priority == PRIORITY_VIDEO:
+            return self.enqueue_video_nowait(data, is_keyframe)
+        if priority == PRIORITY_AUDIO:
+            return self.enqueue_audio_nowait(data)
+        while self._reliable_count >= self.max_reliable and not self.is_closed:
+            self._reliable_space.clear()
+            await self._reliable_space.wait()
+        return self.enqueue_nowait(data, priority, is_keyframe)
+
+    async def wait_queue_empty(self, priority: int) -> bool:
+        """
+        Chờ tới khi hàng đợi của một lớp tin cậy (control/chat/bulk) không còn message nào chưa được lấy ra ghi.
+        Dùng để giới hạn dữ liệu bulk đang chờ (ví dụ: gửi lịch sử từng phần một). Trả về False nếu kết nối đã đóng.
+        """
+        while self._queues[priority] and not self.is_closed:
+            self._reliable_space.clear() # Được set lại mỗi khi một message tin cậy rời hàng đợi
+            await self._reliable_space.wait()
+        return not self.is_closed
+
+    def enqueue_nowait(self, data: bytes, priority: int, is_keyframe: bool = True) -> bool:
+        """
+        Như enqueue() nhưng không bao giờ chờ (dùng được từ callback đồng bộ):
+        message control/chat/bulk bị từ chối (False) khi hàng đợi tin cậy đang đầy.
+        """
+        if priority == PRIORITY_VIDEO:
+            return self.enqueue_video_nowait(data, is_keyframe)
+        if priority == PRIORITY_AUDIO:
+            return self.enqueue_audio_nowait(data)
+        if self.is_closed or self._reliable_count >= self.max_reliable:
+            return False
+        self._queues[priority].append(_QueuedFrame(data, priority, is_keyframe))
+        self._reliable_count += 1
+        self._after_enqueue(priority)
+        return True
+
+    def enqueue_video_nowait(self, data: bytes, is_keyframe: bool = True) -> bool:
+        """Đưa frame video vào hàng đợi mà không chờ; trả về False nếu frame bị bỏ."""
+        if self.is_closed:
+            return False
+        video_queue = self._queues[PRIORITY_VIDEO]
+        if self._video_needs_keyframe:
+            if not is_keyframe:
+                self.dropped_video_frames += 1
+                return False
+            self._video_needs_keyframe = False
+        if len(video_queue) >= self.max_video:
+            if self.video_drop_policy == DROP_TO_KEYFRAME:
+                if not self._drop_to_latest_keyframe(video_queue, is_keyframe):
+                    # Không còn keyframe để cắt: bỏ frame mới và chờ keyframe kế tiếp để viewer không giải mã sai
+                    self.dropped_video_frames += 1
+                    self._video_needs_keyframe = True
+                    return False
+            else:
+                while len(video_queue) >= self.max_video:
+                    video_queue.popleft()
+                    self.dropped_video_frames += 1
+        video_queue.append(_QueuedFrame(data, PRIORITY_VIDEO, is_keyframe))
+        self._after_enqueue(PRIORITY_VIDEO)
+        return True
+
+    def enqueue_audio_nowait(self, data: bytes) -> bool:
+        """Đưa gói âm thanh vào hàng đợi mà không chờ; khi đầy thì bỏ gói cũ nhất (đã quá hạn phát)."""
+        if self.is_closed:
+            return False
+        audio_queue = self._queues[PRIORITY_AUDIO]
+        while len(audio_queue) >= self.max_audio:
+            audio_queue.popleft()
+            self.dropped_audio_frames += 1
+        audio_queue.append(_QueuedFrame(data, PRIORITY_AUDIO, True))
+        self._after_enqueue(PRIORITY_AUDIO)
+        return True
+
+    def _drop_to_latest_keyframe(self, video_queue: Deque[_QueuedFrame], new_is_keyframe: bool) -> bool:
+        """Bỏ các frame đứng trước keyframe mới nhất. Trả về True nếu đã giải phóng được chỗ."""
+        if new_is_keyframe:
+            # Keyframe mới thay thế toàn bộ frame đang chờ
+            self.dropped_video_frames += len(video_queue)
+            video_queue.clear()
+            return True
+        last_keyframe_index = -1
+        for index, queued in enumerate(video_queue):
+            if queued.is_keyframe:
+                last_keyframe_index = index
+        if last_keyframe_index <= 0:
+            return False
+        for _ in range(last_keyframe_index):
+            video_queue.popleft()
+        self.dropped_video_frames += last_keyframe_index
+        return True
+
+    def _after_enqueue(self, priority: int):
+        depth = self.queue_depth()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+        self._has_data.set()
+        if priority in _URGENT_PRIORITIES:
+            self._end_linger() # Message khẩn được ghi ngay cùng lô đang gom
+
+    def _end_linger(self):
+        if self._linger is not None and not self._linger.done():
+            self._linger.set_result(None)
+
+    def _pop_next(self) -> Optional[_QueuedFrame]:
+        for queue in self._queues:
+            if queue:
+                item = queue.popleft()
+                if item.priority not in _UNRELIABLE_PRIORITIES:
+                    self._reliable_count -= 1
+                    self._reliable_space.set()
+                return item
+        return None
+
+    async def _writer_loop(self):
+        """
+        Coroutine gửi duy nhất của kết nối: gom message theo độ ưu tiên thành lô, ghi cả lô bằng một
+        lần writelines rồi drain. Lô được ghi khi đủ write_batch_bytes, ngay lập tức nếu có
+        control/chat/audio, còn lô chỉ có bulk/video thì chờ thêm tối đa write_batch_delay_ms.
+        """
+        try:
+            while not self._closed:
+                item = self._pop_next()
+                if item is None:
+                    self._has_data.clear()
+                    await self._has_data.wait()
+                    continue
+                batch = await self._collect_batch(item)
+                if self._closed:
+                    break
+                batch_bytes = sum(len(data) for data in batch)
+                started = time.monotonic()
+                self.writer.writelines(batch)
+                await self.writer.drain() # Đảm bảo dữ liệu được gửi đi hết khỏi buffer hệ thống
+                self.drain_ms += _EWMA_ALPHA * ((time.monotonic() - started) * 1000 - self.drain_ms)
+                self.flushes += 1
+                self.max_flush_bytes = max(self.max_flush_bytes, batch_bytes)
+                self.sent_messages += len(batch)
+                self.sent_bytes += batch_bytes
+        except asyncio.CancelledError:
+            raise
+        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as conn_err:
+            log_event(f"[ERROR][P2P_CONN] Connection error while sending to {self.peer_addr_str}: {conn_err}. Closing connection.")
+            self._mark_broken()
+        except Exception as e:
+            log_event(f"[ERROR][P2P_CONN] Unexpected error in writer loop for {self.peer_addr_str}: {e}", exc_info=True)
+            self._mark_broken()
+
+    async def _collect_batch(self, first: _QueuedFrame) -> List[bytes]:
+        """Gom message đang chờ (bắt đầu từ first) thành một lô theo ngưỡng kích thước/thời gian."""
+        batch: List[bytes] = []
+        batch_bytes = 0
+        urgent = False
+        lingered = False
+        item: Optional[_QueuedFrame] = first
+        while True:
+            if item is not None:
+                now = time.monotonic()
+                self.queue_latency_ms += _EWMA_ALPHA * ((now - item.enqueued_at) * 1000 - self.queue_latency_ms)
+                # Nén ở đây (không phải lúc enqueue) để ngữ cảnh nén đi đúng thứ tự byte trên socket
+                data = item.data if self.compressor is None else self.compressor.compress_frame(item.data)
+                batch.append(data)
+                batch_bytes += len(data)
+                urgent = urgent or item.priority in _URGENT_PRIORITIES
+                if batch_bytes >= self.write_batch_bytes:
+                    self.size_flushes += 1
+                    break
+                item = self._pop_next()
+                continue
+            if urgent:
+                self.urgent_flushes += 1
+                break
+            if lingered or self.write_batch_delay_ms <= 0 or self._closed:
+                break
+            # Chỉ có bulk/video: chờ thêm một chút để gom (kết thúc sớm nếu có message khẩn)
+            lingered = True
+            loop = asyncio.get_running_loop()
+            self._linger = loop.create_future()
+            timer = loop.call_later(self.write_batch_delay_ms / 1000.0, self._end_linger)
+            try:
+                await self._linger
+            finally:
+                timer.cancel()
+                self._linger = None
+            item = self._pop_next()
+        return batch
+
+    def _mark_broken(self):
+        if self._closed:
+            return
+        self._release()
+        if self._on_broken:
+            self._on_broken(self)
+
+    def _release(self):
+        """Đánh dấu đóng, xóa hàng đợi và đánh thức các coroutine đang chờ chỗ trống."""
+        self._closed = True
+        for queue in self._queues:
+            queue.clear()
+        self._reliable_count = 0
+        self._reliable_space.set()
+        self._has_data.set()
+        self._end_linger()
+
+    async def close(self):
+        """Dừng coroutine gửi (bỏ dữ liệu còn chờ) và đóng writer."""
+        self._release()
+        task = self._writer_task
+        if task and not task.done() and task is not asyncio.current_task():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        if not self.writer.is_closing():
+            self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionResetError, BrokenPipeError):
+            pass # Peer đã đóng trước, coi như đã xử lý xong
+
+    def record_rtt(self, rtt_ms: float):
+        self.rtt_ms = rtt_ms if self.rtt_ms is None else self.rtt_ms + _EWMA_ALPHA * (rtt_ms - self.rtt_ms)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Metrics của kết nối (độ sâu hàng đợi, số frame bị bỏ, độ trễ hàng đợi, thời gian drain)."""
+        return {
+            "queue_depth": self.queue_depth(),
+            "queue_depth_by_priority": [len(queue) for queue in self._queues],
+            "max_queue_depth": self.max_queue_depth,
+            "dropped_video_frames": self.dropped_video_frames,
+            "dropped_audio_frames": self.dropped_audio_frames,
+            "sent_messages": self.sent_messages,
+            "sent_bytes": self.sent_bytes,
+            "queue_latency_ms": round(self.queue_latency_ms, 2),
+            "drain_ms": round(self.drain_ms, 2),
+            "flushes": self.flushes,
+            "urgent_flushes": self.urgent_flushes,
+            "size_flushes": self.size_flushes,
+            "bytes_per_flush": round(self.sent_bytes / self.flushes) if self.flushes else 0,
+            "messages_per_flush": round(self.sent_messages / self.flushes, 2) if self.flushes else 0.0,
+            "max_flush_bytes": self.max_flush_bytes,
+            "send_framing": self.send_framing,
+            "rtt_ms": round(self.rtt_ms, 2) if self.rtt_ms is not None else None,
+            "peer_user_id": self.peer_user_id,
+            "compression": self.compressor.get_stats() if self.compressor else None,
+        }
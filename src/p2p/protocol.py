@@ -1,6 +1,9 @@
 # src/p2p/protocol.py
 import json
-from typing import Dict, Any, Optional, List
+import struct
+import base64
+import zlib
+from typing import Dict, Any, Optional, List, Tuple, Union
 
 # Giả sử logger đã được cấu hình và import đúng cách
 try:
@@ -13,6 +16,11 @@ except ImportError:
             import traceback
             traceback.print_exc()
 
+try:
+    import zstandard # Tuỳ chọn: nén tốt và nhanh hơn zlib nếu cả hai peer đều có
+except ImportError:
+    zstandard = None
+
 # --- Định nghĩa các loại message type ---
 MSG_TYPE_GREETING = "greeting"         # Gửi khi mới kết nối
 MSG_TYPE_CHAT_MESSAGE = "chat_message" # Tin nhắn chat thông thường
@@ -26,14 +34,83 @@ MSG_TYPE_STATUS_UPDATE = "status"    # Cập nhật trạng thái user (tùy ch
 MSG_TYPE_LIVESTREAM_START = "livestream_start"     # Host báo bắt đầu stream
 MSG_TYPE_LIVESTREAM_END = "livestream_end"       # Host báo kết thúc stream
 MSG_TYPE_VIDEO_FRAME = "video_frame"           # Gói tin chứa dữ liệu frame video
+MSG_TYPE_AUDIO_FRAME = "audio_frame"           # Gói âm thanh ngắn (vài chục ms) của livestream
+MSG_TYPE_LIVESTREAM_SUBSCRIBE = "livestream_subscribe"     # Viewer đăng ký nhận frame của một stream
+MSG_TYPE_LIVESTREAM_UNSUBSCRIBE = "livestream_unsubscribe" # Viewer ngừng nhận frame
+MSG_TYPE_RELAY_ASSIGN = "relay_assign"   # Host giao cho viewer danh sách viewer con cần chuyển tiếp frame
+MSG_TYPE_RELAY_REPORT = "relay_report"   # Viewer báo cho host các peer mình kết nối được và tình trạng nhận frame
+MSG_TYPE_PING = "ping"                 # Đo RTT, P2PService tự trả lời
+MSG_TYPE_PONG = "pong"
+
+# --- Chế độ đóng gói (framing) trên đường truyền ---
+# JSON-lines: mỗi message là một dòng JSON kết thúc bằng '\n' (mặc định, tương thích ngược).
+# Binary: header cố định (magic | kind | flags | length) + payload, biên frame biết trước.
+# Chế độ gửi được thương lượng qua greeting; bên nhận luôn chấp nhận cả hai
+# vì byte magic không bao giờ là byte đầu của một dòng JSON UTF-8 hợp lệ.
+FRAMING_JSON_LINES = "json"
+FRAMING_BINARY = "binary"
+SUPPORTED_FRAMINGS = [FRAMING_BINARY, FRAMING_JSON_LINES] # Thứ tự ưu tiên
+
+BINARY_FRAME_MAGIC = 0xB1
+BINARY_HEADER = struct.Struct("!BBBI") # magic (1B), kind (1B), flags (1B), payload length (4B)
+BINARY_HEADER_SIZE = BINARY_HEADER.size
+MAX_FRAME_PAYLOAD = 64 * 1024 * 1024 # Giới hạn kích thước một frame để tránh phình bộ nhớ
+RECV_BUFFER_SIZE = 64 * 1024 # Kích thước ban đầu của buffer nhận, cũng là cỡ mỗi lần đọc socket
+MIN_RECV_SIZE = 4096 # Vùng trống tối thiểu cho một lần đọc
+LARGE_PAYLOAD_THRESHOLD = 16 * 1024 # Payload nhị phân từ cỡ này được nhận thẳng vào buffer riêng
+
+# --- Nén payload JSON của frame nhị phân (tuỳ chọn, thương lượng qua greeting) ---
+# Mỗi chiều của một kết nối dùng một ngữ cảnh nén theo luồng: mỗi message được flush riêng nhưng
+# bộ từ điển (các UUID kênh/user lặp lại, tên trường JSON...) được giữ qua các message,
+# nên cả message nhỏ lặp lại cũng nén được. Chỉ message từ COMPRESSION_MIN_BYTES mới được nén.
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_ZSTD = "zstd"
+SUPPORTED_COMPRESSIONS = ([COMPRESSION_ZSTD] if zstandard else []) + [COMPRESSION_ZLIB] # Thứ tự ưu tiên
+COMPRESSION_MIN_BYTES = 256
+FRAME_FLAG_ZLIB = 0x01 # Bit trong trường flags của header nhị phân
+FRAME_FLAG_ZSTD = 0x02
+_ZLIB_SYNC_TAIL = b"\x00\x00\xff\xff" # Đuôi cố định của Z_SYNC_FLUSH, bỏ khi gửi và thêm lại khi nhận
+
+# Loại payload trong frame nhị phân
+FRAME_KIND_JSON = 0x01 # Payload là message JSON UTF-8 (không có '\n')
+FRAME_KIND_VIDEO = 0x02 # Payload là video frame: header video cố định + streamer_id + JPEG thô
+FRAME_KIND_AUDIO = 0x03 # Payload là audio frame: header audio cố định + streamer_id + mẫu âm thanh
+
+# Header của video frame nhị phân: frame_id (4B), timestamp_ms (8B), video flags (1B), độ dài streamer_id (1B)
+VIDEO_FRAME_HEADER = struct.Struct("!IQBB")
+VIDEO_FLAG_KEYFRAME = 0x01 # Có: JPEG đầy đủ. Không: tập patch JPEG của các tile thay đổi so với frame trước
+
+# Header của audio frame nhị phân: seq (4B), timestamp_ms (8B, cùng đồng hồ với video), sample_rate (2B),
+# số kênh (1B), codec (1B), độ dài streamer_id (1B)
+AUDIO_FRAME_HEADER = struct.Struct("!IQHBBB")
+AUDIO_CODEC_PCM_S16LE = 0 # PCM 16-bit little-endian, các kênh xen kẽ
+
+# Frame delta (không phải keyframe): chuỗi patch, mỗi patch = header cố định + JPEG của vùng thay đổi
+TILE_PATCH_HEADER = struct.Struct("!HHHHI") # x, y, width, height (pixel), độ dài JPEG
 
 # --- Ví dụ cấu trúc Payload ---
-# greeting: {"user_id": "...", "display_name": "..."}
+# greeting: {"user_id": "...", "display_name": "...", "framing": ["binary", "json"], "compression": ["zstd", "zlib"]}
 # chat_message: {"sender_id": "...", "channel_id": "...", "content": "...", "timestamp_iso": "..."}
-# req_history: {"channel_id": "...", "since_timestamp_iso": "..." | None}
-# res_history: {"channel_id": "...", "messages": [ {message_dict}, ... ], "is_last_chunk": True/False}
+# req_history: {"channel_id": "...", "since_timestamp_iso": "..." | None, "since_id": "..." | None, "limit": int | None,
+#               "until_timestamp_iso": "..." | None}
+#   since_*: chỉ lấy tin nhắn sau mốc (timestamp, id) này (tiếp tục sau lần tải bị ngắt); không có mốc thì lấy
+#   'limit' tin nhắn mới nhất. until_timestamp_iso: khi tải tiếp, mốc trên của lần tải đầu (tin nhắn mới hơn
+#   peer đã nhận qua broadcast chat)
+# res_history: {"channel_id": "...", "messages": [ {message_dict}, ... ], "is_last_chunk": True/False,
+#               "until_timestamp_iso": "..."}
+#   until_timestamp_iso: mốc trên host đang dùng (chỉ gửi tin nhắn không mới hơn mốc này)
+#   message_dict: {"id", "user_id", "content", "timestamp_iso", "sender_display_name"}, cũ trước mới sau
 # status_update: {"user_id": "...", "status": "online|offline|invisible"}
-# video_frame: {"streamer_id": "...", "frame_id": int, "frame_data": "base64_encoded_jpeg"} # Cập nhật cấu trúc
+# livestream_start: {"streamer_id": "...", "streamer_name": "...", "relay": bool}
+# livestream_subscribe / livestream_unsubscribe: {"streamer_id": "..."}
+# relay_assign: {"streamer_id": "...", "children": ["user_id", ...], "epoch": int}
+# relay_report: {"streamer_id": "...", "reachable": ["user_id", ...], "missing_children": [...], "stalled": bool}
+# ping / pong: {"sent_ms": float}
+# audio_frame (chỉ framing nhị phân): {"streamer_id": "...", "seq": int, "timestamp_ms": int, "sample_rate": int,
+#   "channels": int, "codec": int, "audio_bytes": <PCM bytes>}
+# video_frame (JSON, peer cũ): {"streamer_id": "...", "frame_id": int, "frame_data": "base64_encoded_jpeg"}
+# video_frame (binary): {"streamer_id": "...", "frame_id": int, "timestamp_ms": int, "keyframe": bool, "frame_bytes": <JPEG bytes>}
+#   keyframe=False: frame_bytes là tập patch (pack_tile_patches), chỉ gửi qua framing nhị phân
 
 def create_message(msg_type: str, payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     """Tạo một dictionary message chuẩn với type và payload."""
@@ -58,12 +135,13 @@ def encode_message(message_dict: Dict[str, Any]) -> Optional[bytes]:
         log_event(f"[ERROR][P2P_PROTO] Unexpected error encoding message: {e}")
         return None
 
-def decode_message(data_bytes: bytes) -> Optional[Dict[str, Any]]:
+def decode_message(data_bytes: Union[bytes, bytearray, memoryview]) -> Optional[Dict[str, Any]]:
     """
     Chuyển đổi bytes UTF-8 (đã loại bỏ ký tự xuống dòng) thành dictionary.
+    Nhận cả memoryview trỏ vào buffer nhận để không phải chép dòng ra bytes trước.
     """
     try:
-        message_str = data_bytes.decode('utf-8').strip()
+        message_str = str(data_bytes, 'utf-8').strip()
         if not message_str: # Bỏ qua message rỗng
              return None
         payload = json.loads(message_str)
@@ -74,24 +152,478 @@ def decode_message(data_bytes: bytes) -> Optional[Dict[str, Any]]:
             log_event(f"[ERROR][P2P_PROTO] Decoded JSON is not a valid message structure (missing 'type'): {payload}")
             return None
     except json.JSONDecodeError:
-        log_event(f"[ERROR][P2P_PROTO] Failed to decode JSON message. Raw bytes: {data_bytes[:100]}...") # Log một phần dữ liệu lỗi
+        log_event(f"[ERROR][P2P_PROTO] Failed to decode JSON message. Raw bytes: {bytes(data_bytes[:100])}...") # Log một phần dữ liệu lỗi
         return None
     except UnicodeDecodeError:
-        log_event(f"[ERROR][P2P_PROTO] Failed to decode UTF-8 message. Raw bytes: {data_bytes[:100]}...")
+        log_event(f"[ERROR][P2P_PROTO] Failed to decode UTF-8 message. Raw bytes: {bytes(data_bytes[:100])}...")
         return None
     except Exception as e:
         log_event(f"[ERROR][P2P_PROTO] Failed to parse message: {e}")
         return None
 
+def encode_message_binary(message_dict: Dict[str, Any]) -> Optional[bytes]:
+    """
+    Đóng gói message thành frame nhị phân: header cố định + JSON UTF-8.
+    """
+    try:
+        body = json.dumps(message_dict, ensure_ascii=False).encode('utf-8')
+    except (TypeError, ValueError) as e:
+        log_event(f"[ERROR][P2P_PROTO] Failed to serialize message to JSON: {e}. Type: {message_dict.get('type')}")
+        return None
+    if len(body) > MAX_FRAME_PAYLOAD:
+        log_event(f"[ERROR][P2P_PROTO] Message too large for binary frame ({len(body)} bytes). Type: {message_dict.get('type')}")
+        return None
+    return BINARY_HEADER.pack(BINARY_FRAME_MAGIC, FRAME_KIND_JSON, 0, len(body)) + body
+
+def encode_video_frame_binary(payload: Dict[str, Any]) -> Optional[bytes]:
+    """
+    Đóng gói video frame thành frame nhị phân: JPEG đi ngay sau header, không qua base64/JSON.
+    """
+    try:
+        streamer_id_bytes = payload["streamer_id"].encode('utf-8')
+        frame_bytes = payload["frame_bytes"]
+        flags = VIDEO_FLAG_KEYFRAME if payload.get("keyframe", True) else 0
+        video_header = VIDEO_FRAME_HEADER.pack(
+            payload.get("frame_id", 0) & 0xFFFFFFFF,
+            payload.get("timestamp_ms", 0),
+            flags,
+            len(streamer_id_bytes)
+        )
+        length = len(video_header) + len(streamer_id_bytes) + len(frame_bytes)
+        if length > MAX_FRAME_PAYLOAD:
+            log_event(f"[ERROR][P2P_PROTO] Video frame too large for binary frame ({length} bytes).")
+            return None
+        frame_header = BINARY_HEADER.pack(BINARY_FRAME_MAGIC, FRAME_KIND_VIDEO, 0, length)
+        # join nhận trực tiếp buffer (bytes/memoryview) nên JPEG chỉ bị copy một lần
+        return b"".join((frame_header, video_header, streamer_id_bytes, frame_bytes))
+    except (KeyError, TypeError, struct.error) as e:
+        log_event(f"[ERROR][P2P_PROTO] Invalid video frame payload: {e}")
+        return None
+
+def encode_audio_frame_binary(payload: Dict[str, Any]) -> Optional[bytes]:
+    """Đóng gói audio frame thành frame nhị phân: mẫu âm thanh đi ngay sau header."""
+    try:
+        streamer_id_bytes = payload["streamer_id"].encode('utf-8')
+        audio_bytes = payload["audio_bytes"]
+        audio_header = AUDIO_FRAME_HEADER.pack(
+            payload.get("seq", 0) & 0xFFFFFFFF,
+            payload.get("timestamp_ms", 0),
+            payload["sample_rate"],
+            payload["channels"],
+            payload.get("codec", AUDIO_CODEC_PCM_S16LE),
+            len(streamer_id_bytes)
+        )
+        length = len(audio_header) + len(streamer_id_bytes) + len(audio_bytes)
+        frame_header = BINARY_HEADER.pack(BINARY_FRAME_MAGIC, FRAME_KIND_AUDIO, 0, length)
+        return b"".join((frame_header, audio_header, streamer_id_bytes, audio_bytes))
+    except (KeyError, TypeError, struct.error) as e:
+        log_event(f"[ERROR][P2P_PROTO] Invalid audio frame payload: {e}")
+        return None
+
+def _to_legacy_video_frame(message_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """Chuyển video frame dạng bytes sang dạng base64-in-JSON cho peer chỉ hỗ trợ JSON-lines."""
+    payload = message_dict.get("payload", {})
+    legacy_payload = create_video_frame_payload(
+        streamer_id=payload.get("streamer_id"),
+        frame_data_base64=base64.b64encode(payload["frame_bytes"]).decode('ascii'),
+        frame_id=payload.get("frame_id")
+    )
+    return create_message(MSG_TYPE_VIDEO_FRAME, legacy_payload)
+
+def encode_message_for(message_dict: Dict[str, Any], framing: str) -> Optional[bytes]:
+    """
+    Encode message theo chế độ framing đã thương lượng với peer.
+    Frame delta không có dạng JSON tương đương (peer cũ không ghép được patch) nên trả về None
+    cho JSON-lines; peer đó chỉ nhận keyframe. Audio cũng chỉ gửi qua framing nhị phân.
+    """
+    msg_type = message_dict.get("type")
+    is_raw_video = msg_type == MSG_TYPE_VIDEO_FRAME and "frame_bytes" in message_dict.get("payload", {})
+    if framing == FRAMING_BINARY:
+        if is_raw_video:
+            return encode_video_frame_binary(message_dict["payload"])
+        if msg_type == MSG_TYPE_AUDIO_FRAME:
+            return encode_audio_frame_binary(message_dict["payload"])
+        return encode_message_binary(message_dict)
+    if msg_type == MSG_TYPE_AUDIO_FRAME:
+        return None
+    if is_raw_video:
+        if not message_dict["payload"].get("keyframe", True):
+            return None
+        message_dict = _to_legacy_video_frame(message_dict)
+    return encode_message(message_dict)
+
+class PreEncodedMessage:
+    """
+    Message được serialize MỘT lần cho mỗi chế độ framing rồi dùng chung bytes (immutable)
+    cho mọi peer khi broadcast. Có thể tạo từ dict hoặc từ bytes đã encode sẵn.
+    """
+    __slots__ = ("message_dict", "msg_type", "is_keyframe", "_encoded")
+
+    def __init__(self, message_dict: Optional[Dict[str, Any]] = None,
+                 encoded: Optional[Dict[str, bytes]] = None, msg_type: Optional[str] = None,
+                 is_keyframe: Optional[bool] = None):
+        if message_dict is None and not encoded:
+            raise ValueError("PreEncodedMessage needs a message dict or pre-encoded bytes")
+        self.message_dict = message_dict
+        self.msg_type = msg_type or (message_dict or {}).get("type", "unknown")
+        if is_keyframe is None:
+            is_keyframe = bool((message_dict or {}).get("payload", {}).get("keyframe", True))
+        self.is_keyframe = is_keyframe # Dùng cho chính sách bỏ frame video trong hàng đợi gửi
+        self._encoded: Dict[str, Optional[bytes]] = dict(encoded or {})
+
+    def get_bytes(self, framing: str) -> Optional[bytes]:
+        """Trả về bytes cho chế độ framing, chỉ encode ở lần gọi đầu tiên."""
+        if framing in self._encoded:
+            return self._encoded[framing]
+        if self.message_dict is None:
+            log_event(f"[ERROR][P2P_PROTO] No '{framing}' encoding available for pre-encoded '{self.msg_type}'.")
+            return None
+        data = encode_message_for(self.message_dict, framing)
+        self._encoded[framing] = data
+        return data
+
+def pre_encode(message: Union[Dict[str, Any], PreEncodedMessage]) -> PreEncodedMessage:
+    """Bọc dict message thành PreEncodedMessage (giữ nguyên nếu đã là PreEncodedMessage)."""
+    if isinstance(message, PreEncodedMessage):
+        return message
+    return PreEncodedMessage(message)
+
+def negotiate_compression(peer_compressions: Optional[List[str]],
+                          local_compressions: Optional[List[str]] = None) -> Optional[str]:
+    """
+    Chọn thuật toán nén để GỬI tới peer (chỉ dùng với framing nhị phân).
+    Peer cũ không gửi trường 'compression' -> không nén.
+    """
+    if not isinstance(peer_compressions, list):
+        return None
+    for codec in (SUPPORTED_COMPRESSIONS if local_compressions is None else local_compressions):
+        if codec in peer_compressions and codec in SUPPORTED_COMPRESSIONS:
+            return codec
+    return None
+
+class StreamCompressor:
+    """
+    Ngữ cảnh nén chiều gửi của một kết nối. Phải được gọi đúng theo thứ tự các frame đi ra socket
+    (PeerConnection nén lúc ghi, sau khi đã xếp theo độ ưu tiên), vì bên nhận giải nén theo luồng.
+    """
+    def __init__(self, codec: str, level: Optional[int] = None, min_bytes: int = COMPRESSION_MIN_BYTES):
+        self.codec = codec
+        self.min_bytes = min_bytes
+        if codec == COMPRESSION_ZSTD:
+            self._context = zstandard.ZstdCompressor(level=level if level is not None else 3).compressobj()
+            self._flag = FRAME_FLAG_ZSTD
+        elif codec == COMPRESSION_ZLIB:
+            self._context = zlib.compressobj(level if level is not None else 6)
+            self._flag = FRAME_FLAG_ZLIB
+        else:
+            raise ValueError(f"Unsupported compression '{codec}'")
+        self.compressed_frames = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def compress_frame(self, frame: bytes) -> bytes:
+        """Nén frame JSON nhị phân đủ lớn; frame khác (JSON-lines, video, audio, frame nhỏ) giữ nguyên."""
+        if len(frame) < BINARY_HEADER_SIZE + self.min_bytes or frame[0] != BINARY_FRAME_MAGIC:
+            return frame
+        _, kind, flags, length = BINARY_HEADER.unpack_from(frame, 0)
+        if kind != FRAME_KIND_JSON or flags:
+            return frame
+        with memoryview(frame) as view:
+            body = view[BINARY_HEADER_SIZE:]
+            if self._flag == FRAME_FLAG_ZSTD:
+                compressed = self._context.compress(body) + self._context.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+            else:
+                compressed = self._context.compress(body) + self._context.flush(zlib.Z_SYNC_FLUSH)
+                if compressed.endswith(_ZLIB_SYNC_TAIL):
+                    compressed = compressed[:-len(_ZLIB_SYNC_TAIL)]
+        # Ngữ cảnh đã ghi nhận dữ liệu này nên luôn gửi bản nén, kể cả khi không nhỏ hơn
+        self.compressed_frames += 1
+        self.bytes_in += length
+        self.bytes_out += len(compressed)
+        return BINARY_HEADER.pack(BINARY_FRAME_MAGIC, FRAME_KIND_JSON, self._flag, len(compressed)) + compressed
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "codec": self.codec,
+            "compressed_frames": self.compressed_frames,
+            "ratio": round(self.bytes_out / self.bytes_in, 3) if self.bytes_in else None,
+        }
+
+def negotiate_framing(peer_framings: Optional[List[str]]) -> str:
+    """
+    Chọn chế độ framing để GỬI tới peer dựa trên danh sách peer quảng bá trong greeting.
+    Peer cũ không gửi trường 'framing' -> giữ JSON-lines.
+    """
+    if not isinstance(peer_framings, list):
+        return FRAMING_JSON_LINES
+    for framing in SUPPORTED_FRAMINGS:
+        if framing in peer_framings:
+            return framing
+    return FRAMING_JSON_LINES
+
+class FrameDecoder:
+    """
+    Tách frame từ luồng byte của một kết nối, hỗ trợ đồng thời JSON-lines và frame nhị phân.
+    Dữ liệu nằm trong một bytearray dùng lại được (vị trí đọc/ghi, chỉ dồn phần chưa xử lý về đầu
+    khi hết chỗ), không tạo bytes mới cho mỗi chunk. Có hai cách nạp dữ liệu:
+    - feed(data): chép chunk đã đọc (ví dụ từ StreamReader) vào buffer;
+    - get_buffer()/buffer_updated(): kiểu readinto/BufferedProtocol, socket ghi thẳng vào buffer.
+    Payload nhị phân lớn (frame video) được nhận thẳng vào một bytearray riêng đúng kích thước,
+    message giải mã ra trỏ vào đó bằng memoryview, không chép thêm lần nào.
+    """
+    def __init__(self, max_payload: int = MAX_FRAME_PAYLOAD, initial_size: int = RECV_BUFFER_SIZE):
+        self._buffer = bytearray(initial_size)
+        self._start = 0 # Vị trí byte chưa xử lý đầu tiên
+        self._end = 0   # Vị trí sau byte cuối cùng đã nhận
+        self._scan_from = 0 # Vị trí bắt đầu tìm '\n' cho dòng JSON đang dở
+        self._max_payload = max_payload
+        # Payload nhị phân lớn đang nhận dở: (kind, flags, buffer riêng, số byte đã có)
+        self._large: Optional[bytearray] = None
+        self._large_filled = 0
+        self._large_kind = 0
+        self._large_flags = 0
+        # Ngữ cảnh giải nén theo luồng, tạo khi gặp frame nén đầu tiên
+        self._zlib: Optional[Any] = None
+        self._zstd: Optional[Any] = None
+
+    def get_buffer(self, sizehint: int = -1) -> memoryview:
+        """Vùng trống để ghi dữ liệu nhận được vào (giống BufferedProtocol.get_buffer)."""
+        if self._large is not None:
+            return memoryview(self._large)[self._large_filled:]
+        self._reserve(sizehint if sizehint > 0 else MIN_RECV_SIZE)
+        return memoryview(self._buffer)[self._end:]
+
+    def buffer_updated(self, nbytes: int) -> List[Dict[str, Any]]:
+        """
+        Báo đã ghi nbytes vào vùng lấy từ get_buffer(); trả về các message hoàn chỉnh.
+        Raise ValueError nếu luồng dữ liệu hỏng không thể đồng bộ lại (kết nối nên bị đóng).
+        """
+        if self._large is not None:
+            self._large_filled += nbytes
+            if self._large_filled < len(self._large):
+                return []
+            payload, self._large = self._large, None
+            message_dict = self._decode_binary(self._large_kind, self._large_flags, memoryview(payload), owned=True)
+            return [message_dict] if message_dict else []
+        self._end += nbytes
+        return self._parse()
+
+    def feed(self, data: bytes) -> List[Dict[str, Any]]:
+        """Nạp một chunk đã đọc sẵn và trả về danh sách message hoàn chỉnh đã decode."""
+        messages: List[Dict[str, Any]] = []
+        with memoryview(data) as view:
+            offset = 0
+            while offset < len(view):
+                with self.get_buffer(len(view) - offset) as target:
+                    count = min(len(target), len(view) - offset)
+                    target[:count] = view[offset:offset + count]
+                offset += count
+                messages.extend(self.buffer_updated(count))
+        return messages
+
+    def _reserve(self, size: int):
+        """Đảm bảo có ít nhất size byte trống sau _end: dồn phần chưa xử lý về đầu hoặc cấp buffer lớn hơn."""
+        buf = self._buffer
+        if len(buf) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if pending + size <= len(buf):
+            # Cùng kích thước nên được phép kể cả khi còn memoryview trỏ vào buffer
+            with memoryview(buf) as view:
+                view[:pending] = view[self._start:self._end]
+        else:
+            # Cấp buffer mới thay vì resize tại chỗ (bytearray không resize được khi đang bị trỏ tới)
+            grown = bytearray(max(len(buf) * 2, pending + size))
+            grown[:pending] = memoryview(buf)[self._start:self._end]
+            self._buffer = grown
+        self._scan_from = max(0, self._scan_from - self._start)
+        self._start, self._end = 0, pending
+
+    def _parse(self) -> List[Dict[str, Any]]:
+        buf = self._buffer
+        messages: List[Dict[str, Any]] = []
+        pos = self._start
+        end = self._end
+        with memoryview(buf) as view:
+            while pos < end:
+                message_dict = None
+                if buf[pos] == BINARY_FRAME_MAGIC:
+                    if end - pos < BINARY_HEADER_SIZE:
+                        break # Chưa đủ header
+                    _, kind, flags, length = BINARY_HEADER.unpack_from(buf, pos)
+                    if length > self._max_payload:
+                        raise ValueError(f"Binary frame too large ({length} bytes)")
+                    payload_start = pos + BINARY_HEADER_SIZE
+                    frame_end = payload_start + length
+                    if frame_end > end:
+                        if length >= LARGE_PAYLOAD_THRESHOLD:
+                            # Nhận phần còn lại thẳng vào buffer riêng của payload
+                            self._large = bytearray(length)
+                            self._large_filled = end - payload_start
+                            self._large[:self._large_filled] = view[payload_start:end]
+                            self._large_kind, self._large_flags = kind, flags
+                            pos = end
+                        break # Chưa đủ payload
+                    message_dict = self._decode_binary(kind, flags, view[payload_start:frame_end], owned=False)
+                    pos = frame_end
+                else:
+                    newline_pos = buf.find(b'\n', max(pos, self._scan_from), end)
+                    if newline_pos < 0:
+                        if end - pos > self._max_payload:
+                            raise ValueError(f"JSON line exceeds {self._max_payload} bytes without newline")
+                        self._scan_from = end
+                        break
+                    line = view[pos:newline_pos]
+                    pos = newline_pos + 1
+                    message_dict = decode_message(line) # Dòng trống trả về None
+                if message_dict:
+                    messages.append(message_dict)
+
+        if pos >= end:
+            # Đã xử lý hết: quay về đầu buffer, không cần dồn dữ liệu
+            self._start = self._end = self._scan_from = 0
+        else:
+            self._start = pos
+        return messages
+
+    def _decode_binary(self, kind: int, flags: int, payload: memoryview, owned: bool) -> Optional[Dict[str, Any]]:
+        """owned=False: payload trỏ vào buffer nhận dùng lại, phải chép ra nếu message giữ lại dữ liệu."""
+        if kind == FRAME_KIND_JSON:
+            if flags & (FRAME_FLAG_ZLIB | FRAME_FLAG_ZSTD):
+                return decode_message(self._decompress(flags, payload))
+            return decode_message(payload)
+        if kind == FRAME_KIND_VIDEO:
+            return decode_video_frame_binary(payload if owned else bytes(payload))
+        if kind == FRAME_KIND_AUDIO:
+            return decode_audio_frame_binary(payload if owned else bytes(payload))
+        log_event(f"[WARN][P2P_PROTO] Unknown binary frame kind {kind} ({len(payload)} bytes). Skipping.")
+        return None
+
+    def _decompress(self, flags: int, payload: memoryview) -> bytes:
+        """Giải nén payload bằng ngữ cảnh của kết nối. Lỗi ở đây làm lệch luồng nên raise ValueError."""
+        try:
+            if flags & FRAME_FLAG_ZSTD:
+                if zstandard is None:
+                    raise ValueError("zstd-compressed frame received but zstandard is not installed")
+                if self._zstd is None:
+                    self._zstd = zstandard.ZstdDecompressor().decompressobj()
+                body = self._zstd.decompress(payload)
+            else:
+                if self._zlib is None:
+                    self._zlib = zlib.decompressobj()
+                body = self._zlib.decompress(payload, self._max_payload)
+                body += self._zlib.decompress(_ZLIB_SYNC_TAIL, self._max_payload)
+                if self._zlib.unconsumed_tail:
+                    raise ValueError(f"Decompressed frame exceeds {self._max_payload} bytes")
+        except Exception as e: # zlib.error, zstandard.ZstdError hoặc vượt giới hạn kích thước
+            raise ValueError(f"Corrupted compressed frame: {e}") from e
+        if len(body) > self._max_payload:
+            raise ValueError(f"Decompressed frame exceeds {self._max_payload} bytes")
+        return body
+
+def decode_video_frame_binary(payload: Union[bytes, bytearray, memoryview]) -> Optional[Dict[str, Any]]:
+    """
+    Giải mã payload của frame FRAME_KIND_VIDEO thành message video_frame.
+    'frame_bytes' là memoryview trỏ vào payload (không chép), đưa thẳng cho cv2.imdecode được.
+    """
+    header_size = VIDEO_FRAME_HEADER.size
+    if len(payload) < header_size:
+        log_event(f"[ERROR][P2P_PROTO] Video frame too short ({len(payload)} bytes).")
+        return None
+    frame_id, timestamp_ms, flags, id_len = VIDEO_FRAME_HEADER.unpack_from(payload, 0)
+    jpeg_start = header_size + id_len
+    if len(payload) < jpeg_start:
+        log_event("[ERROR][P2P_PROTO] Video frame truncated inside streamer_id.")
+        return None
+    try:
+        streamer_id = str(payload[header_size:jpeg_start], 'utf-8')
+    except UnicodeDecodeError:
+        log_event("[ERROR][P2P_PROTO] Video frame has invalid streamer_id encoding.")
+        return None
+    return create_message(MSG_TYPE_VIDEO_FRAME, create_raw_video_frame_payload(
+        streamer_id=streamer_id,
+        frame_bytes=memoryview(payload)[jpeg_start:],
+        frame_id=frame_id,
+        timestamp_ms=timestamp_ms,
+        is_keyframe=bool(flags & VIDEO_FLAG_KEYFRAME)
+    ))
+
+def decode_audio_frame_binary(payload: Union[bytes, bytearray, memoryview]) -> Optional[Dict[str, Any]]:
+    """Giải mã payload của frame FRAME_KIND_AUDIO thành message audio_frame."""
+    header_size = AUDIO_FRAME_HEADER.size
+    if len(payload) < header_size:
+        log_event(f"[ERROR][P2P_PROTO] Audio frame too short ({len(payload)} bytes).")
+        return None
+    seq, timestamp_ms, sample_rate, channels, codec, id_len = AUDIO_FRAME_HEADER.unpack_from(payload, 0)
+    audio_start = header_size + id_len
+    if len(payload) < audio_start:
+        log_event("[ERROR][P2P_PROTO] Audio frame truncated inside streamer_id.")
+        return None
+    try:
+        streamer_id = str(payload[header_size:audio_start], 'utf-8')
+    except UnicodeDecodeError:
+        log_event("[ERROR][P2P_PROTO] Audio frame has invalid streamer_id encoding.")
+        return None
+    return create_message(MSG_TYPE_AUDIO_FRAME, create_audio_frame_payload(
+        streamer_id=streamer_id,
+        audio_bytes=memoryview(payload)[audio_start:],
+        seq=seq,
+        timestamp_ms=timestamp_ms,
+        sample_rate=sample_rate,
+        channels=channels,
+        codec=codec
+    ))
+
+def pack_tile_patches(patches: List[Tuple[int, int, int, int, Any]]) -> bytes:
+    """Đóng gói danh sách patch (x, y, width, height, JPEG) thành frame_bytes của frame delta."""
+    parts = []
+    for x, y, width, height, jpeg_bytes in patches:
+        parts.append(TILE_PATCH_HEADER.pack(x, y, width, height, len(jpeg_bytes)))
+        parts.append(jpeg_bytes)
+    return b"".join(parts)
+
+def unpack_tile_patches(frame_bytes: Any) -> List[Tuple[int, int, int, int, memoryview]]:
+    """Tách frame_bytes của frame delta thành các patch; JPEG là memoryview không copy. ValueError nếu dữ liệu hỏng."""
+    view = memoryview(frame_bytes)
+    patches = []
+    offset = 0
+    while offset < len(view):
+        if len(view) - offset < TILE_PATCH_HEADER.size:
+            raise ValueError("Truncated tile patch header")
+        x, y, width, height, jpeg_len = TILE_PATCH_HEADER.unpack_from(view, offset)
+        offset += TILE_PATCH_HEADER.size
+        if len(view) - offset < jpeg_len:
+            raise ValueError("Truncated tile patch data")
+        patches.append((x, y, width, height, view[offset:offset + jpeg_len]))
+        offset += jpeg_len
+    return patches
+
 # --- Hàm tạo payload cho Livestream ---
-def create_livestream_start_payload(streamer_id: str, streamer_name: str) -> Dict[str, Any]:
-    """Tạo payload cho message bắt đầu livestream."""
-    return {"streamer_id": streamer_id, "streamer_name": streamer_name}
+def create_livestream_start_payload(streamer_id: str, streamer_name: str, relay: bool = False) -> Dict[str, Any]:
+    """Tạo payload cho message bắt đầu livestream. 'relay' báo viewer rằng host dùng cây chuyển tiếp."""
+    return {"streamer_id": streamer_id, "streamer_name": streamer_name, "relay": relay}
 
 def create_livestream_end_payload(streamer_id: str) -> Dict[str, Any]:
     """Tạo payload cho message kết thúc livestream."""
     return {"streamer_id": streamer_id}
 
+def create_livestream_subscribe_payload(streamer_id: str) -> Dict[str, Any]:
+    """Tạo payload đăng ký (hoặc huỷ đăng ký) nhận frame của stream do streamer_id phát."""
+    return {"streamer_id": streamer_id}
+
+def create_relay_assign_payload(streamer_id: str, children: List[str], epoch: int) -> Dict[str, Any]:
+    """Tạo payload giao cho một viewer danh sách viewer con (user_id) mà nó phải chuyển tiếp frame tới."""
+    return {"streamer_id": streamer_id, "children": children, "epoch": epoch}
+
+def create_relay_report_payload(streamer_id: str, reachable: List[str], missing_children: List[str],
+                                stalled: bool) -> Dict[str, Any]:
+    """Tạo payload viewer báo cáo cho host: peer kết nối được, con không chuyển tiếp được, có bị đứt frame không."""
+    return {"streamer_id": streamer_id, "reachable": reachable, "missing_children": missing_children, "stalled": stalled}
+
+def create_ping_payload(sent_ms: float) -> Dict[str, Any]:
+    """Tạo payload ping/pong; sent_ms là đồng hồ monotonic của bên gửi ping, được trả lại nguyên vẹn."""
+    return {"sent_ms": sent_ms}
+
 # **** HÀM ĐÃ ĐƯỢC CẬP NHẬT ****
 def create_video_frame_payload(streamer_id: str, frame_data_base64: str, frame_id: Optional[int] = None) -> Dict[str, Any]:
     """
@@ -114,12 +646,55 @@ def create_video_frame_payload(streamer_id: str, frame_data_base64: str, frame_i
     # log_event(f"[P2P_PROTO] Created video frame payload for streamer {streamer_id}, frame {frame_id}") # Log nếu cần
     return payload
 
+def create_raw_video_frame_payload(streamer_id: str, frame_bytes: Any, frame_id: int,
+                                   timestamp_ms: int, is_keyframe: bool = True) -> Dict[str, Any]:
+    """
+    Tạo payload video frame chứa JPEG thô (bytes hoặc memoryview), hoặc tập patch nếu is_keyframe=False.
+    Khi gửi, encode_message_for chọn frame nhị phân hoặc tự chuyển sang base64 cho peer cũ.
+    """
+    return {
+        "streamer_id": streamer_id,
+        "frame_id": frame_id,
+        "timestamp_ms": timestamp_ms,
+        "keyframe": is_keyframe,
+        "frame_bytes": frame_bytes
+    }
+
+def create_audio_frame_payload(streamer_id: str, audio_bytes: Any, seq: int, timestamp_ms: int,
+                               sample_rate: int, channels: int, codec: int = AUDIO_CODEC_PCM_S16LE) -> Dict[str, Any]:
+    """Tạo payload audio frame; timestamp_ms dùng cùng đồng hồ với video frame để viewer đồng bộ tiếng-hình."""
+    return {
+        "streamer_id": streamer_id,
+        "seq": seq,
+        "timestamp_ms": timestamp_ms,
+        "sample_rate": sample_rate,
+        "channels": channels,
+        "codec": codec,
+        "audio_bytes": audio_bytes
+    }
+
 # --- Các hàm trợ giúp tạo message cụ thể khác (Giữ nguyên) ---
 def create_chat_payload(sender_id: str, channel_id: str, content: str, timestamp_iso: str) -> Dict[str, Any]:
      return {"sender_id": sender_id, "channel_id": channel_id, "content": content, "timestamp_iso": timestamp_iso}
 
-def create_greeting_payload(user_id: str, display_name: str) -> Dict[str, Any]:
-     return {"user_id": user_id, "display_name": display_name}
+def create_greeting_payload(user_id: str, display_name: str, framing: Optional[List[str]] = None,
+                            compression: Optional[List[str]] = None) -> Dict[str, Any]:
+     # 'framing': các chế độ đóng gói mà bên gửi có thể NHẬN, theo thứ tự ưu tiên
+     # 'compression': các thuật toán nén bên gửi muốn NHẬN (danh sách rỗng = không muốn nhận frame nén)
+     return {"user_id": user_id, "display_name": display_name,
+             "framing": list(framing if framing is not None else SUPPORTED_FRAMINGS),
+             "compression": list(compression if compression is not None else SUPPORTED_COMPRESSIONS)}
+
+def create_history_request_payload(channel_id: str, since_timestamp_iso: Optional[str] = None,
+                                   since_id: Optional[str] = None, limit: Optional[int] = None,
+                                   until_timestamp_iso: Optional[str] = None) -> Dict[str, Any]:
+     return {"channel_id": channel_id, "since_timestamp_iso": since_timestamp_iso, "since_id": since_id, "limit": limit,
+             "until_timestamp_iso": until_timestamp_iso}
+
+def create_history_chunk_payload(channel_id: str, messages: List[Dict[str, Any]], is_last_chunk: bool,
+                                 until_timestamp_iso: Optional[str] = None) -> Dict[str, Any]:
+     return {"channel_id": channel_id, "messages": messages, "is_last_chunk": is_last_chunk,
+             "until_timestamp_iso": until_timestamp_iso}
 
 # ... (Thêm các hàm create_payload khác nếu cần) ...
 
@@ -1,6 +1,13 @@
 # src/storage/local_storage_service.py
-from typing import List, Optional, Any
+import asyncio
+import bisect
+import concurrent.futures
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
 import datetime
+import config
 from . import local_store # Import các hàm từ file trước
 from src.models.message import Message
 from src.utils.logger import log_event
@@ -9,12 +16,17 @@ from src.utils.logger import log_event
 _initialized = False
 
 class LocalStorageService:
-    """Lớp wrapper đơn giản cho các hàm trong local_store.py."""
+    """
+    Lớp wrapper đơn giản (đồng bộ) cho các hàm trong local_store.py.
+    Code chạy trên event loop nên dùng AsyncLocalStorageService để không chặn UI khi truy cập đĩa.
+    """
     def __init__(self):
         global _initialized
         if not _initialized:
             try:
-                local_store.init_storage()
+                local_store.init_storage(synchronous=config.LOCAL_STORE_SYNCHRONOUS,
+                                         group_commit_ms=config.LOCAL_STORE_GROUP_COMMIT_MS,
+                                         group_commit_max=config.LOCAL_STORE_GROUP_COMMIT_MAX)
                 _initialized = True
             except Exception as e:
                 log_event(f"[ERROR][STORAGE_SVC] Failed to initialize local storage: {e}")
@@ -22,20 +34,212 @@ class LocalStorageService:
 
     def add_message(self, message: Message) -> bool:
         """Lưu message vào local store."""
-        # TODO: Cân nhắc chạy trong thread nếu thao tác DB tốn thời gian
         if not _initialized:
              log_event("[ERROR][STORAGE_SVC] Storage not initialized. Cannot add message.")
              return False
         log_event(f"[STORAGE_SVC] Requesting to add message {message.id} locally.")
         return local_store.add_message(message)
 
+    def add_messages(self, messages: List[Message]) -> int:
+        """Lưu nhiều message trong một transaction (ví dụ: nhập backup từ server). Trả về số message đã lưu."""
+        if not _initialized:
+             log_event("[ERROR][STORAGE_SVC] Storage not initialized. Cannot add messages.")
+             return 0
+        return local_store.add_messages(messages)
+
+    def submit_message(self, message: Message) -> concurrent.futures.Future:
+        """
+        Lưu message qua group commit: không chờ ghi đĩa, Future nhận True khi message đã được commit
+        (cùng các message khác đến trong vài ms, xem LOCAL_STORE_GROUP_COMMIT_MS).
+        """
+        if not _initialized:
+             log_event("[ERROR][STORAGE_SVC] Storage not initialized. Cannot submit message.")
+             future: concurrent.futures.Future = concurrent.futures.Future()
+             future.set_result(False)
+             return future
+        return local_store.submit_message(message)
+
     def get_messages(self, channel_id: str, limit: int = 100, before_ts: Optional[datetime.datetime] = None) -> List[Message]:
         """Lấy messages từ local store."""
-        # TODO: Cân nhắc chạy trong thread nếu thao tác DB tốn thời gian
         if not _initialized:
              log_event("[ERROR][STORAGE_SVC] Storage not initialized. Cannot get messages.")
              return []
         log_event(f"[STORAGE_SVC] Requesting to get messages for {channel_id} locally.")
         return local_store.get_messages_for_channel(channel_id, limit, before_ts)
 
-    # Thêm các phương thức wrapper khác nếu cần (ví dụ: get_latest_timestamp)
\ No newline at end of file
+    def get_messages_before(self, channel_id: str, before_ts: Optional[datetime.datetime] = None,
+                            before_id: Optional[str] = None, limit: int = 100) -> List[Message]:
+        """
+        Lấy trang `limit` messages ngay trước mốc (before_ts, before_id) từ local store, cũ nhất trước
+        (cuộn ngược lịch sử; mốc của trang kế tiếp là message đầu tiên của trang này).
+        """
+        if not _initialized:
+             log_event("[ERROR][STORAGE_SVC] Storage not initialized. Cannot get messages.")
+             return []
+        return local_store.get_messages_before(channel_id, before_ts, before_id, limit)
+
+    def get_messages_after(self, channel_id: str, after_ts: Optional[datetime.datetime] = None,
+                           after_id: Optional[str] = None, limit: int = 100) -> List[Message]:
+        """Lấy messages sau mốc (after_ts, after_id) từ local store, cũ nhất trước (đọc tiếp từng phần)."""
+        if not _initialized:
+             log_event("[ERROR][STORAGE_SVC] Storage not initialized. Cannot get messages.")
+             return []
+        return local_store.get_messages_after(channel_id, after_ts, after_id, limit)
+
+    def search_messages(self, channel_id: str, query: str, cursor: Optional[Tuple[int, int]] = None,
+                        limit: int = 20) -> Tuple[List[local_store.SearchHit], Optional[Tuple[int, int]]]:
+        """
+        Tìm kiếm toàn văn trong tin nhắn của kênh: (các SearchHit đã xếp hạng kèm đoạn trích, cursor trang kế tiếp).
+        Truyền lại cursor nhận được để lấy trang sau; cursor None nghĩa là đã hết kết quả.
+        """
+        if not _initialized:
+             log_event("[ERROR][STORAGE_SVC] Storage not initialized. Cannot search messages.")
+             return [], None
+        return local_store.search_messages(channel_id, query, cursor, limit)
+
+    def close(self):
+        """Đóng các kết nối SQLite đang giữ (gọi khi thoát ứng dụng)."""
+        global _initialized
+        if _initialized:
+            local_store.close_storage()
+            _initialized = False
+
+    # Thêm các phương thức wrapper khác nếu cần (ví dụ: get_latest_timestamp)
+
+
+WAIT_BUCKETS_MS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 1000.0) # Cận trên mỗi bucket
+
+
+class LatencyHistogram:
+    """Histogram thời gian chờ (ms) theo các bucket cố định WAIT_BUCKETS_MS, bucket cuối là '> 1000 ms'."""
+
+    def __init__(self, bounds_ms: Tuple[float, ...] = WAIT_BUCKETS_MS):
+        self.bounds_ms = bounds_ms
+        self.counts = [0] * (len(bounds_ms) + 1)
+        self.total = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, wait_ms: float):
+        self.counts[bisect.bisect_left(self.bounds_ms, wait_ms)] += 1
+        self.total += 1
+        self.sum_ms += wait_ms
+        self.max_ms = max(self.max_ms, wait_ms)
+
+    def percentile(self, pct: float) -> float:
+        """Cận trên của bucket chứa phân vị pct (xấp xỉ); max_ms nếu rơi vào bucket cuối."""
+        if not self.total:
+            return 0.0
+        target = pct / 100.0 * self.total
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return self.bounds_ms[index] if index < len(self.bounds_ms) else self.max_ms
+        return self.max_ms
+
+    def snapshot(self) -> Dict[str, Any]:
+        labels = [f"<={bound:g}ms" for bound in self.bounds_ms] + [f">{self.bounds_ms[-1]:g}ms"]
+        return {
+            "count": self.total,
+            "avg_ms": round(self.sum_ms / self.total, 3) if self.total else 0.0,
+            "p50_ms": self.percentile(50),
+            "p99_ms": self.percentile(99),
+            "max_ms": round(self.max_ms, 3),
+            "buckets": {label: count for label, count in zip(labels, self.counts) if count},
+        }
+
+
+class AsyncLocalStorageService:
+    """
+    Mặt tiền bất đồng bộ cho LocalStorageService, dùng trên event loop (qasync):
+    mọi thao tác đọc/ghi chạy trên MỘT thread DB riêng qua hàng đợi yêu cầu, coroutine chỉ await future
+    nên UI không bị đứng khi đĩa chậm. Tin nhắn đơn lẻ đi qua group commit (thread ghi riêng của local_store).
+    Thời gian người gọi phải chờ được ghi vào histogram theo từng thao tác (get_wait_stats()).
+    API đồng bộ vẫn dùng được qua thuộc tính `sync`.
+    """
+
+    _STOP = object()
+
+    def __init__(self, sync_service: Optional[LocalStorageService] = None):
+        self.sync = sync_service or LocalStorageService()
+        self._requests: "queue.Queue" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="LocalStoreDB", daemon=True)
+        self._closed = False
+        self._wait_histograms: Dict[str, LatencyHistogram] = {}
+        self._thread.start()
+
+    def _run(self):
+        """Thread DB: lần lượt thực hiện các yêu cầu trong hàng đợi."""
+        while True:
+            request = self._requests.get()
+            if request is self._STOP:
+                return
+            func, args, future = request
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    async def _call(self, operation: str, func: Callable, *args) -> Any:
+        if self._closed:
+            raise RuntimeError("Local storage is closed")
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        started = time.perf_counter()
+        self._requests.put((func, args, future))
+        try:
+            return await asyncio.wrap_future(future)
+        finally:
+            self._record_wait(operation, started)
+
+    def _record_wait(self, operation: str, started: float):
+        histogram = self._wait_histograms.get(operation)
+        if histogram is None:
+            histogram = self._wait_histograms[operation] = LatencyHistogram()
+        histogram.record((time.perf_counter() - started) * 1000)
+
+    async def add_message(self, message: Message) -> bool:
+        """Lưu message (group commit); trả về True khi message đã được commit."""
+        started = time.perf_counter()
+        try:
+            return await asyncio.wrap_future(self.sync.submit_message(message))
+        finally:
+            self._record_wait("add_message", started)
+
+    async def add_messages(self, messages: List[Message]) -> int:
+        """Lưu nhiều message trong một transaction trên thread DB."""
+        return await self._call("add_messages", self.sync.add_messages, list(messages))
+
+    async def get_messages(self, channel_id: str, limit: int = 100,
+                           before_ts: Optional[datetime.datetime] = None) -> List[Message]:
+        return await self._call("get_messages", self.sync.get_messages, channel_id, limit, before_ts)
+
+    async def get_messages_before(self, channel_id: str, before_ts: Optional[datetime.datetime] = None,
+                                  before_id: Optional[str] = None, limit: int = 100) -> List[Message]:
+        return await self._call("get_messages_before", self.sync.get_messages_before, channel_id, before_ts, before_id, limit)
+
+    async def get_messages_after(self, channel_id: str, after_ts: Optional[datetime.datetime] = None,
+                                 after_id: Optional[str] = None, limit: int = 100) -> List[Message]:
+        return await self._call("get_messages_after", self.sync.get_messages_after, channel_id, after_ts, after_id, limit)
+
+    async def search_messages(self, channel_id: str, query: str, cursor: Optional[Tuple[int, int]] = None,
+                              limit: int = 20) -> Tuple[List[local_store.SearchHit], Optional[Tuple[int, int]]]:
+        return await self._call("search_messages", self.sync.search_messages, channel_id, query, cursor, limit)
+
+    def get_wait_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Histogram thời gian chờ của người gọi (ms) theo từng thao tác."""
+        return {operation: histogram.snapshot() for operation, histogram in self._wait_histograms.items()}
+
+    def close(self):
+        """Dừng thread DB sau khi xử lý hết yêu cầu đang chờ, rồi đóng storage (ghi nốt group commit)."""
+        if self._closed:
+            return
+        self._closed = True
+        self._requests.put(self._STOP)
+        self._thread.join()
+        for operation, stats in self.get_wait_stats().items():
+            log_event(f"[STORAGE_SVC] Wait time for {operation}: count={stats['count']} p50<={stats['p50_ms']}ms "
+                      f"p99<={stats['p99_ms']}ms max={stats['max_ms']}ms")
+        self.sync.close()
@@ -1,10 +1,17 @@
 # SegmentChatClient/src/storage/local_store.py
+import concurrent.futures
+import contextlib
+import queue
+import re
 import sqlite3
+import unicodedata
 import os
 import datetime
+import threading
+import time
+from dataclasses import dataclass
 from typing import List, Optional, Tuple
 from src.models.message import Message # Import model Message
-from typing import List, Any
 
 # Xác định đường dẫn đến file database SQLite
 _STORAGE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -17,103 +24,368 @@ except ImportError:
 
 # Biến cờ để đảm bảo DB được khởi tạo chỉ một lần
 _db_initialized = False
-_db_lock = None # Lock cho môi trường đa luồng
+_init_lock = threading.Lock() # Chỉ một thread được khởi tạo/đóng storage mỗi lúc
+
+READ_POOL_SIZE = 4 # Số kết nối chỉ đọc tối đa được giữ lại để dùng lại
+STATEMENT_CACHE_SIZE = 64 # Số câu lệnh đã biên dịch sqlite3 giữ lại trên mỗi kết nối
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA") # Giá trị hợp lệ của PRAGMA synchronous
+DEFAULT_SYNCHRONOUS = "FULL" # Mặc định của SQLite: fsync ở mỗi commit
+GROUP_COMMIT_DELAY_MS = 5.0 # GroupCommitWriter gom tin nhắn tối đa chừng này trước khi commit
+GROUP_COMMIT_MAX_BATCH = 256 # ... hoặc tới khi đủ chừng này tin nhắn
+SEARCH_RANK_WINDOW = 2000 # search_messages xếp hạng trong từng nhóm chừng này kết quả khớp mới nhất
+SEARCH_SNIPPET_TOKENS = 12 # Số từ tối đa của mỗi đoạn trích
+SEARCH_SNIPPET_MARKERS = ("[", "]", "…") # Mở/đóng quanh từ khớp, dấu lược bớt ở đầu/cuối đoạn trích
+
+# Câu lệnh SQL dùng chung ở mức module: cùng một chuỗi SQL trên cùng kết nối thì sqlite3 dùng lại
+# câu lệnh đã biên dịch trong cache, không phải parse/prepare lại mỗi lần gọi
+_SQL_INSERT_MESSAGE = """
+    INSERT OR REPLACE INTO messages (id, channel_id, user_id, content, timestamp, sender_display_name)
+    VALUES (?, ?, ?, ?, ?, ?);
+"""
+_SQL_SELECT_COLUMNS = "SELECT id, channel_id, user_id, content, timestamp, sender_display_name FROM messages"
+# Thứ tự tin nhắn là (timestamp, id): id phân định các tin nhắn trùng timestamp, nên mốc phân trang
+# (timestamp, id) luôn ổn định. So sánh row value "(timestamp, id) < (?, ?)" được SQLite dùng trực tiếp
+# làm khoảng tìm trên index (channel_id, timestamp, id): mỗi trang chỉ đọc đúng `limit` dòng dù kênh có bao
+# nhiêu tin nhắn (dạng "timestamp < ? OR (timestamp = ? AND id < ?)" buộc SQLite quét cả kênh).
+_SQL_LATEST_MESSAGES = _SQL_SELECT_COLUMNS + " WHERE channel_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?;"
+_SQL_LATEST_MESSAGES_BEFORE = _SQL_SELECT_COLUMNS + \
+    " WHERE channel_id = ? AND timestamp < ? ORDER BY timestamp DESC, id DESC LIMIT ?;"
+_SQL_MESSAGES_BEFORE_CURSOR = _SQL_SELECT_COLUMNS + \
+    " WHERE channel_id = ? AND (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC LIMIT ?;"
+_SQL_MESSAGES_AFTER_ALL = _SQL_SELECT_COLUMNS + " WHERE channel_id = ? ORDER BY timestamp ASC, id ASC LIMIT ?;"
+_SQL_MESSAGES_AFTER_TIMESTAMP = _SQL_SELECT_COLUMNS + " WHERE channel_id = ? AND timestamp > ? ORDER BY timestamp ASC, id ASC LIMIT ?;"
+_SQL_MESSAGES_AFTER_CURSOR = _SQL_SELECT_COLUMNS + \
+    " WHERE channel_id = ? AND (timestamp, id) > (?, ?) ORDER BY timestamp ASC, id ASC LIMIT ?;"
+
+
+# --- Tìm kiếm toàn văn (FTS5) ---
+# messages_fts là bảng FTS5 "external content": chỉ lưu index, nội dung đọc lại từ view messages_fts_source
+# (rowid của messages). Kênh được index thành MỘT token (hex của channel_id) để điều kiện lọc kênh là một
+# doclist thay vì cụm nhiều token của UUID. Trigger giữ index khớp với messages; INSERT OR REPLACE xóa dòng cũ
+# nên kết nối ghi cần PRAGMA recursive_triggers để trigger xóa được chạy. Rowid của messages là rowid ẩn:
+# VACUUM có thể đánh số lại, khi đó cần chạy lại lệnh 'rebuild' của messages_fts.
+_SQL_CREATE_SEARCH_INDEX = (
+    "CREATE VIEW IF NOT EXISTS messages_fts_source AS "
+    "SELECT rowid AS msg_rowid, content, hex(channel_id) AS channel_key FROM messages;",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, channel_key, "
+    "content='messages_fts_source', content_rowid='msg_rowid', tokenize='unicode61 remove_diacritics 2');",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_after_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content, channel_key) VALUES (new.rowid, new.content, hex(new.channel_id));
+    END;""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_after_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content, channel_key)
+        VALUES ('delete', old.rowid, old.content, hex(old.channel_id));
+    END;""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_after_update AFTER UPDATE OF content, channel_id ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content, channel_key)
+        VALUES ('delete', old.rowid, old.content, hex(old.channel_id));
+        INSERT INTO messages_fts(rowid, content, channel_key) VALUES (new.rowid, new.content, hex(new.channel_id));
+    END;""",
+)
+_SQL_SEARCH_REBUILD = "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild');"
+# Một trang kết quả trong một nhóm: nhóm là tối đa :window kết quả khớp mới nhất có rowid <= :top (một lượt duyệt
+# index theo rowid giảm dần). Điểm kiểu BM25 (k1=1.2, b=0.75) tính trong SQL từ số từ khớp của mỗi tin nhắn
+# (đếm dấu char(1) do highlight() chèn) và độ dài tin nhắn (số từ) so với trung bình của nhóm. Không dùng bm25()
+# của FTS5 vì nó tính IDF bằng cách duyệt doclist của từng từ trên TOÀN bảng ở mỗi truy vấn (~30 ms với một từ
+# phổ biến trong 1 triệu tin nhắn); mọi từ đều bắt buộc phải có nên bỏ IDF không đổi tập kết quả.
+# snippet() và dòng messages chỉ được đọc cho các dòng của trang (CROSS JOIN giữ thứ tự: tra theo rowid).
+_SQL_SEARCH_RANKED = """
+    WITH candidates AS (
+        SELECT rowid AS hit_rowid, highlight(messages_fts, 0, char(1), '') AS marked FROM messages_fts
+        WHERE messages_fts MATCH :match AND rowid <= :top ORDER BY rowid DESC LIMIT :window),
+    counted AS (
+        SELECT hit_rowid, length(marked) - length(replace(marked, char(1), '')) AS tf,
+               length(marked) - length(replace(marked, ' ', '')) + 1 AS dl
+        FROM candidates),
+    ranked AS (
+        SELECT hit_rowid, tf * 2.2 / (tf + 1.2 * (0.25 + 0.75 * dl / (SELECT avg(dl) FROM counted))) AS score,
+               (SELECT count(*) FROM counted) AS window_count, (SELECT min(hit_rowid) FROM counted) AS window_oldest,
+               (SELECT max(hit_rowid) FROM counted) AS window_newest
+        FROM counted ORDER BY score DESC, hit_rowid DESC LIMIT :limit OFFSET :offset)
+    SELECT m.id, m.channel_id, m.user_id, m.content, m.timestamp, m.sender_display_name,
+           snippet(messages_fts, 0, :open, :close, :ellipsis, :tokens), ranked.score,
+           ranked.window_count, ranked.window_oldest, ranked.window_newest
+    FROM ranked CROSS JOIN messages_fts CROSS JOIN messages AS m
+    WHERE messages_fts MATCH :match AND messages_fts.rowid = ranked.hit_rowid AND m.rowid = ranked.hit_rowid
+    ORDER BY ranked.score DESC, ranked.hit_rowid DESC;
+"""
+# Giới hạn của nhóm khi trang rỗng (không có dòng nào mang theo window_count/oldest/newest)
+_SQL_SEARCH_WINDOW = """
+    SELECT max(rowid), min(rowid), count(*) FROM (
+        SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? AND rowid <= ? ORDER BY rowid DESC LIMIT ?);
+"""
+_MAX_ROWID = 2 ** 63 - 1
+_SEARCH_TERM_PATTERN = re.compile(r"\w+")
+
+
+@dataclass
+class SearchHit:
+    """Một kết quả của search_messages."""
+    message: Message
+    snippet: str # Đoạn nội dung quanh các từ khớp, từ khớp nằm giữa SEARCH_SNIPPET_MARKERS
+    score: float # Điểm liên quan, càng lớn càng liên quan
+
+
+class _ConnectionManager:
+    """
+    Giữ kết nối SQLite sống suốt vòng đời ứng dụng thay vì mở/đóng mỗi lần gọi:
+    một kết nối ghi duy nhất (được khóa bằng _write_lock, SQLite chỉ cho một writer mỗi lúc)
+    và một pool nhỏ kết nối chỉ đọc. Ở chế độ WAL, reader không chặn writer và ngược lại,
+    nên đọc lịch sử không phải chờ một lần ghi đang diễn ra.
+    """
 
-try:
-    import threading
-    _db_lock = threading.Lock()
-except ImportError:
-    pass # Không dùng lock nếu không có threading
+    def __init__(self, db_file: str, read_pool_size: int = READ_POOL_SIZE, synchronous: str = DEFAULT_SYNCHRONOUS):
+        self.db_file = db_file
+        self.read_pool_size = read_pool_size
+        self.synchronous = synchronous
+        self._write_lock = threading.Lock()
+        self._writer: Optional[sqlite3.Connection] = None
+        self._pool_lock = threading.Lock()
+        self._idle_readers: List[sqlite3.Connection] = []
+        self._closed = False
+
+    def _connect(self, read_only: bool) -> sqlite3.Connection:
+        try:
+            if read_only:
+                # mode=ro: kết nối không thể ghi nhầm; check_same_thread=False vì kết nối được mượn/trả giữa các thread
+                conn = sqlite3.connect(f"file:{self.db_file}?mode=ro", uri=True, timeout=10,
+                                       check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+            else:
+                conn = sqlite3.connect(self.db_file, timeout=10, check_same_thread=False,
+                                       cached_statements=STATEMENT_CACHE_SIZE)
+                conn.execute("PRAGMA foreign_keys = ON;")
+                # Chế độ WAL lưu trong file DB; reader đọc song song với writer
+                conn.execute("PRAGMA journal_mode=WAL;")
+                # NORMAL (với WAL): commit không fsync, chỉ fsync khi checkpoint -> mất điện có thể mất vài
+                # transaction cuối nhưng DB không hỏng. FULL: fsync ở mỗi commit.
+                conn.execute(f"PRAGMA synchronous={self.synchronous};")
+                # INSERT OR REPLACE chạy trigger xóa (giữ index tìm kiếm messages_fts khớp) chỉ khi bật pragma này
+                conn.execute("PRAGMA recursive_triggers = ON;")
+            return conn
+        except sqlite3.Error as e:
+            log_event(f"[ERROR][STORAGE] Could not connect to SQLite database '{self.db_file}' (read_only={read_only}): {e}")
+            raise # Raise lỗi lên để nơi gọi xử lý
+
+    @contextlib.contextmanager
+    def writer(self):
+        """Mượn kết nối ghi (độc quyền) cho tới khi khối with kết thúc."""
+        with self._write_lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Local storage is closed")
+            if self._writer is None:
+                self._writer = self._connect(read_only=False)
+            yield self._writer
+
+    @contextlib.contextmanager
+    def reader(self):
+        """Mượn một kết nối chỉ đọc từ pool (mở thêm nếu pool đang hết), trả lại khi xong."""
+        with self._pool_lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Local storage is closed")
+            conn = self._idle_readers.pop() if self._idle_readers else None
+        if conn is None:
+            conn = self._connect(read_only=True)
+        try:
+            yield conn
+        finally:
+            with self._pool_lock:
+                keep = not self._closed and len(self._idle_readers) < self.read_pool_size
+                if keep:
+                    self._idle_readers.append(conn)
+            if not keep:
+                conn.close()
+
+    def close(self):
+        """Đóng mọi kết nối (khi thoát ứng dụng)."""
+        with self._write_lock, self._pool_lock:
+            self._closed = True
+            readers, self._idle_readers = self._idle_readers, []
+            writer, self._writer = self._writer, None
+        for conn in readers:
+            conn.close()
+        if writer is not None:
+            writer.close()
 
-def _get_db_connection() -> sqlite3.Connection:
-    """Mở kết nối đến database SQLite."""
-    try:
-        # isolation_level=None để tự quản lý transaction hoặc bật autocommit (tuỳ nhu cầu)
-        # Hoặc để mặc định và dùng conn.commit() / conn.rollback()
-        # timeout để tránh lỗi database is locked nếu nhiều thread truy cập
-        conn = sqlite3.connect(DB_FILE, timeout=10, check_same_thread=False) # check_same_thread=False nếu dùng đa luồng
-        # Đặt row_factory để trả về dict thay vì tuple (tùy chọn)
-        # conn.row_factory = sqlite3.Row
-        return conn
-    except sqlite3.Error as e:
-        log_event(f"[ERROR][STORAGE] Could not connect to SQLite database '{DB_FILE}': {e}")
-        raise # Raise lỗi lên để nơi gọi xử lý
 
-def init_storage():
+class GroupCommitWriter:
     """
-    Khởi tạo database và bảng nếu chưa tồn tại.
+    Thread ghi nền cho tin nhắn trực tiếp: gom các tin nhắn được submit trong tối đa commit_delay_ms
+    (hoặc tới max_batch tin nhắn) rồi ghi cả nhóm bằng một transaction, nên một loạt tin nhắn đến dồn dập
+    chỉ tốn một lần commit (một fsync với synchronous=FULL) thay vì mỗi tin một lần.
+    submit() trả về concurrent.futures.Future, nhận True khi tin nhắn đã được commit, False nếu ghi lỗi.
+    """
+
+    _STOP = object()
+
+    def __init__(self, commit_delay_ms: float = GROUP_COMMIT_DELAY_MS, max_batch: int = GROUP_COMMIT_MAX_BATCH):
+        self.commit_delay_ms = max(0.0, commit_delay_ms)
+        self.max_batch = max(1, max_batch)
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="LocalStoreGroupCommit", daemon=True)
+        self._stopped = False
+        # --- Metrics ---
+        self.commits = 0
+        self.committed_messages = 0
+        self._thread.start()
+
+    def submit(self, message: Message) -> concurrent.futures.Future:
+        """
+        Đưa tin nhắn vào nhóm ghi kế tiếp (không chờ). Tin nhắn được chuyển thành tham số ghi ngay tại đây,
+        nên tin nhắn không hợp lệ chỉ làm hỏng Future của chính nó chứ không cả nhóm ghi cùng.
+        """
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        if self._stopped:
+            future.set_result(False)
+            return future
+        try:
+            params = _message_params(message)
+        except Exception as e:
+            log_event(f"[ERROR][STORAGE] Invalid message '{getattr(message, 'id', None)}' not queued for group commit: {e}",
+                      exc_info=True)
+            future.set_result(False)
+            return future
+        self._queue.put((params, future))
+        return future
+
+    def close(self):
+        """Ghi nốt các tin nhắn đang chờ rồi dừng thread."""
+        if self._stopped:
+            return
+        self._stopped = True
+        self._queue.put(self._STOP)
+        self._thread.join()
+        while True: # Tin nhắn submit sau lúc dừng sẽ không bao giờ được ghi
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not self._STOP:
+                item[1].set_result(False)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                return
+            batch = [item]
+            stopping = False
+            deadline = time.monotonic() + self.commit_delay_ms / 1000.0
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            success = False
+            try:
+                success = _insert_message_params([params for params, _ in batch]) == len(batch)
+                self.commits += 1
+                if success:
+                    self.committed_messages += len(batch)
+            except Exception as e: # Lỗi bất ngờ không được làm chết thread: mọi lần submit sau sẽ chờ mãi
+                log_event(f"[ERROR][STORAGE] Group commit of {len(batch)} messages failed: {e}", exc_info=True)
+            finally:
+                for _, future in batch:
+                    future.set_result(success)
+            if stopping:
+                return
+
+    def get_stats(self) -> dict:
+        return {"commits": self.commits, "committed_messages": self.committed_messages,
+                "messages_per_commit": round(self.committed_messages / self.commits, 2) if self.commits else 0.0,
+                "pending": self._queue.qsize()}
+
+
+_connections: Optional[_ConnectionManager] = None
+_group_writer: Optional[GroupCommitWriter] = None
+
+def init_storage(synchronous: str = DEFAULT_SYNCHRONOUS, group_commit_ms: float = GROUP_COMMIT_DELAY_MS,
+                 group_commit_max: int = GROUP_COMMIT_MAX_BATCH):
+    """
+    Khởi tạo database và bảng nếu chưa tồn tại, mở kết nối ghi dùng chung và thread group commit.
     Cần được gọi một lần khi ứng dụng khởi động.
+    synchronous: giá trị PRAGMA synchronous của kết nối ghi (xem SYNCHRONOUS_MODES).
     """
-    global _db_initialized
     if _db_initialized:
         return
+    synchronous = str(synchronous).upper()
+    if synchronous not in SYNCHRONOUS_MODES:
+        log_event(f"[WARN][STORAGE] Invalid synchronous mode '{synchronous}', using {DEFAULT_SYNCHRONOUS}.")
+        synchronous = DEFAULT_SYNCHRONOUS
+    with _init_lock:
+        # Kiểm tra lại _db_initialized bên trong lock
+        if not _db_initialized:
+            _init_storage_locked(synchronous, group_commit_ms, group_commit_max)
 
-    log_event(f"[STORAGE] Initializing local storage at '{DB_FILE}'...")
-    conn = None # Khởi tạo conn là None
-    acquired_lock = False
-    try:
-        # Dùng lock nếu có thể
-        if _db_lock:
-            _db_lock.acquire()
-            acquired_lock = True
 
-        # Kiểm tra lại _db_initialized bên trong lock
-        if _db_initialized:
-             if acquired_lock: _db_lock.release()
-             return
-
-        conn = _get_db_connection()
-        cursor = conn.cursor()
-
-        # Bật foreign keys (nếu có kế hoạch dùng)
-        cursor.execute("PRAGMA foreign_keys = ON;")
-        # Chế độ WAL thường tốt hơn cho ghi đồng thời (dù đây là client)
-        cursor.execute("PRAGMA journal_mode=WAL;")
-
-        # Tạo bảng messages nếu chưa tồn tại
-        # Lưu timestamp dưới dạng TEXT theo chuẩn ISO 8601 (dễ đọc và chuẩn)
-        # Hoặc dùng INTEGER lưu Unix timestamp (số giây từ epoch)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id TEXT PRIMARY KEY,                  -- UUID dạng TEXT làm khóa chính
-                channel_id TEXT NOT NULL,
-                user_id TEXT NOT NULL,
-                content TEXT,
-                timestamp TEXT NOT NULL,              -- Lưu dạng ISO 8601 UTC: 'YYYY-MM-DDTHH:MM:SS.ffffff+00:00'
-                sender_display_name TEXT
-            );
-        """)
-
-        # Tạo index để tăng tốc độ truy vấn theo kênh và thời gian
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_channel_timestamp ON messages (channel_id, timestamp);")
-
-        # TODO: Tạo các bảng khác nếu cần (ví dụ: channels, users_info...)
-
-        conn.commit()
+def _init_storage_locked(synchronous: str, group_commit_ms: float, group_commit_max: int):
+    global _db_initialized, _connections, _group_writer
+    log_event(f"[STORAGE] Initializing local storage at '{DB_FILE}' (synchronous={synchronous})...")
+    manager = _ConnectionManager(DB_FILE, synchronous=synchronous)
+    try:
+        with manager.writer() as conn:
+            try:
+                # Tạo bảng messages nếu chưa tồn tại
+                # Lưu timestamp dưới dạng TEXT theo chuẩn ISO 8601 (dễ đọc và chuẩn)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS messages (
+                        id TEXT PRIMARY KEY,                  -- UUID dạng TEXT làm khóa chính
+                        channel_id TEXT NOT NULL,
+                        user_id TEXT NOT NULL,
+                        content TEXT,
+                        timestamp TEXT NOT NULL,              -- Lưu dạng ISO 8601 UTC: 'YYYY-MM-DDTHH:MM:SS.ffffff+00:00'
+                        sender_display_name TEXT
+                    );
+                """)
+
+                # Index theo kênh và thứ tự hiển thị (timestamp, id) cho phân trang keyset.
+                # Index cũ (channel_id, timestamp) là tiền tố của index này nên được bỏ đi.
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_channel_timestamp_id ON messages (channel_id, timestamp, id);")
+                conn.execute("DROP INDEX IF EXISTS idx_messages_channel_timestamp;")
+
+                # Index tìm kiếm toàn văn; DB cũ đã có tin nhắn thì index lại toàn bộ một lần
+                has_search_index = conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts';").fetchone()
+                for sql in _SQL_CREATE_SEARCH_INDEX:
+                    conn.execute(sql)
+                if not has_search_index:
+                    conn.execute(_SQL_SEARCH_REBUILD)
+
+                # TODO: Tạo các bảng khác nếu cần (ví dụ: channels, users_info...)
+
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback() # Hoàn tác nếu có lỗi
+                raise
         log_event("[STORAGE] Database tables checked/created successfully.")
+        _connections = manager
         _db_initialized = True
-
+        _group_writer = GroupCommitWriter(group_commit_ms, group_commit_max)
     except sqlite3.Error as e:
         log_event(f"[ERROR][STORAGE] Failed to initialize database tables: {e}")
-        if conn:
-            conn.rollback() # Hoàn tác nếu có lỗi
-    finally:
-        if conn:
-            conn.close()
-        if acquired_lock: # Chỉ release nếu đã acquire
-            _db_lock.release()
+        manager.close()
 
 
-def add_message(message: Message) -> bool:
-    """
-    Thêm một tin nhắn mới vào CSDL cục bộ.
-    Tự động tạo ID nếu message.id là None.
-    """
-    if not _db_initialized:
-        log_event("[ERROR][STORAGE] Storage not initialized. Cannot add message.")
-        # Hoặc thử gọi init_storage() ở đây? Cần cẩn thận.
-        return False
+def close_storage():
+    """Đóng các kết nối SQLite đang giữ (khi thoát ứng dụng); init_storage() có thể được gọi lại sau đó."""
+    global _db_initialized, _connections, _group_writer
+    with _init_lock:
+        writer, _group_writer = _group_writer, None
+        if writer is not None:
+            writer.close() # Ghi nốt tin nhắn đang chờ trước khi đóng kết nối
+        manager, _connections = _connections, None
+        _db_initialized = False
+    if manager is not None:
+        manager.close()
+        log_event("[STORAGE] Local storage connections closed.")
 
+
+def _message_params(message: Message) -> Tuple:
+    """Tham số cho _SQL_INSERT_MESSAGE; tạo ID nếu message.id là None."""
     # Tạo ID nếu chưa có (nên tạo UUID chuẩn)
     if message.id is None:
         import uuid
@@ -122,11 +394,7 @@ def add_message(message: Message) -> bool:
     # Chuyển timestamp sang string ISO 8601 UTC
     ts_iso = message.timestamp.astimezone(datetime.timezone.utc).isoformat()
 
-    sql = """
-        INSERT OR REPLACE INTO messages (id, channel_id, user_id, content, timestamp, sender_display_name)
-        VALUES (?, ?, ?, ?, ?, ?);
-    """
-    params = (
+    return (
         message.id,
         message.channel_id,
         message.user_id,
@@ -135,19 +403,27 @@ def add_message(message: Message) -> bool:
         message.sender_display_name
     )
 
-    conn = None
-    acquired_lock = False
+
+def add_message(message: Message) -> bool:
+    """
+    Thêm một tin nhắn mới vào CSDL cục bộ.
+    Tự động tạo ID nếu message.id là None.
+    """
+    if not _db_initialized:
+        log_event("[ERROR][STORAGE] Storage not initialized. Cannot add message.")
+        # Hoặc thử gọi init_storage() ở đây? Cần cẩn thận.
+        return False
+
+    params = _message_params(message)
     success = False
-    log_event(f"[STORAGE][ATTEMPT] Attempting to add/replace message ID: {message.id} for channel: {message.channel_id}")
     try:
-        if _db_lock:
-            _db_lock.acquire()
-            acquired_lock = True
-
-        conn = _get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(sql, params)
-        conn.commit()
+        with _connections.writer() as conn:
+            try:
+                conn.execute(_SQL_INSERT_MESSAGE, params)
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
         log_event(f"[STORAGE] Message '{message.id}' added to local DB for channel {message.channel_id}.")
         success = True
     except sqlite3.IntegrityError:
@@ -156,89 +432,229 @@ def add_message(message: Message) -> bool:
          success = True # Giả sử trùng ID không phải lỗi nghiêm trọng
     except sqlite3.Error as e:
         log_event(f"[ERROR][STORAGE] Failed to add message '{message.id}': {e}")
-        if conn:
-            conn.rollback()
-    finally:
-        if conn:
-            conn.close()
-        if acquired_lock:
-             _db_lock.release()
     return success
 
 
+def add_messages(messages: List[Message]) -> int:
+    """
+    Thêm nhiều tin nhắn trong MỘT transaction (executemany, một lần commit).
+    Trả về số tin nhắn đã ghi: len(messages) nếu thành công, 0 nếu lỗi (transaction được hoàn tác toàn bộ).
+    """
+    if not _db_initialized:
+        log_event("[ERROR][STORAGE] Storage not initialized. Cannot add messages.")
+        return 0
+    if not messages:
+        return 0
+
+    return _insert_message_params([_message_params(message) for message in messages])
+
+
+def _insert_message_params(params: List[Tuple]) -> int:
+    """Ghi các bộ tham số của _message_params trong một transaction; trả về số tin nhắn đã ghi (0 nếu lỗi)."""
+    if not _db_initialized:
+        log_event("[ERROR][STORAGE] Storage not initialized. Cannot add messages.")
+        return 0
+    try:
+        with _connections.writer() as conn:
+            try:
+                conn.executemany(_SQL_INSERT_MESSAGE, params)
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+    except sqlite3.Error as e:
+        log_event(f"[ERROR][STORAGE] Failed to add {len(params)} messages in one transaction: {e}")
+        return 0
+    log_event(f"[STORAGE] {len(params)} messages added to local DB in one transaction.")
+    return len(params)
+
+
+def submit_message(message: Message) -> concurrent.futures.Future:
+    """
+    Ghi tin nhắn qua GroupCommitWriter (commit chung với các tin nhắn đến trong vài ms tới).
+    Không chờ; Future nhận True khi tin nhắn đã được commit.
+    """
+    writer = _group_writer
+    if not _db_initialized or writer is None:
+        log_event("[ERROR][STORAGE] Storage not initialized. Cannot submit message.")
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        future.set_result(False)
+        return future
+    return writer.submit(message)
+
+
+def get_group_commit_stats() -> Optional[dict]:
+    """Metrics của GroupCommitWriter (số lần commit, số tin nhắn mỗi lần commit)."""
+    writer = _group_writer
+    return writer.get_stats() if writer else None
+
+
+def _row_to_message(row: Tuple) -> Message:
+    """Chuyển một dòng (id, channel_id, user_id, content, timestamp, sender_display_name) thành Message."""
+    msg_id, chan_id, user_id, content, ts_str, sender_name = row
+    # Chuyển đổi timestamp từ string ISO format sang datetime object
+    timestamp = datetime.datetime.now(datetime.timezone.utc) # Default nếu lỗi
+    try:
+         timestamp = datetime.datetime.fromisoformat(ts_str)
+         # Đảm bảo có timezone (sqlite không lưu tz, nhưng isoformat() cần nó)
+         if timestamp.tzinfo is None:
+              timestamp = timestamp.replace(tzinfo=datetime.timezone.utc) # Giả định là UTC
+    except ValueError:
+         log_event(f"[WARN][STORAGE] Could not parse timestamp string from DB: {ts_str}")
+
+    return Message(
+        id=msg_id,
+        channel_id=chan_id,
+        user_id=user_id,
+        content=content,
+        timestamp=timestamp,
+        sender_display_name=sender_name
+    )
+
+
+def _fetch_messages(sql: str, params: Tuple) -> List[Message]:
+    """Chạy một truy vấn SELECT tin nhắn trên kết nối chỉ đọc mượn từ pool."""
+    with _connections.reader() as conn:
+        rows = conn.execute(sql, params).fetchall()
+    return [_row_to_message(row) for row in rows]
+
+
 def get_messages_for_channel(channel_id: str, limit: int = 100, before_timestamp: Optional[datetime.datetime] = None) -> List[Message]:
     """
     Lấy danh sách tin nhắn cho một kênh từ CSDL cục bộ.
     Sắp xếp theo thời gian tăng dần (cũ nhất trước).
-    Có thể lấy các tin nhắn trước một thời điểm cụ thể (để phân trang).
+    Có thể lấy các tin nhắn trước một thời điểm cụ thể (để phân trang, xem thêm get_messages_before).
+    """
+    messages = get_messages_before(channel_id, before_timestamp, None, limit)
+    log_event(f"[STORAGE] Fetched {len(messages)} messages locally for channel {channel_id}.")
+    return messages
+
+
+def get_messages_before(channel_id: str, before_timestamp: Optional[datetime.datetime] = None,
+                        before_id: Optional[str] = None, limit: int = 100) -> List[Message]:
+    """
+    Lấy tối đa `limit` tin nhắn MỚI NHẤT của kênh nằm TRƯỚC mốc (before_timestamp, before_id), cũ nhất trước.
+    Trang kế tiếp (cũ hơn) dùng mốc (messages[0].timestamp, messages[0].id); trả về ít hơn `limit` tin nhắn
+    nghĩa là đã tới đầu kênh. before_timestamp=None: trang mới nhất; before_id=None: mọi tin nhắn có
+    timestamp nhỏ hơn before_timestamp.
     """
     if not _db_initialized:
         log_event("[ERROR][STORAGE] Storage not initialized. Cannot get messages.")
         return []
 
+    # Lấy mới nhất trước, sau đó đảo ngược
+    if not before_timestamp:
+        sql, params = _SQL_LATEST_MESSAGES, (channel_id, limit)
+    else:
+        # Lấy các tin nhắn CŨ HƠN mốc cung cấp
+        ts_iso = before_timestamp.astimezone(datetime.timezone.utc).isoformat()
+        if before_id:
+            sql, params = _SQL_MESSAGES_BEFORE_CURSOR, (channel_id, ts_iso, before_id, limit)
+        else:
+            sql, params = _SQL_LATEST_MESSAGES_BEFORE, (channel_id, ts_iso, limit)
+
     messages: List[Message] = []
-    sql = """
-        SELECT id, channel_id, user_id, content, timestamp, sender_display_name
-        FROM messages
-        WHERE channel_id = ?
-    """
-    params: List[Any] = [channel_id]
+    try:
+        messages = _fetch_messages(sql, params)
+    except sqlite3.Error as e:
+        log_event(f"[ERROR][STORAGE] Failed to get messages before {before_timestamp} for channel {channel_id}: {e}")
 
-    if before_timestamp:
-        # Lấy các tin nhắn CŨ HƠN thời điểm cung cấp
-        ts_iso = before_timestamp.astimezone(datetime.timezone.utc).isoformat()
-        sql += " AND timestamp < ? "
-        params.append(ts_iso)
+    # Đảo ngược danh sách để có thứ tự thời gian tăng dần (cũ trước, mới sau)
+    messages.reverse()
+    return messages
+
+
+def get_messages_after(channel_id: str, after_timestamp: Optional[datetime.datetime] = None,
+                       after_id: Optional[str] = None, limit: int = 100) -> List[Message]:
+    """
+    Lấy tối đa `limit` tin nhắn của kênh nằm SAU mốc (after_timestamp, after_id), cũ nhất trước.
+    Mốc gồm cả id để các tin nhắn trùng timestamp không bị bỏ sót hay lặp lại khi đọc tiếp từng phần;
+    after_id=None nghĩa là lấy mọi tin nhắn có timestamp lớn hơn after_timestamp.
+    """
+    if not _db_initialized:
+        log_event("[ERROR][STORAGE] Storage not initialized. Cannot get messages.")
+        return []
 
-    sql += " ORDER BY timestamp DESC LIMIT ?;" # Lấy mới nhất trước, sau đó đảo ngược
-    params.append(limit)
+    if not after_timestamp:
+        sql, params = _SQL_MESSAGES_AFTER_ALL, (channel_id, limit)
+    else:
+        ts_iso = after_timestamp.astimezone(datetime.timezone.utc).isoformat()
+        if after_id:
+            sql, params = _SQL_MESSAGES_AFTER_CURSOR, (channel_id, ts_iso, after_id, limit)
+        else:
+            sql, params = _SQL_MESSAGES_AFTER_TIMESTAMP, (channel_id, ts_iso, limit)
 
-    conn = None
-    acquired_lock = False
     try:
-        if _db_lock:
-            _db_lock.acquire()
-            acquired_lock = True
+        return _fetch_messages(sql, params)
+    except sqlite3.Error as e:
+        log_event(f"[ERROR][STORAGE] Failed to get messages after {after_timestamp} for channel {channel_id}: {e}")
+        return []
 
-        conn = _get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(sql, params)
-        rows = cursor.fetchall()
 
-        log_event(f"[STORAGE] Fetched {len(rows)} messages locally for channel {channel_id}.")
+def _search_match_expression(channel_id: str, query: str) -> Optional[str]:
+    """
+    Biểu thức MATCH của FTS5 cho truy vấn người dùng gõ: mọi từ phải có trong nội dung (AND), trong kênh
+    channel_id. Từ được tách và đặt trong ngoặc kép nên dấu câu hay cú pháp FTS5 trong truy vấn không gây lỗi.
+    None nếu truy vấn không có từ nào.
+    """
+    terms = _SEARCH_TERM_PATTERN.findall(unicodedata.normalize("NFC", query or ""))
+    if not terms:
+        return None
+    channel_key = channel_id.encode("utf-8").hex()
+    phrases = " ".join(f'"{term}"' for term in terms)
+    return f'channel_key : "{channel_key}" AND content : ({phrases})'
 
-        for row in rows:
-            msg_id, chan_id, user_id, content, ts_str, sender_name = row
-            # Chuyển đổi timestamp từ string ISO format sang datetime object
-            timestamp = datetime.datetime.now(datetime.timezone.utc) # Default nếu lỗi
-            try:
-                 timestamp = datetime.datetime.fromisoformat(ts_str)
-                 # Đảm bảo có timezone (sqlite không lưu tz, nhưng isoformat() cần nó)
-                 if timestamp.tzinfo is None:
-                      timestamp = timestamp.replace(tzinfo=datetime.timezone.utc) # Giả định là UTC
-            except ValueError:
-                 log_event(f"[WARN][STORAGE] Could not parse timestamp string from DB: {ts_str}")
-
-            messages.append(Message(
-                id=msg_id,
-                channel_id=chan_id,
-                user_id=user_id,
-                content=content,
-                timestamp=timestamp,
-                sender_display_name=sender_name
-            ))
 
+def search_messages(channel_id: str, query: str, cursor: Optional[Tuple[int, int]] = None,
+                    limit: int = 20) -> Tuple[List[SearchHit], Optional[Tuple[int, int]]]:
+    """
+    Tìm tin nhắn của kênh chứa mọi từ trong `query` (không phân biệt hoa thường và dấu tiếng Việt:
+    "tin nhan" khớp "tin nhắn"). Trả về (tối đa `limit` SearchHit, cursor của trang kế tiếp hoặc None nếu hết).
+
+    Kết quả được xếp hạng (điểm kiểu BM25, xem _SQL_SEARCH_RANKED; bằng điểm thì tin mới hơn trước) trong từng
+    nhóm SEARCH_RANK_WINDOW kết quả khớp mới nhất (theo thứ tự lưu), rồi tới nhóm cũ hơn: từ phổ biến khớp hàng
+    trăm nghìn tin nhắn vẫn chỉ phải xếp hạng một nhóm mỗi trang.
+    cursor = (rowid lớn nhất của nhóm, số kết quả đã trả về trong nhóm); tin nhắn mới lưu sau trang đầu không
+    làm xê dịch các trang sau.
+    """
+    if not _db_initialized:
+        log_event("[ERROR][STORAGE] Storage not initialized. Cannot search messages.")
+        return [], None
+    match = _search_match_expression(channel_id, query)
+    if match is None:
+        return [], None
+
+    window_top, offset = cursor if cursor else (_MAX_ROWID, 0)
+    snippet_open, snippet_close, snippet_ellipsis = SEARCH_SNIPPET_MARKERS
+    hits: List[SearchHit] = []
+    next_cursor: Optional[Tuple[int, int]] = None
+    try:
+        with _connections.reader() as conn:
+            while len(hits) < limit:
+                rows = conn.execute(_SQL_SEARCH_RANKED, {
+                    "match": match, "top": window_top, "window": SEARCH_RANK_WINDOW, "limit": limit - len(hits),
+                    "offset": offset, "open": snippet_open, "close": snippet_close, "ellipsis": snippet_ellipsis,
+                    "tokens": SEARCH_SNIPPET_TOKENS}).fetchall()
+                if rows:
+                    count, oldest, newest = rows[0][8:11]
+                else:
+                    newest, oldest, count = conn.execute(_SQL_SEARCH_WINDOW, (match, window_top, SEARCH_RANK_WINDOW)).fetchone()
+                    if not count:
+                        break
+                hits.extend(SearchHit(_row_to_message(row[:6]), row[6], row[7]) for row in rows)
+                offset += len(rows)
+                if offset < count:
+                    next_cursor = (newest, offset) # Trang đã đủ, nhóm này còn kết quả
+                    break
+                if count < SEARCH_RANK_WINDOW:
+                    break # Nhóm cuối cùng: không còn kết quả cũ hơn
+                window_top, offset = oldest - 1, 0
+                next_cursor = (window_top, 0)
     except sqlite3.Error as e:
-        log_event(f"[ERROR][STORAGE] Failed to get messages for channel {channel_id}: {e}")
-    finally:
-        if conn:
-            conn.close()
-        if acquired_lock:
-             _db_lock.release()
-
-    # Đảo ngược danh sách để có thứ tự thời gian tăng dần (cũ trước, mới sau)
-    messages.reverse()
-    return messages
+        log_event(f"[ERROR][STORAGE] Failed to search messages in channel {channel_id}: {e}")
+        return [], None
+    log_event(f"[STORAGE] Search in channel {channel_id} returned {len(hits)} messages.")
+    return hits, next_cursor
 
 # --- Có thể thêm các hàm khác ---
 # def get_latest_timestamp(channel_id: str) -> Optional[datetime.datetime]: ...
@@ -8,12 +8,13 @@ from PySide6.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineE
                                QPushButton, QFrame, QListWidget, QTextEdit, QComboBox,
                                QSpacerItem, QSizePolicy, QListWidgetItem, QMessageBox, QInputDialog)
 from PySide6.QtCore import Signal, Slot, Qt
-from PySide6.QtGui import QColor
+from PySide6.QtGui import QColor, QTextCursor
 
 from src.models.message import Message
 from src.models.channel import Channel
 from src.utils.logger import log_event # Đảm bảo đã import
 
+HISTORY_PREFETCH_PX = 200 # Người dùng cuộn tới cách đầu khung chat chừng này pixel thì yêu cầu trang lịch sử cũ hơn
 
 class ChatPage(QWidget):
     send_message_requested = Signal(str)
@@ -25,10 +26,15 @@ class ChatPage(QWidget):
     leave_channel_requested = Signal(str)
     request_start_livestream = Signal()
     request_view_livestream = Signal(str, str)
+    older_messages_requested = Signal()
 
     def __init__(self, parent: QWidget | None = None):
         super().__init__(parent)
         self.controller = None
+        # Cuộn vô hạn: mỗi lần cuộn lên gần đầu chỉ yêu cầu một trang, tới khi controller báo hết lịch sử
+        self._history_loading = False
+        self._history_exhausted = False
+        self._auto_scrolling = False # Đang cuộn bằng code (không phải người dùng cuộn)
         self._setup_ui()
         self.online_text_color = QColor(60, 179, 113)
         self.offline_text_color = Qt.GlobalColor.yellow
@@ -222,6 +228,7 @@ class ChatPage(QWidget):
         self.message_display = QTextEdit()
         self.message_display.setObjectName("messageDisplay")
         self.message_display.setReadOnly(True)
+        self.message_display.verticalScrollBar().valueChanged.connect(self._on_message_display_scrolled)
         chat_frame_layout.addWidget(self.message_display)
 
         input_frame = QFrame()
@@ -287,13 +294,12 @@ class ChatPage(QWidget):
         self.current_streamer_label.setText("")
         self.current_streamer_label.setVisible(False) # Ẩn label ban đầu
 
-    @Slot(Message)
-    def display_message_object(self, msg: Message):
+    def _format_message_html(self, msg: Message) -> str:
         sender = msg.sender_display_name or f"User_{msg.user_id[:6]}"
         timestamp_str = msg.get_formatted_timestamp("%H:%M") if hasattr(msg, 'get_formatted_timestamp') else "timestamp"
         escaped_content = html.escape(msg.content) if msg.content else ""
         content_html = escaped_content.replace('\n', '<br/>')
-        formatted_message = f"""
+        return f"""
         <div style='margin-bottom: 2px; padding-left: 0px; padding-top: 5px;'>
             <span style='color: #FFFFFF; font-weight: 550;'>{html.escape(sender)}</span>
             <span style='color: #a3a6aa; font-size: 9pt; margin-left: 8px;'>{timestamp_str}</span>
@@ -302,13 +308,65 @@ class ChatPage(QWidget):
             {content_html}
         </div>
         """
-        self.message_display.append(formatted_message)
+
+    def _set_scroll_value(self, value: int):
+        self._auto_scrolling = True
+        try:
+            self.message_display.verticalScrollBar().setValue(value)
+        finally:
+            self._auto_scrolling = False
+
+    @Slot(Message)
+    def display_message_object(self, msg: Message):
+        self._auto_scrolling = True
+        try:
+            self.message_display.append(self._format_message_html(msg))
+        finally:
+            self._auto_scrolling = False
+        self._set_scroll_value(self.message_display.verticalScrollBar().maximum())
+
+    @Slot(list, bool)
+    def prepend_messages(self, messages: List[Message], has_more: bool):
+        """
+        Chèn một trang tin nhắn cũ hơn (cũ trước) lên đầu khung chat mà không làm nhảy vị trí đang xem.
+        has_more=False: đã tới tin nhắn đầu tiên của kênh, không yêu cầu thêm.
+        """
+        self._history_loading = False
+        self._history_exhausted = not has_more
+        if not messages:
+            return
         scrollbar = self.message_display.verticalScrollBar()
-        scrollbar.setValue(scrollbar.maximum())
+        distance_from_bottom = scrollbar.maximum() - scrollbar.value()
+        self._auto_scrolling = True
+        try:
+            cursor = QTextCursor(self.message_display.document())
+            cursor.movePosition(QTextCursor.MoveOperation.Start)
+            cursor.insertHtml("".join(self._format_message_html(msg) for msg in messages))
+            cursor.insertBlock()
+        finally:
+            self._auto_scrolling = False
+        # Giữ nguyên khoảng cách tới đáy: nội dung đang xem đứng yên, trang mới nằm phía trên
+        self._set_scroll_value(scrollbar.maximum() - distance_from_bottom)
+        log_event(f"[UI][ChatPage] Prepended {len(messages)} older messages (has_more={has_more}).")
+
+    @Slot(int)
+    def _on_message_display_scrolled(self, value: int):
+        if self._auto_scrolling or self._history_loading or self._history_exhausted:
+            return
+        if value > HISTORY_PREFETCH_PX or self.message_display.document().isEmpty():
+            return
+        self._history_loading = True
+        self.older_messages_requested.emit()
 
     @Slot()
     def clear_message_display(self):
-        self.message_display.clear()
+        self._auto_scrolling = True
+        try:
+            self.message_display.clear()
+        finally:
+            self._auto_scrolling = False
+        self._history_loading = False
+        self._history_exhausted = False
 
     @Slot(str)
     def set_current_channel_name(self, name: str):
@@ -404,7 +462,7 @@ class ChatPage(QWidget):
         self.user_info_label.setToolTip(f"Logged in as: {display_name}")
 
     def clear_all(self):
-        self.message_display.clear()
+        self.clear_message_display()
         self.channel_list.clear()
         self.hosting_list.clear()
         self.member_list_widget.clear()
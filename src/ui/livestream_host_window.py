@@ -17,6 +17,10 @@ class LivestreamHostWindow(QDialog):
         self.video_label.setStyleSheet("background-color: black; color: white;")
         self.layout.addWidget(self.video_label, 1)
 
+        self.quality_label = QLabel("Chất lượng: --") # Bậc chất lượng hiện tại do bộ điều chỉnh thích ứng chọn
+        self.quality_label.setAlignment(Qt.AlignCenter)
+        self.layout.addWidget(self.quality_label)
+
         self.stop_button = QPushButton("Dừng Livestream")
         self.stop_button.clicked.connect(self._on_stop_clicked)
         self.layout.addWidget(self.stop_button)
@@ -25,6 +29,10 @@ class LivestreamHostWindow(QDialog):
     def update_preview_frame(self, pixmap: QPixmap):
         self.video_label.setPixmap(pixmap.scaled(self.video_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation))
 
+    @Slot(int, str)
+    def update_quality_rung(self, rung_index: int, rung_label: str):
+        self.quality_label.setText(f"Chất lượng: {rung_label} (bậc {rung_index + 1})")
+
     def _on_stop_clicked(self):
         self.stop_livestream_requested.emit()
         self.accept() # Hoặc self.close()
@@ -5,6 +5,7 @@ from PySide6.QtCore import Slot, Qt, Signal
 
 class LivestreamViewerWindow(QDialog):
     stop_viewing_requested = Signal() # Nếu viewer muốn chủ động đóng
+    display_size_changed = Signal(int, int) # Kích thước khung video, để pipeline giải mã co giãn sẵn frame
 
     def __init__(self, streamer_name: str, parent=None):
         super().__init__(parent)
@@ -25,7 +26,11 @@ class LivestreamViewerWindow(QDialog):
     @Slot(QPixmap)
     def update_viewer_frame(self, pixmap: QPixmap):
         if not pixmap.isNull():
-            self.video_label.setPixmap(pixmap.scaled(self.video_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation))
+            label_size = self.video_label.size()
+            if pixmap.width() > label_size.width() or pixmap.height() > label_size.height():
+                # Frame giải mã trước khi cửa sổ đổi kích thước: co nhanh, frame sau sẽ đúng kích thước
+                pixmap = pixmap.scaled(label_size, Qt.KeepAspectRatio, Qt.FastTransformation)
+            self.video_label.setPixmap(pixmap)
         else:
             self.video_label.setText("Stream bị lỗi hoặc đã kết thúc.")
 
@@ -33,6 +38,10 @@ class LivestreamViewerWindow(QDialog):
     #     self.stop_viewing_requested.emit()
     #     self.accept()
 
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.display_size_changed.emit(self.video_label.width(), self.video_label.height())
+
     def closeEvent(self, event):
         self.stop_viewing_requested.emit() # Báo cho service biết là đã đóng cửa sổ
         super().closeEvent(event)
\ No newline at end of file